@@ -6,19 +6,25 @@ Created on Jan 18, 2016
 import enum
 import logging
 from uuid import uuid1
-from cookiebot.multithreading import RepeatedTimer
+from cookiebot.multithreading import RepeatedTimer, DeadlineWatchdog, TaskFuture
+from cookiebot.tracing import tracer
+from cookiebot.logsetup import step_log
+from cookiebot.metrics import registry
+from cookiebot import hardware, i2c
 import time
 import array
 import sys
 import argparse
+import threading
 
+# per-task and per-pause debug output; see cookiebot.logsetup
+step_debug = step_log('actuator')
 
-onPI = True
-
-if onPI:
-    from Adafruit_MotorHAT import Adafruit_MotorHAT  # @UnresolvedImport
-    import RPi.GPIO as GPIO  # @UnresolvedImport
-    GPIO.setmode(GPIO.BOARD)
+steps_issued = registry.counter(
+    'cookiebot_actuator_steps_total', 'Steps issued to each stepper', ('actuator',))
+step_lateness = registry.histogram(
+    'cookiebot_step_lateness_seconds', 'How late each actuator\'s step timer woke',
+    ('actuator',))
 
 
 class Actuator(object):
@@ -39,20 +45,46 @@ class Actuator(object):
         executing_blocked = 2
         dead = 3
 
-    def __init__(self, identity='', run_interval=0.1):
+    def __init__(self, identity='', run_interval=0.1, lateness_warn=1.0,
+                 lateness_fault=None, precise=False):
         '''
         Constructor
 
         Prepares an actuator to receive commands, assigns its ID, and starts
         execution.
+
+        lateness_warn and lateness_fault are thresholds, in step intervals,
+        for how late a step may fire before a warning is logged or the
+        actuator is declared dead.  None turns the check off
+
+        precise puts the step timer in its sleep-then-spin precision mode,
+        which only spins while a task is executing
         '''
         self.logger.debug(
             'Create actuator {0} with interval {1}'.format(identity, run_interval))
         self.state = Actuator.State.ready
         self.identity = identity if identity else str(uuid1())
         self._task = None
-
-        self._timer = RepeatedTimer(run_interval, self._run_execution)
+        self._future = None
+
+        # time at which this actuator last became able to take a new command,
+        # i.e. the end of its last blocking task or the start of a non-blocking
+        # one.  Used to measure how long the stage takes to dispatch
+        self.ready_time = time.time()
+
+        self._task_start = None
+        # set_task runs a first step on the caller's thread, so it and the
+        # step timer must take turns with the task
+        self._execution_lock = threading.RLock()
+        watchdog = DeadlineWatchdog(warn=lateness_warn, fault=lateness_fault,
+                                    on_fault=self._deadline_fault,
+                                    name=self.identity)
+        self._timer = RepeatedTimer(run_interval, self._run_execution,
+                                    name=self.identity, watchdog=watchdog,
+                                    precision=precise,
+                                    spin_when=self._is_executing)
+        # the timer keeps this histogram anyway, on its own thread
+        step_lateness.labels(self.identity).adopt(self._timer.lateness, self)
 
     def __str__(self):
         return self.identity
@@ -60,6 +92,10 @@ class Actuator(object):
     def set_task(self, task=None, blocking=False):
         '''Public API for assigning a task to an actuator
 
+        Returns a TaskFuture that resolves to True when the task finishes,
+        to False if another task replaces it first, or fails with
+        ExecutionError if the actuator dies before it finishes
+
         Raises CommandError if the command is, for some reason, invalid
         '''
 
@@ -80,38 +116,105 @@ class Actuator(object):
             raise CommandError(
                 'Task {0} is not valid for actuator {1}'.format(task, self))
 
-        self._task = task
-        self._task_is_blocking = blocking
+        if tracer.enabled and self._task_start is not None and not self._task_is_complete():
+            self._trace_task(replaced=True)
+
+        with self._execution_lock:
+            self._task = task
+            self._task_is_blocking = blocking
+            self._task_start = time.time()
+            if not blocking:
+                self.ready_time = time.time()
+
+            future, replaced = TaskFuture(), self._future
+            self._future = future
+            if replaced is not None:
+                replaced.set_result(False)
+
+            self._run_execution()
 
-        self._run_execution()
+            # an empty task never starts executing, so it is already finished
+            if self.state == Actuator.State.ready and self._task_is_complete():
+                self._finish_task(future)
+            return future
 
     def _run_execution(self):
         '''Private method called repeatedly and frequently to update the state
 
         Raises ExecutionError if something goes wrong
         '''
+        with self._execution_lock:
+            if self._task and self.state == Actuator.State.ready or self.state == Actuator.State.executing:
+                self.state = Actuator.State.executing_blocked if self._task_is_blocking else Actuator.State.executing
 
-        if self._task and self.state == Actuator.State.ready or self.state == Actuator.State.executing:
-            self.state = Actuator.State.executing_blocked if self._task_is_blocking else Actuator.State.executing
-
-        if self.state == Actuator.State.executing or self.state == Actuator.State.executing_blocked:
-            if not self._check_bounds():
-                self.state = Actuator.State.dead
-                self.logger.error(
-                    'Bounds violated, setting state of {0} to dead'.format(self))
-
-            if self._task_is_complete():
-                self.state = Actuator.State.ready
-                self.logger.debug('Done with task for {0}'.format(self))
-            else:
-                try:
-                    self._execute_task()
-                except ExecutionError as e:
-                    self.logger.error(
-                        'Execution failed with error {0}'.format(e))
-                    self.logger.error(
-                        'Setting actuator to dead on account of error')
+            if self.state == Actuator.State.executing or self.state == Actuator.State.executing_blocked:
+                if not self._check_bounds():
                     self.state = Actuator.State.dead
+                    self.logger.error(
+                        'Bounds violated, setting state of {0} to dead'.format(self))
+                    self._fail_task('Bounds violated on {0}'.format(self))
+                    return
+
+                if self._task_is_complete():
+                    if self.state == Actuator.State.executing_blocked:
+                        self.ready_time = time.time()
+                    self.state = Actuator.State.ready
+                    if step_debug.enabled:
+                        step_debug.debug('Done with task for {0}'.format(self))
+                    if tracer.enabled and self._task_start is not None:
+                        self._trace_task()
+                    self._finish_task(self._future)
+                else:
+                    try:
+                        if tracer.enabled:
+                            start = time.time()
+                            self._execute_task()
+                            tracer.complete('step', 'actuator', self.identity,
+                                            start, time.time())
+                        else:
+                            self._execute_task()
+                    except ExecutionError as e:
+                        self.logger.error(
+                            'Execution failed with error {0}'.format(e))
+                        self.logger.error(
+                            'Setting actuator to dead on account of error')
+                        self.state = Actuator.State.dead
+                        self._fail_task(e.value)
+
+    def _finish_task(self, future):
+        '''Resolve future, if it is still the current task's, as done'''
+        if future is not None and future is self._future:
+            self._future = None
+            future.set_result(True)
+
+    def _fail_task(self, reason):
+        '''Fail the current task's future, if any, with ExecutionError'''
+        future, self._future = self._future, None
+        if future is not None:
+            future.set_exception(ExecutionError(reason))
+
+    def _is_executing(self):
+        return self.state in (Actuator.State.executing,
+                              Actuator.State.executing_blocked)
+
+    def timing_stats(self):
+        '''How accurately this actuator's steps are firing; see RepeatedTimer'''
+        return self._timer.timing_stats()
+
+    def _deadline_fault(self, lateness):
+        '''Called from the step thread when a step fires far too late'''
+        self.logger.error(
+            'Step on {0} fired {1:.2f}ms late, setting state to dead'.format(
+                self, lateness * 1e3))
+        self.state = Actuator.State.dead
+        self._fail_task('Step on {0} fired too late'.format(self))
+
+    def _trace_task(self, replaced=False):
+        '''Add the task that just ended to the trace, on its own track'''
+        tracer.complete('task', 'actuator', self.identity + ' tasks',
+                        self._task_start, time.time(),
+                        {'blocking': self._task_is_blocking, 'replaced': replaced})
+        self._task_start = None
 
     def kill(self):
         '''Public API method - kill this actuator
@@ -127,13 +230,16 @@ class Actuator(object):
             'Killing actuator {0} and stopping thread'.format(self))
         self.state = Actuator.State.dead
         self.pause()
+        self._fail_task('Actuator {0} was killed'.format(self))
 
     def pause(self):
-        self.logger.debug('Pausing thread for actuator {0}'.format(self))
+        if step_debug.enabled:
+            step_debug.debug('Pausing thread for actuator {0}'.format(self))
         self._timer.stop()
 
     def unpause(self):
-        self.logger.debug('Unpausing thread for actuator {0}'.format(self))
+        if step_debug.enabled:
+            step_debug.debug('Unpausing thread for actuator {0}'.format(self))
         self._timer.restart()
 
     def _check_bounds(self):
@@ -200,19 +306,22 @@ class StepperActuator(Actuator):
     function of each is described in Actuator.
     '''
     class StepType(enum.IntEnum):
-        if onPI:
-            single = Adafruit_MotorHAT.SINGLE
-            double = Adafruit_MotorHAT.DOUBLE
-            micro = Adafruit_MotorHAT.MICROSTEP
-            interleave = Adafruit_MotorHAT.INTERLEAVE
-        else:
-            single = 0
-            double = 1
-            micro = 2
-            interleave = 3
+        # Adafruit_MotorHAT's values, which the I2C bus manager shares
+        single = i2c.SINGLE
+        double = i2c.DOUBLE
+        micro = i2c.MICROSTEP
+        interleave = i2c.INTERLEAVE
 
     logger = logging.getLogger('cookiebot.Actuator.StepperActuator')
 
+    # False for subclasses whose steps are generated somewhere else, so no
+    # MotorHAT is opened even on a Pi
+    drives_hat = True
+
+    # how far the applied rate override may move towards its target per
+    # step, as a fraction, so a changed override ramps in instead of jumping
+    override_slew = 0.02
+
     def __init__(self,
                  identity='',
                  peak_rpm=30,
@@ -223,7 +332,13 @@ class StepperActuator(Actuator):
                  stepper_num=1,
                  step_type=StepType.double,
                  reversed=False,
-                 zero_pins={'start': 4, 'end': 4}):
+                 zero_pins={'start': 4, 'end': 4},
+                 time_scale=1.0,
+                 lateness_warn=1.0,
+                 lateness_fault=None,
+                 precise=False,
+                 bus=None,
+                 end_stops=None):
         '''
         Constructor
 
@@ -232,13 +347,34 @@ class StepperActuator(Actuator):
         constructor) and prepares an actuator for use.
 
         Connecting to hats and zeroing starting position goes here
+
+        time_scale speeds up (>1) or slows down (<1) every step rate of this
+        actuator, which is how simulated stages run recipes faster than real
+        time
+
+        bus is an optional cookiebot.i2c.I2CBusManager.  If given, steps and
+        releases are queued with it instead of being written by this thread,
+        and the Adafruit library is not used at all
+
+        end_stops optionally maps 'start' and/or 'end' to a
+        cookiebot.sensors.DigitalSensor.  A step towards an active end stop
+        kills the actuator.  Only the sensors' cached readings are checked,
+        so keep them sampled or watched
         '''
 
         # superclass constructor
-        run_interval = 1.0 / (peak_rpm * 200.0 / 60.0)
+        self.rpm = peak_rpm
+        self.time_scale = time_scale
+        # multiplies the step rate; see set_rate_override
+        self.rate_override = 1.0
+        self._applied_override = 1.0
+        run_interval = self._rpm_to_interval(peak_rpm)
 
         super(StepperActuator, self).__init__(
-            identity=identity, run_interval=run_interval)
+            identity=identity, run_interval=run_interval,
+            lateness_warn=lateness_warn, lateness_fault=lateness_fault,
+            precise=precise)
+        self._steps_issued = steps_issued.labels(self.identity)
 
         self.step_style = step_type
 
@@ -246,18 +382,44 @@ class StepperActuator(Actuator):
         self.step_size = dist_per_step
         self.max_steps = int(max_dist / self.step_size)
         self.zero_pins = zero_pins
-
-        if onPI:
-            self.hat = Adafruit_MotorHAT(addr=addr)
+        self.set_end_stops(**(end_stops or {}))
+        # while homing, reaching the start stop ends the task instead of
+        # killing the actuator
+        self._homing = False
+        self._hit_stop = False
+
+        # set by the owning stage to record every position change
+        self.journal = None
+        self.journal_axis = 0
+
+        self.addr = addr
+        self.stepper_num = stepper_num
+        self.direction = -1 if reversed else 1
+        self.bus = bus
+        if bus is not None:
+            # the bus manager sets the HAT up and makes every write; a
+            # MotorHAT here would reset the chip and open a second handle
+            bus.register(addr, stepper_num)
+            backend = hardware.NoHardware
+        elif self.drives_hat:
+            # the hardware libraries are only imported here, by the first
+            # actuator that needs them (see cookiebot.hardware)
+            backend = hardware.backend()
+        else:
+            backend = hardware.NoHardware
+        if backend.present:
+            MotorHAT = backend.MotorHAT
+            self.hat = MotorHAT(addr=addr)
             self.stepper = self.hat.getStepper(steps_per_rev, stepper_num)
             self.motors = [1, 2] if stepper_num == 1 else [3, 4]
+            self._release = MotorHAT.RELEASE
 
             if reversed:
-                self.forward = Adafruit_MotorHAT.BACKWARD
-                self.backward = Adafruit_MotorHAT.FORWARD
+                self.forward = MotorHAT.BACKWARD
+                self.backward = MotorHAT.FORWARD
             else:
-                self.forward = Adafruit_MotorHAT.FORWARD
-                self.backward = Adafruit_MotorHAT.BACKWARD
+                self.forward = MotorHAT.FORWARD
+                self.backward = MotorHAT.BACKWARD
 
             #for pin in self.zero_pins.itervalues():
             #    GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
@@ -269,40 +431,142 @@ class StepperActuator(Actuator):
 
     def set_rpm(self, new_rpm):
         """Set a new rpm value for this StepperActuator"""
-        new_interval = 1.0 / (new_rpm * 200.0 / 60.0)
-        self._timer.interval = new_interval
+        self.rpm = new_rpm
+        self._timer.interval = self._rpm_to_interval(new_rpm) / self._applied_override
+
+    def set_rate_override(self, factor):
+        """Run at factor times the set rpm, from now until changed
+
+        Safe from any thread.  A task that is running ramps to the new rate
+        by at most override_slew per step; the next task starts at it
+        """
+        if factor <= 0:
+            raise CommandError('Rate override must be positive, not {0}'.format(factor))
+        self.rate_override = float(factor)
+        if not self._is_executing():
+            self._apply_override(self.rate_override)
+
+    def set_task(self, task=None, blocking=False):
+        future = super(StepperActuator, self).set_task(task, blocking)
+        self._steps_issued.inc(len(task) - task.count(0))
+        # a new task starts at the target rate, with no ramp from the last
+        self._apply_override(self.rate_override)
+        return future
+
+    def _apply_override(self, factor):
+        self._applied_override = factor
+        self._timer.interval = self._rpm_to_interval(self.rpm) / factor
+
+    def _slew_override(self):
+        """Move the applied override one step's worth towards its target"""
+        target, applied = self.rate_override, self._applied_override
+        if applied == target:
+            return
+        limit = 1.0 + self.override_slew
+        self._apply_override(min(max(target, applied / limit), applied * limit))
+
+    def _rpm_to_interval(self, rpm):
+        """Convert an rpm to the period between steps, in seconds"""
+        return 1.0 / (rpm * 200.0 / 60.0) / self.time_scale
+
+    def set_end_stops(self, start=None, end=None):
+        '''Use sensors (anything with an active property, usually a
+        cookiebot.sensors.DigitalSensor) as this axis's end stops'''
+        self.end_stops = {k: v for k, v in (('start', start), ('end', end)) if v is not None}
+        self._start_stop = start
+        self._end_stop = end
 
     def go_to_zero(self):
-        pin_to_listen = self.zero_pins['start']
-
-        # do stuff here - how does GPIO work?
-        if onPI:
-            #while GPIO.input(pin_to_listen) == GPIO.HIGH:
-            #    time.sleep(0.01)
-            #    self.stepper.oneStep(
-            #        self.backward, self.step_style.value)
-            pass
-        
+        '''Home against the start end stop, or just call here zero without one'''
+        return self.home()
+
+    def home(self, fast_rpm=None, slow_rpm=None, backoff=20, travel=5000, timeout=None):
+        '''Find the start end stop and make it position zero
+
+        Runs fast towards the stop until it triggers, backs off by backoff
+        steps, then approaches again at slow_rpm so that zero is found at
+        the same point every time.  The stop is noticed on the very next
+        step after it triggers, through its cached value, so fast_rpm can be
+        the axis's full speed.  Blocks until done and returns the seconds it
+        took.
+
+        Raises ExecutionError if the stop is not found within travel steps
+        or does not release when backing off, and FutureTimeout if a phase
+        takes longer than timeout
+        '''
+        stop = self._start_stop
+        if stop is None:
+            self.step_pos = 0
+            return 0.0
+
+        start = time.time()
+        self.unpause()
+        rpm = self.rpm
+        fast_rpm = fast_rpm or rpm
+        slow_rpm = slow_rpm or fast_rpm / 5.0
+
+        self._homing = True
+        try:
+            if not stop.active and not self._home_move(-1, travel, fast_rpm, timeout):
+                raise ExecutionError(
+                    'No end stop found within {0} steps of {1}'.format(travel, self))
+
+            self._home_move(1, backoff, fast_rpm, timeout)
+            if stop.active:
+                raise ExecutionError(
+                    'End stop of {0} still active after backing off'.format(self))
+
+            if not self._home_move(-1, 2 * backoff, slow_rpm, timeout):
+                raise ExecutionError('{0} missed its end stop on the slow approach'.format(self))
+        finally:
+            self._homing = False
+            self.set_rpm(rpm)
+
         self.step_pos = 0
+        elapsed = time.time() - start
+        self.logger.info('Homed {0} in {1:.2f}s'.format(self, elapsed))
+        return elapsed
+
+    def _home_move(self, direction, steps, rpm, timeout):
+        '''Run one homing phase; True if it ended at the start stop'''
+        self._hit_stop = False
+        self.set_rpm(rpm)
+        self.set_task(array.array('b', [direction]) * steps, blocking=True).result(timeout)
+        return self._hit_stop
 
     def kill(self):
         super(StepperActuator, self).kill()
-        if onPI:
+        if self.bus is not None:
+            self.bus.release(self.addr, self.stepper_num)
+        elif self.hat is not None:
             for m in self.motors:
-                self.hat.getMotor(m).run(Adafruit_MotorHAT.RELEASE)
+                self.hat.getMotor(m).run(self._release)
 
     @property
     def real_pos(self):
         return self.step_pos * self.step_size
 
     def _check_bounds(self):
-        """TBD"""
-        if onPI:
-            return True
-            #return all([GPIO.input(p) == GPIO.HIGH for p in self.zero_pins.values()])
-        else:
+        """False if the next step would drive into an active end stop
+
+        Reads only the end stops' cached values - no I/O per step
+        """
+        if not self._task:
             return True
 
+        step = self._task[0]
+        if step < 0:
+            if self._start_stop is None or not self._start_stop.active:
+                return True
+            if self._homing:
+                self._task = self._task[:0]
+                self._hit_stop = True
+                return True
+            return False
+        if step > 0:
+            return not (self._end_stop is not None and self._end_stop.active)
+        return True
+
     def _validate_task(self, task):
         '''Check that task is an iterable containing only -1, 0 or 1'''
 
@@ -317,9 +581,16 @@ class StepperActuator(Actuator):
         return not self._task
 
     def _execute_task(self):
+        self._slew_override()
         step, self._task = self._task[0], self._task[1:]  # aka generalized pop
         self.step_pos += step
-        if onPI:
+        if step and self.journal is not None:
+            self.journal.position(self.journal_axis, self.step_pos)
+        if self.bus is not None:
+            if step:
+                self.bus.step(self.addr, self.stepper_num,
+                              step * self.direction, self.step_style.value)
+        elif self.stepper is not None:
             if step == -1:
                 # step back oneStep
                 self.stepper.oneStep(self.backward, self.step_style.value)
@@ -351,8 +622,22 @@ class ActuatorWrapper(object):
 
     def send(self, command):
         '''The primary method of each ActuatorWrapper - implement the custom
-        behavior needed to generate the actuator task, then set the task'''
-        pass
+        behavior needed to generate the actuator task, then set the task
+
+        Returns a TaskFuture that resolves when the wrapper can take its
+        next command, i.e. when every blocking task it set has finished
+        (see TaskFuture.gather)
+        '''
+        return TaskFuture.completed()
+
+    def timing_stats(self):
+        '''timing_stats() of every wrapped actuator, sorted by name'''
+        return [self._wrapped_actuators[k].timing_stats()
+                for k in sorted(self._wrapped_actuators)]
+
+    def zero(self):
+        '''Home every wrapped actuator at once; returns {identity: seconds}'''
+        return home_all(self._wrapped_actuators.values())
 
     def check_ready(self):
         '''Determine if all actuators can receive a command'''
@@ -368,6 +653,36 @@ class ActuatorWrapper(object):
         return True
 
 
+def home_all(actuators):
+    '''Home actuators in parallel, one thread each
+
+    Returns {identity: seconds taken}.  Waits for every actuator to finish,
+    then raises the first error, if any
+    '''
+    times = {}
+    errors = []
+
+    def home(act):
+        start = time.time()
+        try:
+            act.go_to_zero()
+        except Exception as e:
+            errors.append(e)
+        else:
+            times[act.identity] = time.time() - start
+
+    threads = [threading.Thread(target=home, args=(act,), name='{0} homing'.format(act))
+               for act in actuators]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    if errors:
+        raise errors[0]
+    return times
+
+
 class CommandError(Exception):
 
     def __init__(self, value):
@@ -0,0 +1,193 @@
+'''
+Created on Oct 18, 2026
+
+Line-based control protocol, for adjusting a running stage from outside
+
+A ControlServer listens on a local TCP port.  Each request is one line of
+words, and gets one line back: 'ok' followed by the result, or 'error'
+followed by what went wrong.  The stage commands are
+
+    override NAME FACTOR    set a live override (see IcingStage.set_override)
+    overrides               show every override
+    status                  whether the stage is live and how far it has got
+    profile [SECONDS]       dump every thread's stack and profile them all
+                            (see cookiebot.profiler)
+    stacks                  dump every thread's stack
+
+and register() adds more.  send_command() and this module's CLI are the
+client side:
+
+    python -m cookiebot.control override travel 1.5
+
+The stage CLI and the GUI start a server when given a port, the GUI through
+the COOKIEBOT_CONTROL_PORT environment variable.
+'''
+import argparse
+import logging
+import socket
+import SocketServer
+import sys
+import threading
+
+from cookiebot import profiler
+
+DEFAULT_PORT = 7441
+
+ENVIRONMENT = 'COOKIEBOT_CONTROL_PORT'
+
+
+class ControlError(Exception):
+    pass
+
+
+class _Handler(SocketServer.StreamRequestHandler):
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ''):
+            words = line.split()
+            if not words:
+                continue
+            self.wfile.write(self.server.control.handle(words) + '\n')
+
+
+class _Server(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class ControlServer(object):
+    '''Serves the control protocol for stage, on a background thread
+
+    Handlers run on the connection's thread, so whatever they call must be
+    safe from any thread
+    '''
+    logger = logging.getLogger('cookiebot.ControlServer')
+
+    def __init__(self, stage, port=DEFAULT_PORT, host='127.0.0.1'):
+        self.stage = stage
+        self._commands = {}
+        self.register('override', self._override, 'NAME FACTOR')
+        self.register('overrides', self._overrides)
+        self.register('status', self._status)
+        self.register('profile', self._profile, '[SECONDS]')
+        self.register('stacks', self._stacks)
+        self.register('help', self._help)
+
+        self._server = _Server((host, port), _Handler)
+        self._server.control = self
+        self.address = self._server.server_address
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='control server')
+        self._thread.daemon = True
+        self._thread.start()
+        self.logger.info('Control server listening on {0}:{1}'.format(*self.address))
+
+    def register(self, name, handler, usage=''):
+        '''Answer requests starting with name with handler(*arguments)
+
+        handler returns the reply text (after 'ok'), and raises ValueError,
+        TypeError or ControlError for a bad request
+        '''
+        self._commands[name] = (handler, usage)
+
+    def handle(self, words):
+        '''The reply line to one request, split into words'''
+        command = self._commands.get(words[0])
+        if command is None:
+            return 'error unknown command {0}'.format(words[0])
+        try:
+            return ('ok ' + command[0](*words[1:])).rstrip()
+        except (ValueError, TypeError, ControlError) as e:
+            return 'error {0}'.format(e)
+        except Exception as e:
+            self.logger.exception('Control command {0} failed'.format(' '.join(words)))
+            return 'error {0}'.format(e)
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def _override(self, name, factor):
+        self.stage.set_override(name, float(factor))
+        return '{0} {1}'.format(name, self.stage.overrides[name])
+
+    def _overrides(self):
+        return ' '.join('{0}={1}'.format(name, self.stage.overrides[name])
+                        for name in self.stage.OVERRIDES)
+
+    def _status(self):
+        return 'live={0} step={1}/{2} done={3}'.format(
+            int(self.stage.live), self.stage.step_index, self.stage._total_steps,
+            int(self.stage.recipe_done()))
+
+    def _profile(self, duration=profiler.DURATION):
+        paths = profiler.on_demand.start(float(duration))
+        if paths is None:
+            raise ControlError('a profile is already running')
+        return ' '.join(paths)
+
+    def _stacks(self):
+        return profiler.on_demand.write_stacks()
+
+    def _help(self):
+        return '; '.join('{0} {1}'.format(name, usage).strip()
+                         for name, (_, usage) in sorted(self._commands.items()))
+
+
+def send_command(command, port=DEFAULT_PORT, host='127.0.0.1', timeout=5.0):
+    '''Send one request line and return the text of its reply
+
+    Raises ControlError if the server replies with an error
+    '''
+    conn = socket.create_connection((host, port), timeout)
+    try:
+        conn.sendall(command.strip() + '\n')
+        reply = conn.makefile('r').readline().strip()
+    finally:
+        conn.close()
+
+    status, _, text = reply.partition(' ')
+    if status != 'ok':
+        raise ControlError(text or 'no reply')
+    return text
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Send a command to a running stage\'s control server',
+        add_help=True, prog='cookiebot_control')
+
+    parser.add_argument(
+        'command', nargs='+',
+        help='The command and its arguments, e.g. "override flow 0.8"; "help" lists them')
+
+    parser.add_argument(
+        '--host', default='127.0.0.1',
+        help='Host the control server is on')
+
+    parser.add_argument(
+        '--port', type=int, default=DEFAULT_PORT,
+        help='Port the control server listens on')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+
+    args = opts().parse_args()
+
+    try:
+        logging.info(send_command(' '.join(args.command), args.port, args.host))
+    except (ControlError, socket.error) as e:
+        logging.error('Command failed: {0}'.format(e))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
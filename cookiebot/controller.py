@@ -3,15 +3,107 @@ Created on Jan 18, 2016
 
 @author: justinpalpant
 '''
+import logging
+import time
+from collections import deque
+
+from cookiebot.metrics import registry
+
+queue_depth = registry.gauge(
+    'cookiebot_controller_queue_depth', 'Recipes waiting for an idle stage')
+
 
 class Controller(object):
     '''
-    classdocs
-    '''
+    Controller hands recipes out to the stages it owns
+
+    Recipes are queued with submit() and given, in order, to whichever stage
+    is idle the next time poll() is called.  A stage is idle when it is live
+    and has no recipe left to run.  The controller does not own any threads -
+    whoever owns the controller (a CLI, the GUI, a test harness) decides how
+    often to poll it
 
+    Recipes are told apart by Recipe.content_hash(), so a recipe submitted
+    while an identical one is queued or running is a duplicate order: it is
+    logged, and dropped if reject_duplicates is set
+    '''
+    logger = logging.getLogger('cookiebot.Controller')
 
-    def __init__(self, params):
+    def __init__(self, stages=None, reject_duplicates=False):
         '''
         Constructor
         '''
-        
\ No newline at end of file
+        self.stages = list(stages) if stages else []
+        self.queue = deque()
+        self.completed = 0
+        self.reject_duplicates = reject_duplicates
+
+        # stage -> (start time, content hash)
+        self._running = {}
+        self._queued = set()
+
+    def add_stage(self, stage):
+        self.stages.append(stage)
+
+    def submit(self, recipe):
+        '''Queue a recipe to be run on the next idle stage
+
+        Returns its content hash, or None if it was rejected as a duplicate
+        '''
+        key = recipe.content_hash()
+        if key in self._queued or any(h == key for _, h in self._running.values()):
+            self.logger.warning('Recipe {0} is already queued or running'.format(key[:12]))
+            if self.reject_duplicates:
+                return None
+
+        self.queue.append((key, recipe))
+        self._queued.add(key)
+        queue_depth.set(len(self.queue))
+        return key
+
+    def busy(self):
+        '''True while any recipe is queued or running'''
+        return bool(self.queue or self._running)
+
+    def poll(self):
+        '''Collect finished recipes and dispatch queued ones to idle stages
+
+        Returns the number of recipes that finished since the last poll
+        '''
+        finished = 0
+
+        for stage in self.stages:
+            if not stage.live:
+                if self._running.pop(stage, None) is not None:
+                    self.logger.error(
+                        'Stage {0} died while running a recipe'.format(stage))
+                continue
+
+            if not stage.recipe_done():
+                continue
+
+            running = self._running.pop(stage, None)
+            if running is not None:
+                finished += 1
+                self.logger.info('Stage {0} finished recipe {1} in {2:.2f}s'.format(
+                    stage, running[1][:12], time.time() - running[0]))
+
+            if self.queue:
+                key, recipe = self.queue.popleft()
+                if not any(k == key for k, _ in self.queue):
+                    self._queued.discard(key)
+                stage.load_recipe(recipe)
+                stage.start_recipe()
+                self._running[stage] = (time.time(), key)
+
+        self.completed += finished
+        queue_depth.set(len(self.queue))
+        return finished
+
+    def shutdown(self):
+        self.queue.clear()
+        self._queued.clear()
+        self._running.clear()
+        queue_depth.set(0)
+        for stage in self.stages:
+            stage.shutdown()
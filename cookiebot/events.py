@@ -0,0 +1,78 @@
+'''
+Created on Oct 18, 2026
+
+Typed events published by stages, for GUIs and anything else that wants to
+follow a recipe without polling the stage
+
+Every event is a namedtuple whose first field is the publishing stage and
+whose last is the time.time() it happened.  Subscribers are called in the
+publishing thread - the recipe timer or, for StepFinished and Progress, the
+actuator thread that finished the step - so they must return quickly and
+must not call back into the stage.  gui.threadsafety.StageEventRelay moves
+events onto the Qt main thread.
+'''
+import collections
+import logging
+import threading
+
+StepStarted = collections.namedtuple(
+    'StepStarted', ['stage', 'index', 'total', 'source', 'time'])
+
+StepFinished = collections.namedtuple(
+    'StepFinished', ['stage', 'index', 'total', 'duration', 'time'])
+
+CookieFinished = collections.namedtuple(
+    'CookieFinished', ['stage', 'position', 'index', 'time'])
+
+ActuatorFault = collections.namedtuple(
+    'ActuatorFault', ['stage', 'error', 'time'])
+
+# fraction is 0 to 1; eta is the estimated seconds left, None until known
+Progress = collections.namedtuple(
+    'Progress', ['stage', 'done', 'total', 'fraction', 'eta', 'time'])
+
+RecipeFinished = collections.namedtuple(
+    'RecipeFinished', ['stage', 'steps', 'elapsed', 'time'])
+
+# name is one of IcingStage.OVERRIDES; published by whichever thread set it
+OverrideChanged = collections.namedtuple(
+    'OverrideChanged', ['stage', 'name', 'factor', 'time'])
+
+
+class EventBus(object):
+    '''Delivers published events to subscribers, synchronously
+
+    subscribe() can be limited to some event types.  Subscribing and
+    unsubscribing are safe from any thread, including from inside a
+    subscriber; publishing never takes a lock
+    '''
+    logger = logging.getLogger('cookiebot.EventBus')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # replaced, never mutated, so publish can iterate without a lock
+        self._subscribers = ()
+
+    def subscribe(self, callback, event_types=None):
+        '''Call callback(event) for every event, or only those of event_types
+
+        Returns a token for unsubscribe()
+        '''
+        token = (callback, tuple(event_types) if event_types else None)
+        with self._lock:
+            self._subscribers = self._subscribers + (token,)
+        return token
+
+    def unsubscribe(self, token):
+        with self._lock:
+            self._subscribers = tuple(s for s in self._subscribers if s is not token)
+
+    def publish(self, event):
+        for callback, types in self._subscribers:
+            if types is not None and not isinstance(event, types):
+                continue
+            try:
+                callback(event)
+            except Exception:
+                self.logger.exception('Subscriber {0} failed on {1}'.format(
+                    callback, type(event).__name__))
@@ -0,0 +1,103 @@
+'''
+Created on Oct 18, 2026
+
+Lazily loaded hardware backends
+
+Nothing here imports Adafruit_MotorHAT or RPi.GPIO until the first
+actuator that drives a HAT asks for the backend, so importing cookiebot
+(or starting the GUI) costs nothing on machines without them, and on a Pi
+the libraries load once, in the background of building the stage.
+
+The backend is chosen by the COOKIEBOT_HARDWARE environment variable, or by
+calling select() before the first actuator is made:
+
+    auto      MotorHAT if its libraries import, otherwise none (the default)
+    motorhat  Adafruit MotorHATs and RPi.GPIO; failing to import is an error
+    none      no hardware - actuators only track their positions
+'''
+import logging
+import os
+import threading
+
+BACKENDS = ('auto', 'motorhat', 'none')
+
+ENVIRONMENT = 'COOKIEBOT_HARDWARE'
+
+logger = logging.getLogger('cookiebot.hardware')
+
+
+class HardwareError(Exception):
+    pass
+
+
+class NoHardware(object):
+    '''Stands in for the hardware libraries when there are none'''
+    name = 'none'
+    present = False
+    MotorHAT = None
+    GPIO = None
+
+
+class MotorHATHardware(object):
+    '''Adafruit MotorHATs for the steppers, RPi.GPIO for the pins'''
+    name = 'motorhat'
+    present = True
+
+    def __init__(self):
+        from Adafruit_MotorHAT import Adafruit_MotorHAT  # @UnresolvedImport
+        import RPi.GPIO as GPIO  # @UnresolvedImport
+
+        GPIO.setmode(GPIO.BOARD)
+        self.MotorHAT = Adafruit_MotorHAT
+        self.GPIO = GPIO
+
+
+_lock = threading.Lock()
+_selected = None
+_backend = None
+
+
+def select(name):
+    '''Choose the backend; must be called before backend() first loads one'''
+    global _selected
+    if name not in BACKENDS:
+        raise HardwareError('Unknown hardware backend {0}, expected one of {1}'.format(
+            name, ', '.join(BACKENDS)))
+
+    with _lock:
+        if _backend is not None and name not in ('auto', _backend.name):
+            raise HardwareError('The {0} backend is already in use'.format(_backend.name))
+        _selected = name
+
+
+def selected():
+    '''The configured backend name - select()ed, or from the environment'''
+    return _selected or os.environ.get(ENVIRONMENT, 'auto')
+
+
+def backend():
+    '''The hardware backend, loaded on first use'''
+    global _backend
+    if _backend is not None:
+        return _backend
+
+    with _lock:
+        if _backend is None:
+            _backend = _load(selected())
+            logger.info('Using the {0} hardware backend'.format(_backend.name))
+    return _backend
+
+
+def _load(name):
+    if name not in BACKENDS:
+        raise HardwareError('Unknown hardware backend {0} in {1}'.format(name, ENVIRONMENT))
+
+    if name == 'none':
+        return NoHardware()
+
+    try:
+        return MotorHATHardware()
+    except ImportError as e:
+        if name == 'motorhat':
+            raise HardwareError('MotorHAT backend unavailable: {0}'.format(e))
+        return NoHardware()
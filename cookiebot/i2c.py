@@ -0,0 +1,358 @@
+'''
+Created on Oct 18, 2026
+
+Single owner for the I2C bus shared by the Adafruit MotorHATs
+
+Adafruit's oneStep makes six separate setPWM calls (24 one-byte I2C writes)
+for every step, from whichever actuator thread is stepping.  Here every
+StepperActuator instead queues its steps and releases with an I2CBusManager.
+One thread owns the bus: it drains the queue, works out the PCA9685 channel
+values with the same coil sequence as Adafruit_StepperMotor.oneStep, and
+writes only the channels that changed as auto-incremented block writes - so
+X and Y steps that land on the same tick share one transaction.
+
+FakeSMBus stands in for smbus.SMBus when there is no hardware.
+'''
+import logging
+import threading
+import time
+import Queue
+
+# PCA9685 registers and bits
+MODE1 = 0x00
+MODE2 = 0x01
+LED0_ON_L = 0x06
+ALL_LED_ON_L = 0xFA
+PRESCALE = 0xFE
+
+ALLCALL = 0x01
+SLEEP = 0x10
+AUTO_INCREMENT = 0x20
+RESTART = 0x80
+OUTDRV = 0x04
+
+# the PWM frequency and oscillator of Adafruit_MotorHAT
+PWM_FREQUENCY = 1600
+OSCILLATOR = 25000000.0
+
+# the most data bytes SMBus allows in one block write
+MAX_BLOCK = 32
+
+# how long the stage CLI holds a batch open for other axes' steps; well
+# under a step period, so no step is noticeably delayed
+COALESCE_WINDOW = 0.0002
+
+FORWARD = 1
+BACKWARD = -1
+
+# Adafruit_MotorHAT step styles
+SINGLE = 1
+DOUBLE = 2
+INTERLEAVE = 3
+MICROSTEP = 4
+
+MICROSTEPS = 8
+MICROSTEP_CURVE = [0, 50, 98, 142, 180, 212, 236, 250, 255]
+
+# PCA9685 channels of each stepper port, as in Adafruit_StepperMotor
+STEPPER_PINS = {
+    1: {'pwma': 8, 'ain2': 9, 'ain1': 10, 'pwmb': 13, 'bin2': 12, 'bin1': 11},
+    2: {'pwma': 2, 'ain2': 3, 'ain1': 4, 'pwmb': 7, 'bin2': 6, 'bin1': 5},
+}
+
+STEP2COILS = [[1, 0, 0, 0], [1, 1, 0, 0], [0, 1, 0, 0], [0, 1, 1, 0],
+              [0, 0, 1, 0], [0, 0, 1, 1], [0, 0, 0, 1], [1, 0, 0, 1]]
+
+PIN_LOW = (0, 4096)
+PIN_HIGH = (4096, 0)
+
+
+class StepperChannel(object):
+    '''Coil state of one stepper port, following Adafruit's oneStep exactly'''
+
+    def __init__(self, stepper_num):
+        self.pins = STEPPER_PINS[stepper_num]
+        self.currentstep = 0
+
+    def step(self, direction, style):
+        '''Advance one step and return {channel: (on, off)} for every pin'''
+        half = MICROSTEPS // 2
+        sign = 1 if direction == FORWARD else -1
+        pwm_a = pwm_b = 255
+
+        if style == SINGLE:
+            self.currentstep += sign * (half if (self.currentstep // half) % 2 else MICROSTEPS)
+        elif style == DOUBLE:
+            self.currentstep += sign * (MICROSTEPS if (self.currentstep // half) % 2 else half)
+        elif style == INTERLEAVE:
+            self.currentstep += sign * half
+        elif style == MICROSTEP:
+            self.currentstep += sign
+
+        self.currentstep %= MICROSTEPS * 4
+
+        if style == MICROSTEP:
+            quarter, offset = divmod(self.currentstep, MICROSTEPS)
+            if quarter % 2:
+                pwm_a = MICROSTEP_CURVE[offset]
+                pwm_b = MICROSTEP_CURVE[MICROSTEPS - offset]
+            else:
+                pwm_a = MICROSTEP_CURVE[MICROSTEPS - offset]
+                pwm_b = MICROSTEP_CURVE[offset]
+            coils = [[1, 1, 0, 0], [0, 1, 1, 0], [0, 0, 1, 1], [1, 0, 0, 1]][quarter]
+        else:
+            coils = STEP2COILS[self.currentstep // half]
+
+        p = self.pins
+        return {
+            p['pwma']: (0, pwm_a * 16),
+            p['pwmb']: (0, pwm_b * 16),
+            p['ain2']: PIN_HIGH if coils[0] else PIN_LOW,
+            p['bin1']: PIN_HIGH if coils[1] else PIN_LOW,
+            p['ain1']: PIN_HIGH if coils[2] else PIN_LOW,
+            p['bin2']: PIN_HIGH if coils[3] else PIN_LOW,
+        }
+
+    def release(self):
+        '''Channel values that de-energise both coils'''
+        p = self.pins
+        return {p[name]: PIN_LOW for name in ('ain1', 'ain2', 'bin1', 'bin2')}
+
+
+class I2CBusManager(object):
+    '''Owns an SMBus and serialises every stepper write onto it
+
+    step() and release() only queue a command and return immediately, so
+    actuator threads never contend for the bus.  coalesce_window (seconds)
+    optionally holds the first command of a batch that long so that steps
+    from other axes scheduled for the same tick can join it.
+    '''
+    logger = logging.getLogger('cookiebot.I2CBusManager')
+
+    def __init__(self, bus, coalesce_window=0.0):
+        self.bus = bus
+        self.coalesce_window = coalesce_window
+
+        self._channels = {}
+        self._written = {}
+        self._queue = Queue.Queue()
+
+        self.commands = 0
+        self.transactions = 0
+        self.bytes_written = 0
+        self.busy_time = 0.0
+        self._opened = time.time()
+
+        self._thread = threading.Thread(target=self._run, name='I2C bus')
+        self._thread.daemon = True
+        self._thread.start()
+
+    @classmethod
+    def open(cls, busnum=1, **kwargs):
+        '''Manage the real I2C bus number busnum (needs the smbus module)'''
+        import smbus  # @UnresolvedImport
+        return cls(smbus.SMBus(busnum), **kwargs)
+
+    def register(self, addr, stepper_num):
+        '''Prepare a HAT address and stepper port for use - call before step()
+
+        The first registration of an address sets its PCA9685 up (see
+        _setup_chip), so nothing else may build a MotorHAT on it
+        '''
+        self._queue.put(('register', addr, stepper_num, None))
+
+    def step(self, addr, stepper_num, direction, style=DOUBLE):
+        self._queue.put(('step', addr, stepper_num, (direction, style)))
+
+    def release(self, addr, stepper_num):
+        self._queue.put(('release', addr, stepper_num, None))
+
+    @property
+    def queue_depth(self):
+        return self._queue.qsize()
+
+    def flush(self):
+        '''Block until every queued command has been written'''
+        self._queue.join()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        elapsed = time.time() - self._opened
+        return {'commands': self.commands,
+                'transactions': self.transactions,
+                'bytes': self.bytes_written,
+                'commands_per_transaction':
+                    self.commands / float(self.transactions) if self.transactions else 0.0,
+                'utilization': self.busy_time / elapsed if elapsed else 0.0,
+                'queue_depth': self.queue_depth}
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            if batch[0] is not None and self.coalesce_window:
+                time.sleep(self.coalesce_window)
+
+            try:
+                while True:
+                    batch.append(self._queue.get_nowait())
+            except Queue.Empty:
+                pass
+
+            stop = None in batch
+            try:
+                self._apply([c for c in batch if c is not None])
+            except IOError as e:
+                self.logger.error('I2C write failed: {0}'.format(e))
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+            if stop:
+                return
+
+    def _apply(self, batch):
+        '''Fold a batch of commands into channel values, then write them
+
+        Commands for different steppers are merged into one write per HAT.
+        A second command for the same stepper first flushes what is pending,
+        so no coil phase is ever skipped
+        '''
+        pending = {}
+        touched = set()
+
+        for kind, addr, num, arg in batch:
+            key = (addr, num)
+            if kind == 'register':
+                if key not in self._channels:
+                    self._channels[key] = StepperChannel(num)
+                if addr not in self._written:
+                    self._setup_chip(addr)
+                    self._written[addr] = {}
+                continue
+
+            if key in touched:
+                self._write_pending(pending)
+                pending = {}
+                touched = set()
+
+            channel = self._channels[key]
+            if kind == 'step':
+                values = channel.step(*arg)
+            else:
+                values = channel.release()
+            pending.setdefault(addr, {}).update(values)
+            touched.add(key)
+            self.commands += 1
+
+        self._write_pending(pending)
+
+    def _setup_chip(self, addr):
+        '''Set a PCA9685 up as Adafruit_MotorHAT's constructor does - every
+        channel off, totem-pole outputs, PWM at PWM_FREQUENCY - but with
+        AUTO_INCREMENT on for block writes
+
+        This is the only setup a HAT gets: building a MotorHAT as well would
+        reset MODE1 behind the manager's back
+        '''
+        bus = self.bus
+        for offset in xrange(4):
+            bus.write_byte_data(addr, ALL_LED_ON_L + offset, 0)
+        bus.write_byte_data(addr, MODE2, OUTDRV)
+        bus.write_byte_data(addr, MODE1, ALLCALL)
+        # the oscillator takes up to 500us to start
+        time.sleep(0.005)
+
+        prescale = int(round(OSCILLATOR / 4096 / PWM_FREQUENCY - 1))
+        mode = (bus.read_byte_data(addr, MODE1) & ~(SLEEP | RESTART)) | AUTO_INCREMENT
+        # the prescaler can only be written while asleep
+        bus.write_byte_data(addr, MODE1, mode | SLEEP)
+        bus.write_byte_data(addr, PRESCALE, prescale)
+        bus.write_byte_data(addr, MODE1, mode)
+        time.sleep(0.005)
+        bus.write_byte_data(addr, MODE1, mode | RESTART)
+
+    def _write_pending(self, pending):
+        for addr, values in pending.items():
+            self._write(addr, values)
+
+    def _write(self, addr, values):
+        '''Write the changed channels of one PCA9685 in as few blocks as possible
+
+        Unchanged channels between two changed ones are rewritten with their
+        current value, since one longer block is cheaper than two short ones
+        '''
+        written = self._written[addr]
+        changed = [ch for ch, v in values.items() if written.get(ch) != v]
+        if not changed:
+            return
+
+        start = time.time()
+
+        runs = [[]]
+        for ch in xrange(min(changed), max(changed) + 1):
+            value = values.get(ch, written.get(ch))
+            if value is None or len(runs[-1]) == MAX_BLOCK // 4:
+                runs.append([])
+            if value is not None:
+                runs[-1].append((ch, value))
+
+        for run in runs:
+            if not run:
+                continue
+
+            data = []
+            for ch, (on, off) in run:
+                data.extend((on & 0xFF, on >> 8, off & 0xFF, off >> 8))
+                written[ch] = (on, off)
+            self.bus.write_i2c_block_data(addr, LED0_ON_L + 4 * run[0][0], data)
+            self.transactions += 1
+            self.bytes_written += len(data)
+
+        self.busy_time += time.time() - start
+
+
+class FakeSMBus(object):
+    '''In-memory PCA9685s with the smbus.SMBus methods I2CBusManager uses
+
+    Block writes only auto-increment when the chip's MODE1 says so, like the
+    real part, so a missing AUTO_INCREMENT setup shows up in tests
+    '''
+
+    def __init__(self, write_delay=0.0):
+        self.write_delay = write_delay
+        self.registers = {}
+        self.transactions = 0
+
+    def _chip(self, addr):
+        if addr not in self.registers:
+            self.registers[addr] = bytearray(256)
+        return self.registers[addr]
+
+    def read_byte_data(self, addr, reg):
+        self.transactions += 1
+        return self._chip(addr)[reg]
+
+    def write_byte_data(self, addr, reg, value):
+        self.transactions += 1
+        self._chip(addr)[reg] = value
+
+    def write_i2c_block_data(self, addr, reg, data):
+        if len(data) > MAX_BLOCK:
+            raise IOError('SMBus block writes are limited to {0} bytes'.format(MAX_BLOCK))
+
+        self.transactions += 1
+        chip = self._chip(addr)
+        increment = 1 if chip[MODE1] & AUTO_INCREMENT else 0
+        for i, value in enumerate(data):
+            chip[reg + i * increment] = value
+
+        if self.write_delay:
+            time.sleep(self.write_delay)
+
+    def channel(self, addr, ch):
+        '''The (on, off) counts currently programmed on one PWM channel'''
+        r = self._chip(addr)[LED0_ON_L + 4 * ch:LED0_ON_L + 4 * ch + 4]
+        return (r[0] | r[1] << 8, r[2] | r[3] << 8)
@@ -0,0 +1,542 @@
+'''
+Created on Oct 18, 2026
+
+Run each actuator in its own process, so its steps do not share a GIL with
+the GUI, logging or recipe parsing
+
+IsolatedActuator looks like a StepperActuator to the wrappers and the stage,
+but the real StepperActuator lives in a child process.  Commands reach it
+through a CommandRing in shared memory (single producer, single consumer,
+no locks), with one byte down a pipe to wake the child.  The child
+publishes its state, step_pos, ready_time and task progress to a StateBlock,
+also in shared memory, guarded by a sequence counter (a seqlock), so
+reading any of them from the parent is a couple of struct unpacks with no
+round trip.  Only rare requests such as timing_stats use a real pipe, and
+task completions come back on another so that set_task can return a
+TaskFuture.
+
+Use it by passing actuator_class=IsolatedActuator to the wrappers, or
+isolate=True to IcingStage.
+'''
+import array
+import logging
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+
+from cookiebot.actuators import (Actuator, StepperActuator, CommandError,
+                                 ExecutionError)
+from cookiebot.multithreading import TaskFuture
+
+# command kinds
+SET_TASK = 1
+SET_RPM = 2
+SET_POSITION = 3
+PAUSE = 4
+UNPAUSE = 5
+KILL = 6
+ZERO = 7
+JOURNAL = 8
+STATS = 9
+SET_OVERRIDE = 10
+
+# record header: length of the whole record (0 = skip to the start of the
+# ring), command sequence number, command kind
+_HEADER = struct.Struct('<IIB')
+_CURSORS = struct.Struct('<QQ')
+
+# seq, state, step_pos, ready_time, last command handled, steps left in the
+# task, steps in the task, rpm
+_STATE = struct.Struct('<IbidIIId')
+_SEQ = struct.Struct('<I')
+
+# task completion: SET_TASK command seq, outcome
+_EVENT = struct.Struct('<Ib')
+DONE = 1
+REPLACED = 0
+FAILED = -1
+
+
+class CommandRing(object):
+    '''A byte ring of variable-length command records in shared memory
+
+    Exactly one process may push and one may pop.  The producer owns head
+    and the consumer owns tail; each only ever writes its own cursor, after
+    the data it covers, so neither side needs a lock
+    '''
+
+    def __init__(self, capacity=1 << 20):
+        self.capacity = capacity
+        self._mem = mmap.mmap(-1, _CURSORS.size + capacity)
+        self._base = _CURSORS.size
+
+    def _cursors(self):
+        return _CURSORS.unpack_from(self._mem, 0)
+
+    def push(self, kind, seq, payload='', timeout=1.0):
+        '''Append one record, waiting up to timeout seconds for room'''
+        size = _HEADER.size + len(payload)
+        if size > self.capacity // 2:
+            raise CommandError('Command of {0} bytes is too big for the ring'.format(size))
+
+        deadline = time.time() + timeout
+        while True:
+            head, tail = self._cursors()
+            pos = head % self.capacity
+            # a record never wraps; if it will not fit before the end of the
+            # ring, the rest of the ring is skipped
+            skip = self.capacity - pos if self.capacity - pos < size else 0
+            if self.capacity - (head - tail) >= size + skip:
+                break
+            if time.time() > deadline:
+                raise CommandError('Command ring is full')
+            time.sleep(0.001)
+
+        if skip:
+            if skip >= _HEADER.size:
+                _HEADER.pack_into(self._mem, self._base + pos, 0, 0, 0)
+            head += skip
+            pos = 0
+
+        _HEADER.pack_into(self._mem, self._base + pos, size, seq, kind)
+        self._mem[self._base + pos + _HEADER.size:self._base + pos + size] = payload
+        # publish the record only once it is completely written
+        struct.pack_into('<Q', self._mem, 0, head + size)
+
+    def pop(self):
+        '''Remove and return the oldest (kind, seq, payload), or None'''
+        head, tail = self._cursors()
+        while tail != head:
+            pos = tail % self.capacity
+            if self.capacity - pos < _HEADER.size:
+                tail += self.capacity - pos
+                continue
+
+            size, seq, kind = _HEADER.unpack_from(self._mem, self._base + pos)
+            if size == 0:
+                tail += self.capacity - pos
+                continue
+
+            start = self._base + pos + _HEADER.size
+            payload = self._mem[start:self._base + pos + size]
+            struct.pack_into('<Q', self._mem, 8, tail + size)
+            return kind, seq, payload
+
+        struct.pack_into('<Q', self._mem, 8, tail)
+        return None
+
+
+class StateBlock(object):
+    '''Actuator state published by one writer process for any reader
+
+    The writer makes the sequence number odd while it updates the fields and
+    even again afterwards; a reader retries until it sees the same even
+    number before and after reading
+    '''
+
+    def __init__(self):
+        self._mem = mmap.mmap(-1, _STATE.size)
+        self._seq = 0
+        self.write(Actuator.State.ready, 0, time.time(), 0, 0, 0, 0.0)
+
+    def write(self, state, step_pos, ready_time, handled, remaining, total, rpm):
+        self._seq += 1
+        _SEQ.pack_into(self._mem, 0, self._seq)
+        _STATE.pack_into(self._mem, 0, self._seq, state, step_pos, ready_time,
+                         handled, remaining, total, rpm)
+        self._seq += 1
+        _SEQ.pack_into(self._mem, 0, self._seq)
+
+    def read(self):
+        '''(state, step_pos, ready_time, handled, remaining, total, rpm)'''
+        while True:
+            fields = _STATE.unpack_from(self._mem, 0)
+            if not fields[0] & 1 and _SEQ.unpack_from(self._mem, 0)[0] == fields[0]:
+                return fields[1:]
+
+
+class IsolatedActuator(object):
+    '''Proxy for a StepperActuator running in a child process
+
+    Takes the same keyword arguments as StepperActuator, and offers the same
+    interface to wrappers and stages.  Commands are asynchronous, so until
+    the child has handled the latest one, state and step_pos report what
+    that command will make them - exactly what a local set_task shows the
+    moment it returns.
+
+    nice, if given, is passed to os.nice in the child (negative values need
+    root)
+    '''
+    logger = logging.getLogger('cookiebot.Actuator.IsolatedActuator')
+
+    def __init__(self, identity='', bus=None, nice=None, ring_size=1 << 20,
+                 startup_timeout=5.0, **actuator_kwargs):
+        if bus is not None:
+            raise CommandError('An I2CBusManager cannot be shared with an isolated actuator')
+
+        self.identity = identity
+        self._ring = CommandRing(ring_size)
+        self._block = StateBlock()
+        self._lock = threading.Lock()
+        self._seq = 0
+        # (command seq, value) that state and step_pos will have once the
+        # child has handled that command
+        self._predicted_state = (0, None)
+        self._predicted_pos = (0, None)
+        self._journal = None
+        self._journal_axis = 0
+        self.rate_override = 1.0
+        self._stats = {}
+        # SET_TASK seq -> TaskFuture, until the child reports the outcome
+        self._futures = {}
+        # set by kill(), after which the doorbell is closed
+        self._closed = False
+
+        self._doorbell_r, self._doorbell_w = os.pipe()
+        self._events_r, events_w = os.pipe()
+        self._replies, child_replies = multiprocessing.Pipe(duplex=False)
+
+        actuator_kwargs['identity'] = identity
+        self._process = multiprocessing.Process(
+            target=_serve, name=identity,
+            args=(actuator_kwargs, self._ring, self._block, self._doorbell_r,
+                  self._doorbell_w, events_w, child_replies, nice))
+        self._process.daemon = True
+        self._process.start()
+        os.close(self._doorbell_r)
+        os.close(events_w)
+        child_replies.close()
+
+        self._events_thread = threading.Thread(
+            target=self._read_events, name=identity + ' events')
+        self._events_thread.daemon = True
+        self._events_thread.start()
+
+        if not self._replies.poll(startup_timeout):
+            self._process.terminate()
+            raise ExecutionError('Actuator process {0} did not start'.format(identity))
+        info = self._replies.recv()
+        if 'error' in info:
+            self._process.join()
+            raise ExecutionError(info['error'])
+
+        self.step_size = info['step_size']
+        self.max_steps = info['max_steps']
+        self.logger.debug('Actuator {0} running in process {1}'.format(
+            identity, self._process.pid))
+
+    def __str__(self):
+        return self.identity
+
+    @property
+    def state(self):
+        if self._process.exitcode is not None:
+            return Actuator.State.dead
+
+        state, _, _, handled, _, _, _ = self._block.read()
+        seq, predicted = self._predicted_state
+        if handled < seq:
+            return predicted
+        return Actuator.State(state)
+
+    @property
+    def step_pos(self):
+        _, step_pos, _, handled, _, _, _ = self._block.read()
+        seq, predicted = self._predicted_pos
+        if handled < seq:
+            return predicted
+        return step_pos
+
+    @step_pos.setter
+    def step_pos(self, value):
+        self._command(SET_POSITION, struct.pack('<i', value), position=value)
+
+    @property
+    def real_pos(self):
+        return self.step_pos * self.step_size
+
+    @property
+    def ready_time(self):
+        return self._block.read()[2]
+
+    @property
+    def rpm(self):
+        return self._block.read()[6]
+
+    def progress(self):
+        '''(steps done, steps in the task) of the current task'''
+        _, _, _, _, remaining, total, _ = self._block.read()
+        return total - remaining, total
+
+    @property
+    def journal(self):
+        return self._journal
+
+    @journal.setter
+    def journal(self, journal):
+        self._journal = journal
+        self._send_journal()
+
+    @property
+    def journal_axis(self):
+        return self._journal_axis
+
+    @journal_axis.setter
+    def journal_axis(self, axis):
+        self._journal_axis = axis
+        self._send_journal()
+
+    def set_task(self, task=None, blocking=False):
+        '''Queue a task for the child; returns a TaskFuture and raises
+        CommandError just like Actuator.set_task'''
+        state = self.state
+        if state is Actuator.State.dead:
+            raise CommandError('Actuator is dead and cannot be commanded')
+        if state is Actuator.State.executing_blocked:
+            raise CommandError('Cannot change task while executing a blocking task')
+
+        try:
+            task = array.array('b', task)
+        except (TypeError, OverflowError):
+            raise CommandError('Task {0} is not valid for actuator {1}'.format(task, self))
+        if not set(task) <= set((-1, 0, 1)):
+            raise CommandError('Task {0} is not valid for actuator {1}'.format(task, self))
+
+        if not task:
+            predicted = state
+        elif blocking:
+            predicted = Actuator.State.executing_blocked
+        else:
+            predicted = Actuator.State.executing
+
+        future = TaskFuture()
+        self._command(SET_TASK, struct.pack('<B', blocking) + task.tostring(),
+                      state=predicted, future=future)
+        return future
+
+    def set_rpm(self, new_rpm):
+        self._command(SET_RPM, struct.pack('<d', new_rpm))
+
+    def set_rate_override(self, factor):
+        if factor <= 0:
+            raise CommandError('Rate override must be positive, not {0}'.format(factor))
+        self.rate_override = float(factor)
+        self._command(SET_OVERRIDE, struct.pack('<d', factor))
+
+    def go_to_zero(self, timeout=None):
+        '''Home the actuator in the child and wait for it, like
+        StepperActuator.go_to_zero; returns the seconds it took
+
+        Raises ExecutionError if homing failed, FutureTimeout after timeout
+        '''
+        start = time.time()
+        future = TaskFuture()
+        self._command(ZERO, position=0, future=future)
+        future.result(timeout)
+        return time.time() - start
+
+    def pause(self):
+        self._command(PAUSE)
+
+    def unpause(self):
+        self._command(UNPAUSE)
+
+    def kill(self):
+        '''Kill the actuator and wait for its process to exit'''
+        if self._process.exitcode is None:
+            try:
+                self._command(KILL)
+            except (CommandError, OSError):
+                pass
+            self._process.join(2.0)
+            if self._process.is_alive():
+                self._process.terminate()
+        with self._lock:
+            if not self._closed:
+                self._closed = True
+                os.close(self._doorbell_w)
+
+    def timing_stats(self):
+        '''The child's RepeatedTimer.timing_stats(), or the last ones seen'''
+        if self._process.exitcode is None:
+            try:
+                self._command(STATS)
+                if self._replies.poll(1.0):
+                    self._stats = self._replies.recv()
+            except (CommandError, OSError, EOFError):
+                pass
+        return self._stats
+
+    def _task_is_complete(self):
+        state = self.state
+        return state is Actuator.State.ready or state is Actuator.State.dead
+
+    def _send_journal(self):
+        if self._journal is not None:
+            self._command(JOURNAL, struct.pack('<B', self._journal_axis) +
+                          self._journal.path.encode('utf-8'))
+
+    def _read_events(self):
+        '''Resolve task futures as the child reports on them'''
+        data = ''
+        while True:
+            try:
+                chunk = os.read(self._events_r, 4096)
+            except OSError:
+                chunk = ''
+            if not chunk:
+                break
+
+            data += chunk
+            while len(data) >= _EVENT.size:
+                seq, outcome = _EVENT.unpack_from(data)
+                data = data[_EVENT.size:]
+                with self._lock:
+                    future = self._futures.pop(seq, None)
+                if future is None:
+                    continue
+                if outcome == FAILED:
+                    future.set_exception(ExecutionError(
+                        'Task failed on actuator {0}'.format(self)))
+                else:
+                    future.set_result(outcome == DONE)
+
+        # the child has exited; nothing pending can finish now
+        os.close(self._events_r)
+        with self._lock:
+            futures, self._futures = self._futures.values(), {}
+        for future in futures:
+            future.set_exception(ExecutionError(
+                'Actuator process {0} exited'.format(self)))
+
+    def _command(self, kind, payload='', state=None, position=None, future=None):
+        with self._lock:
+            if self._closed:
+                raise CommandError('Actuator {0} has been killed'.format(self))
+            self._seq += 1
+            if future is not None:
+                self._futures[self._seq] = future
+            if state is not None:
+                self._predicted_state = (self._seq, state)
+            if position is not None:
+                self._predicted_pos = (self._seq, position)
+            self._ring.push(kind, self._seq, payload)
+            os.write(self._doorbell_w, b'!')
+
+
+def _serve(kwargs, ring, block, doorbell_r, doorbell_w, events, replies, nice):
+    '''Child process: run one StepperActuator, taking commands from ring'''
+    os.close(doorbell_w)
+    # Ctrl-C is for the parent, which kills its actuators in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logger = IsolatedActuator.logger
+
+    if nice:
+        try:
+            os.nice(nice)
+        except OSError as e:
+            logger.warning('Could not renice actuator process: {0}'.format(e))
+
+    lock = threading.Lock()
+    progress = {'total': 0, 'handled': 0}
+
+    class PublishedActuator(StepperActuator):
+        '''Publishes its state to the StateBlock after every execution'''
+        # the step timer starts before StepperActuator.__init__ is done
+        constructed = False
+
+        def _run_execution(self):
+            super(PublishedActuator, self)._run_execution()
+            if self.constructed:
+                publish(self)
+
+    def report(seq, future):
+        if future.exception() is not None:
+            outcome = FAILED
+        else:
+            outcome = DONE if future.result() else REPLACED
+        os.write(events, _EVENT.pack(seq, outcome))
+
+    def publish(act):
+        with lock:
+            block.write(act.state, act.step_pos, act.ready_time, progress['handled'],
+                        len(act._task) if act._task else 0, progress['total'], act.rpm)
+
+    try:
+        act = PublishedActuator(**kwargs)
+    except Exception as e:
+        replies.send({'error': 'Could not create actuator: {0}'.format(e)})
+        return
+
+    act.constructed = True
+    replies.send({'step_size': act.step_size, 'max_steps': act.max_steps})
+    publish(act)
+
+    journal = None
+    running = True
+    while running:
+        try:
+            if not os.read(doorbell_r, 4096):
+                # the parent is gone
+                break
+        except OSError:
+            break
+
+        while True:
+            record = ring.pop()
+            if record is None:
+                break
+            kind, seq, payload = record
+
+            try:
+                if kind == SET_TASK:
+                    blocking = bool(ord(payload[0]))
+                    task = array.array('b', payload[1:])
+                    progress['total'] = len(task)
+                    future = act.set_task(task, blocking)
+                    future.add_done_callback(
+                        lambda f, seq=seq: report(seq, f))
+                elif kind == SET_RPM:
+                    act.set_rpm(struct.unpack('<d', payload)[0])
+                elif kind == SET_OVERRIDE:
+                    act.set_rate_override(struct.unpack('<d', payload)[0])
+                elif kind == SET_POSITION:
+                    act.step_pos = struct.unpack('<i', payload)[0]
+                elif kind == PAUSE:
+                    act.pause()
+                elif kind == UNPAUSE:
+                    act.unpause()
+                elif kind == ZERO:
+                    try:
+                        act.go_to_zero()
+                        outcome = DONE
+                    except Exception as e:
+                        logger.error('Homing {0} failed: {1}'.format(act, e))
+                        outcome = FAILED
+                    os.write(events, _EVENT.pack(seq, outcome))
+                elif kind == JOURNAL:
+                    from cookiebot.journal import ExecutionJournal
+                    if journal is None:
+                        journal = ExecutionJournal(payload[1:].decode('utf-8'))
+                    act.journal = journal
+                    act.journal_axis = ord(payload[0])
+                elif kind == STATS:
+                    replies.send(act.timing_stats())
+                elif kind == KILL:
+                    running = False
+            except CommandError as e:
+                logger.error('Command {0} rejected by {1}: {2}'.format(seq, act, e))
+                if kind in (SET_TASK, ZERO):
+                    os.write(events, _EVENT.pack(seq, FAILED))
+
+            progress['handled'] = seq
+            publish(act)
+
+    act.kill()
+    publish(act)
+    if journal is not None:
+        journal.close()
@@ -0,0 +1,159 @@
+'''
+Created on Oct 18, 2026
+
+Append-only execution journal, so a stage can resume a recipe after a crash
+
+The journal is a flat file of fixed-size binary records.  Each record is
+written with a single os.write on an O_APPEND descriptor, so it reaches the
+OS as soon as it is written and a dead process loses nothing.  fsync (which
+only matters if the whole Pi loses power) is batched on a background timer,
+so no actuator thread ever waits on the SD card.
+'''
+import collections
+import logging
+import os
+import struct
+import time
+import zlib
+
+from cookiebot.multithreading import RepeatedTimer
+
+# type, axis, value, crc32 of the first three fields
+_RECORD = struct.Struct('<BBi')
+_CRC = struct.Struct('<I')
+RECORD_SIZE = _RECORD.size + _CRC.size
+
+RECIPE_BEGIN = 1   # axis unused, value = number of steps in the recipe
+RECIPE_CHECK = 2   # axis unused, value = fingerprint of the recipe steps
+STEP_DISPATCH = 3  # axis unused, value = index of the step being started
+POSITION = 4       # value = step_pos of the axis after its latest step
+RECIPE_END = 5     # axis and value unused
+
+JournalState = collections.namedtuple(
+    'JournalState', ['total', 'fingerprint', 'dispatched', 'positions', 'finished'])
+
+
+class ExecutionJournal(object):
+    '''Records recipe progress and axis positions as they happen
+
+    Writes are cheap enough to make after every single motor step.
+    write_time and records can be used to check that claim on a given machine
+    - see overhead()
+    '''
+    logger = logging.getLogger('cookiebot.ExecutionJournal')
+
+    def __init__(self, path, sync_interval=0.5):
+        '''Open (or create) the journal at path for appending
+
+        sync_interval is the longest time, in seconds, that a record can sit
+        in the OS cache before it is fsync'd to disk
+        '''
+        self.path = path
+        self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._dirty = False
+
+        self.records = 0
+        self.write_time = 0.0
+
+        self._sync_timer = RepeatedTimer(sync_interval, self.sync,
+                                         name='journal sync')
+
+    def begin_recipe(self, steps):
+        '''Start a fresh journal for a newly loaded list of recipe steps'''
+        os.ftruncate(self._fd, 0)
+        self._write(RECIPE_BEGIN, 0, len(steps))
+        self._write(RECIPE_CHECK, 0, fingerprint(steps))
+        self.sync()
+
+    def step_dispatched(self, index):
+        self._write(STEP_DISPATCH, 0, index)
+
+    def position(self, axis, step_pos):
+        '''Record the position of one axis - called from actuator threads
+
+        No lock is needed: O_APPEND makes each small write atomic
+        '''
+        self._write(POSITION, axis, step_pos)
+
+    def end_recipe(self):
+        self._write(RECIPE_END, 0, 0)
+        self.sync()
+
+    def overhead(self):
+        '''Mean time, in seconds, spent writing one record'''
+        return self.write_time / self.records if self.records else 0.0
+
+    def sync(self):
+        if self._fd is not None and self._dirty:
+            self._dirty = False
+            os.fsync(self._fd)
+
+    def close(self):
+        self._sync_timer.stop()
+        if self._fd is not None:
+            self.sync()
+            os.close(self._fd)
+            self._fd = None
+
+    def _write(self, rtype, axis, value):
+        if self._fd is None:
+            return
+
+        start = time.time()
+        body = _RECORD.pack(rtype, axis, value)
+        os.write(self._fd, body + _CRC.pack(zlib.crc32(body) & 0xffffffff))
+        self._dirty = True
+
+        # unlocked, so concurrent writers can occasionally lose a count; these
+        # are only used to estimate overhead
+        self.records += 1
+        self.write_time += time.time() - start
+
+    @staticmethod
+    def recover(path):
+        '''Read a journal back and return the last consistent JournalState
+
+        Reading stops at the first torn or corrupt record.  Returns None if
+        the file does not exist or does not start with a recipe
+        '''
+        if not os.path.exists(path):
+            return None
+
+        with open(path, 'rb') as f:
+            data = f.read()
+
+        total = check = None
+        dispatched = -1
+        positions = {}
+        finished = False
+
+        for offset in xrange(0, len(data) - RECORD_SIZE + 1, RECORD_SIZE):
+            body = data[offset:offset + _RECORD.size]
+            crc, = _CRC.unpack_from(data, offset + _RECORD.size)
+            if zlib.crc32(body) & 0xffffffff != crc:
+                ExecutionJournal.logger.warning(
+                    'Journal {0} is corrupt after byte {1}'.format(path, offset))
+                break
+
+            rtype, axis, value = _RECORD.unpack(body)
+            if rtype == RECIPE_BEGIN:
+                total = value
+            elif rtype == RECIPE_CHECK:
+                check = value
+            elif rtype == STEP_DISPATCH:
+                dispatched = value
+            elif rtype == POSITION:
+                positions[axis] = value
+            elif rtype == RECIPE_END:
+                finished = True
+
+        if total is None:
+            return None
+
+        return JournalState(total, check, dispatched, positions, finished)
+
+
+def fingerprint(steps):
+    '''A cheap, stable 31-bit fingerprint of a list of recipe steps'''
+    return zlib.crc32(repr([sorted((int(k), v) for k, v in s.items())
+                            for s in steps])) & 0x7fffffff
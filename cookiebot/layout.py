@@ -0,0 +1,177 @@
+'''
+Created on Oct 18, 2026
+
+Tray layouts: where each cookie of a tray sits on the stage
+
+A TrayLayout is a grid of columns x rows slots, (column, row) from (0, 0),
+with the centre of slot (0, 0) at origin and neighbouring slots pitch apart,
+all in stage inches.  Any slot can be rotated (degrees, counterclockwise)
+and scaled, about its centre, for cookies that sit at an angle or patterns
+that should come out smaller or larger.
+
+Each slot is one affine transform from pattern coordinates to stage
+coordinates, and apply() maps a whole pattern's points through it in one go
+- with numpy when it is installed, in a single pass over plain lists when
+not.  Layouts are data: JSON files in data/layouts, e.g.
+
+    {"columns": 6, "rows": 4, "origin": [0.0, 0.0], "pitch": [3.0, 3.0],
+     "slots": {"5,3": {"rotation": 90, "scale": 0.8}}}
+'''
+import json
+import math
+import os
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+LAYOUT_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'data', 'layouts')
+
+DEFAULT = '2x2'
+
+
+class LayoutError(Exception):
+    pass
+
+
+class TrayLayout(object):
+    '''A columns x rows grid of cookie slots'''
+
+    def __init__(self, columns=2, rows=2, origin=(0.0, 0.0), pitch=(4.5, 4.5),
+                 slots=None, name=''):
+        '''
+        slots optionally maps (column, row) to {'rotation': degrees,
+        'scale': factor}; slots not mentioned are neither rotated nor scaled
+        '''
+        if columns < 1 or rows < 1:
+            raise LayoutError('A tray needs at least one slot, not {0}x{1}'.format(columns, rows))
+
+        self.columns = columns
+        self.rows = rows
+        self.origin = (float(origin[0]), float(origin[1]))
+        self.pitch = (float(pitch[0]), float(pitch[1]))
+        self.slots = dict(slots or {})
+        self.name = name or '{0}x{1}'.format(columns, rows)
+
+        for pos in self.slots:
+            if pos not in self:
+                raise LayoutError('Slot {0} is not on a {1}x{2} tray'.format(pos, columns, rows))
+
+        self._transforms = {pos: self._transform(pos) for pos in self.positions()}
+
+    def __str__(self):
+        return self.name
+
+    def __contains__(self, pos):
+        return (len(pos) == 2 and 0 <= pos[0] < self.columns and 0 <= pos[1] < self.rows and
+                int(pos[0]) == pos[0] and int(pos[1]) == pos[1])
+
+    def __len__(self):
+        return self.columns * self.rows
+
+    def positions(self):
+        '''Every slot, row by row'''
+        return [(column, row) for row in xrange(self.rows) for column in xrange(self.columns)]
+
+    def centre(self, pos):
+        '''Stage coordinates of the centre of slot pos'''
+        return (self.origin[0] + pos[0] * self.pitch[0],
+                self.origin[1] + pos[1] * self.pitch[1])
+
+    def transform(self, pos):
+        '''(a, b, c, d, e, f) of slot pos: a pattern point (x, y) goes to
+        (a*x + b*y + c, d*x + e*y + f)
+
+        Raises LayoutError for a position that is not on this tray
+        '''
+        try:
+            return self._transforms[pos]
+        except (KeyError, TypeError):
+            raise LayoutError('Slot {0} is not on the {1} tray'.format(pos, self))
+
+    def _transform(self, pos):
+        slot = self.slots.get(pos, {})
+        angle = math.radians(slot.get('rotation', 0.0))
+        scale = slot.get('scale', 1.0)
+        # exact for the common unrotated slot, so nothing picks up rounding
+        cos = 1.0 if not angle else math.cos(angle)
+        sin = 0.0 if not angle else math.sin(angle)
+
+        cx, cy = self.centre(pos)
+        return (scale * cos, -scale * sin, cx, scale * sin, scale * cos, cy)
+
+    def apply(self, points, pos):
+        '''Map a sequence of pattern points to stage coordinates for slot pos
+
+        Returns a list of (x, y) tuples
+        '''
+        a, b, c, d, e, f = self.transform(pos)
+        if not len(points):
+            return []
+
+        if numpy is not None:
+            xy = numpy.asarray(points, dtype=float)
+            matrix = numpy.array([[a, d], [b, e]])
+            return map(tuple, (xy.dot(matrix) + (c, f)).tolist())
+
+        if b == 0.0 and d == 0.0:
+            return [(a * x + c, e * y + f) for x, y in points]
+        return [(a * x + b * y + c, d * x + e * y + f) for x, y in points]
+
+    def to_pattern(self, point, pos):
+        '''The inverse of apply, for one stage point: where it is in slot
+        pos's pattern coordinates'''
+        a, b, c, d, e, f = self.transform(pos)
+        x, y = point[0] - c, point[1] - f
+        det = a * e - b * d
+        return ((e * x - b * y) / det, (a * y - d * x) / det)
+
+    def to_dict(self):
+        data = {'columns': self.columns, 'rows': self.rows,
+                'origin': list(self.origin), 'pitch': list(self.pitch)}
+        if self.slots:
+            data['slots'] = {'{0},{1}'.format(*pos): dict(slot)
+                             for pos, slot in self.slots.items()}
+        return data
+
+    @classmethod
+    def from_dict(cls, data, name=''):
+        '''A layout from to_dict's format; missing entries take the defaults
+
+        Raises LayoutError if data does not describe a layout
+        '''
+        try:
+            slots = {}
+            for key, slot in data.get('slots', {}).items():
+                column, row = key.split(',')
+                slots[(int(column), int(row))] = {
+                    k: float(v) for k, v in slot.items() if k in ('rotation', 'scale')}
+
+            return cls(columns=int(data.get('columns', 2)), rows=int(data.get('rows', 2)),
+                       origin=data.get('origin', (0.0, 0.0)),
+                       pitch=data.get('pitch', (4.5, 4.5)),
+                       slots=slots, name=name)
+        except (AttributeError, TypeError, ValueError, IndexError) as e:
+            raise LayoutError('Not a tray layout: {0}'.format(e))
+
+
+def load_layout(name=DEFAULT):
+    '''The layout in data/layouts/<name>.json, or in the file name
+
+    Raises LayoutError if it cannot be read
+    '''
+    path = name if os.path.splitext(name)[1] else os.path.join(LAYOUT_DIR, name + '.json')
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except (IOError, ValueError) as e:
+        raise LayoutError('Cannot load tray layout {0}: {1}'.format(name, e))
+    return TrayLayout.from_dict(data, os.path.splitext(os.path.basename(path))[0])
+
+
+def available_layouts():
+    '''Names of the layouts in data/layouts'''
+    return sorted(os.path.splitext(f)[0] for f in os.listdir(LAYOUT_DIR)
+                  if f.endswith('.json'))
@@ -0,0 +1,239 @@
+'''
+Created on Oct 18, 2026
+
+Load-testing harness that runs many simulated IcingStages at once
+
+Every simulated stage is a normal IcingStage whose actuators run without
+hardware (the 'none' backend of cookiebot.hardware) and whose timers are
+sped up by time_scale.  Stages run real recipes built from
+data/icing_patterns and are fed by a Controller, either all inside this
+process or one per worker process.
+'''
+import argparse
+import itertools
+import logging
+import multiprocessing
+import resource
+import sys
+import time
+
+from cookiebot import hardware
+from cookiebot.controller import Controller
+from cookiebot.layout import TrayLayout
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage
+
+
+class SimulatedIcingStage(IcingStage):
+    '''An IcingStage that records how long each step waited to be dispatched
+
+    Dispatch latency is the time from the moment every actuator could accept
+    a new command to the moment _check_recipe actually sent the next step
+    '''
+
+    def __init__(self, name='', **kwargs):
+        super(SimulatedIcingStage, self).__init__(**kwargs)
+        self.name = name
+        self.latencies = []
+        self.steps_dispatched = 0
+
+    def __str__(self):
+        return self.name
+
+    def _check_recipe(self):
+        remaining = len(self.steps)
+
+        super(SimulatedIcingStage, self)._check_recipe()
+
+        if len(self.steps) < remaining:
+            self.latencies.append(self.dispatch_latency)
+            self.steps_dispatched += 1
+
+
+def percentile(values, fraction):
+    '''Nearest-rank percentile of an already sorted list'''
+    if not values:
+        return 0.0
+    idx = min(len(values) - 1, max(0, int(round(fraction * len(values))) - 1))
+    return values[idx]
+
+
+def build_trays(count, patterns=None, layout=None):
+    '''Make count recipes filling every slot of layout (default 2x2),
+    cycling through patterns (default: all)'''
+    patterns = patterns or list(Recipe.IcingType)
+    cycle = itertools.cycle(patterns)
+    positions = (layout or TrayLayout()).positions()
+
+    trays = []
+    for _ in xrange(count):
+        r = Recipe()
+        for pos in positions:
+            r.add_cookie({'icing': next(cycle)}, pos)
+        trays.append(r)
+
+    return trays
+
+
+def run_stages(num_stages, trays_per_stage=1, time_scale=50.0, patterns=None,
+               poll_interval=0.05):
+    '''Run trays on num_stages simulated stages in this process
+
+    Returns a list with one result dictionary per stage; see _stage_result
+    '''
+    stages = [SimulatedIcingStage(name='stage-{0}'.format(i), time_scale=time_scale)
+              for i in xrange(num_stages)]
+    controller = Controller(stages)
+
+    for recipe in build_trays(num_stages * trays_per_stage, patterns):
+        controller.submit(recipe)
+
+    cpu_start = _cpu_time()
+    start = time.time()
+    try:
+        controller.poll()
+        while controller.busy():
+            time.sleep(poll_interval)
+            controller.poll()
+    finally:
+        elapsed = time.time() - start
+        cpu = _cpu_time() - cpu_start
+        alive = [s.live for s in stages]
+        controller.shutdown()
+
+    # threads share one process, so CPU and memory can only be split evenly
+    return [_stage_result(s, live, elapsed, time_scale, cpu / num_stages,
+                          _max_rss_kb() / float(num_stages))
+            for s, live in zip(stages, alive)]
+
+
+def _run_worker(args):
+    '''Pool entry point - run one stage in its own process'''
+    index, trays, time_scale, names = args
+    # nested enums do not pickle, so patterns travel by name
+    patterns = [getattr(Recipe.IcingType, n) for n in names] if names else None
+    result = run_stages(1, trays, time_scale, patterns)[0]
+    result['stage'] = 'process-{0}'.format(index)
+    return result
+
+
+def run_stage_pool(num_stages, trays_per_stage=1, time_scale=50.0, patterns=None):
+    '''Run each simulated stage in its own worker process'''
+    names = [p.name for p in patterns] if patterns else None
+    pool = multiprocessing.Pool(num_stages)
+    try:
+        return pool.map(_run_worker, [(i, trays_per_stage, time_scale, names)
+                                      for i in xrange(num_stages)])
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _stage_result(stage, live, elapsed, time_scale, cpu, rss_kb):
+    latencies = sorted(stage.latencies)
+    # rates are reported in machine time, not simulated time
+    machine_time = elapsed * time_scale
+
+    return {
+        'stage': str(stage),
+        'live': live,
+        'steps': stage.steps_dispatched,
+        'elapsed': elapsed,
+        'latency_p50': percentile(latencies, 0.50),
+        'latency_p90': percentile(latencies, 0.90),
+        'latency_p99': percentile(latencies, 0.99),
+        'latency_max': latencies[-1] if latencies else 0.0,
+        'steps_per_sec': stage.steps_dispatched / machine_time if machine_time else 0.0,
+        'cpu_sec': cpu,
+        'cpu_fraction': cpu / elapsed if elapsed else 0.0,
+        'rss_kb': rss_kb,
+    }
+
+
+def summarize(num_stages, results):
+    '''Collapse per-stage results into one row of the scaling table'''
+    latencies = sorted(r['latency_p99'] for r in results)
+    return {
+        'stages': num_stages,
+        'failed': sum(1 for r in results if not r['live']),
+        'latency_p50': max(r['latency_p50'] for r in results),
+        'latency_p99': percentile(latencies, 1.0),
+        'steps_per_sec': sum(r['steps_per_sec'] for r in results),
+        'cpu_per_stage': sum(r['cpu_fraction'] for r in results) / len(results),
+        'rss_kb_per_stage': sum(r['rss_kb'] for r in results) / len(results),
+    }
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _max_rss_kb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Measure how the control software scales with many simulated stages',
+        add_help=True, prog='cookiebot_loadtest')
+
+    parser.add_argument(
+        '--stages', nargs='+', type=int, default=[1, 2, 4, 8],
+        help='Numbers of simultaneous stages to try, in order')
+
+    parser.add_argument(
+        '--trays', type=int, default=1,
+        help='Number of 2x2 trays each stage should ice')
+
+    parser.add_argument(
+        '--time-scale', type=float, default=50.0,
+        help='How many times faster than real time the actuators should run')
+
+    parser.add_argument(
+        '--recipes', nargs='*', default=[],
+        help='Icing patterns to cycle through (names from Recipe.IcingType).  Default all')
+
+    parser.add_argument(
+        '--processes', action='store_true',
+        help='Run each stage in its own process instead of as threads of this one')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+
+    # per-step output from dozens of stages would swamp the measurement
+    logging.getLogger('cookiebot.Stage').setLevel(logging.WARNING)
+    logging.getLogger('cookiebot.Controller').setLevel(logging.WARNING)
+    # accelerated timers are expected to run late; lateness is in the table
+    logging.getLogger('cookiebot.DeadlineWatchdog').setLevel(logging.ERROR)
+
+    args = opts().parse_args()
+    # never drive real motors, even on a Pi
+    hardware.select('none')
+    patterns = [getattr(Recipe.IcingType, r) for r in args.recipes] or None
+
+    rows = []
+    for n in args.stages:
+        logging.info('Running {0} stage(s)'.format(n))
+        if args.processes:
+            results = run_stage_pool(n, args.trays, args.time_scale, patterns)
+        else:
+            results = run_stages(n, args.trays, args.time_scale, patterns)
+        rows.append(summarize(n, results))
+
+    logging.info('stages  failed  p50 latency(ms)  p99 latency(ms)  steps/s  cpu/stage  rss/stage(MB)')
+    for row in rows:
+        logging.info('{stages:6d}  {failed:6d}  {0:15.2f}  {1:15.2f}  {steps_per_sec:7.2f}  '
+                     '{cpu_per_stage:9.1%}  {2:13.1f}'.format(
+                         row['latency_p50'] * 1000, row['latency_p99'] * 1000,
+                         row['rss_kb_per_stage'] / 1024.0, **row))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+'''
+Created on Oct 18, 2026
+
+Logging that keeps off the step threads
+
+install() moves a logger's handlers onto a background thread: the logger
+gets a QueueHandler, which only formats the message and puts the record on
+a bounded queue, and a QueueListener thread passes each record on to the
+real handlers.  A thread that logs never waits for a console, file or GUI,
+and when the queue is full records are dropped, not waited for.  (Python 2
+has no logging.handlers.QueueHandler, so these follow its design.)
+
+Per-step debug output - every task, step dispatch and pause - is off by
+default, per subsystem, and costs one attribute check when off:
+
+    steps = step_log('actuator')
+    ...
+    if steps.enabled:
+        steps.debug('Done with task for {0}'.format(self))
+
+Switch subsystems on with set_step_debug(), or at start-up with the
+COOKIEBOT_STEP_DEBUG environment variable (comma separated, or 'all').
+'''
+import atexit
+import logging
+import os
+import Queue
+import threading
+
+from cookiebot.metrics import registry
+
+ENVIRONMENT = 'COOKIEBOT_STEP_DEBUG'
+
+# subsystems with per-step debug output
+SUBSYSTEMS = ('actuator', 'wrapper', 'stage')
+
+logger = logging.getLogger('cookiebot.logsetup')
+
+queue_depth = registry.gauge(
+    'cookiebot_log_queue_depth', 'Log records waiting for the logging thread', ('logger',))
+records_dropped = registry.counter(
+    'cookiebot_log_records_dropped_total', 'Log records dropped because the queue was full',
+    ('logger',))
+
+
+class QueueHandler(logging.Handler):
+    '''Puts records on a queue for a QueueListener to handle
+
+    The message is formatted here, so objects it mentions may change
+    afterwards, and tracebacks are rendered to text.  emit never blocks: if
+    the queue is full the record is dropped and counted in dropped
+    '''
+
+    def __init__(self, queue, name='root'):
+        super(QueueHandler, self).__init__()
+        self.queue = queue
+        self.dropped = 0
+        self._dropped = records_dropped.labels(name)
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Queue.Full:
+            self.dropped += 1
+            self._dropped.inc()
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(object):
+    '''Hands records from a queue to handlers, on its own thread'''
+
+    def __init__(self, queue, *handlers):
+        self.queue = queue
+        self.handlers = handlers
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='logging')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        '''Handle every record already queued, then stop the thread'''
+        if self._thread is None:
+            return
+        self.queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            for handler in self.handlers:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+
+
+def install(name=None, capacity=10000):
+    '''Move the handlers of the logger called name (default the root logger)
+    onto a QueueListener thread
+
+    Returns the running listener.  It is stopped, and the queue flushed, at
+    exit
+    '''
+    target = logging.getLogger(name)
+    handlers = [h for h in target.handlers if not isinstance(h, QueueHandler)]
+
+    queue = Queue.Queue(capacity)
+    listener = QueueListener(queue, *handlers)
+    for handler in handlers:
+        target.removeHandler(handler)
+    target.addHandler(QueueHandler(queue, name or 'root'))
+    queue_depth.labels(name or 'root').set_function(queue.qsize)
+
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class StepLog(object):
+    '''Per-step debug output of one subsystem
+
+    Check enabled before building a message; debug() logs to
+    cookiebot.steps.<subsystem>
+    '''
+
+    def __init__(self, subsystem):
+        self.subsystem = subsystem
+        self.logger = logging.getLogger('cookiebot.steps.' + subsystem)
+        self.enabled = False
+        # the logger's own method, so records show the caller's function
+        self.debug = self.logger.debug
+
+
+_step_logs = {name: StepLog(name) for name in SUBSYSTEMS}
+
+
+def step_log(subsystem):
+    return _step_logs[subsystem]
+
+
+def set_step_debug(subsystems, enabled=True):
+    '''Switch per-step debug output of subsystems (names, or 'all') on or off
+
+    Raises ValueError for an unknown subsystem
+    '''
+    if isinstance(subsystems, basestring):
+        subsystems = [subsystems]
+    if 'all' in subsystems:
+        subsystems = SUBSYSTEMS
+    unknown = set(subsystems) - set(SUBSYSTEMS)
+    if unknown:
+        raise ValueError('Unknown step debug subsystem(s) {0}, expected some of {1}'.format(
+            ', '.join(sorted(unknown)), ', '.join(SUBSYSTEMS)))
+
+    for name in subsystems:
+        log = _step_logs[name]
+        log.enabled = enabled
+        # shown even where the rest of cookiebot logs at INFO
+        log.logger.setLevel(logging.DEBUG if enabled else logging.NOTSET)
+
+
+if os.environ.get(ENVIRONMENT):
+    try:
+        set_step_debug([s.strip() for s in os.environ[ENVIRONMENT].split(',') if s.strip()])
+    except ValueError as e:
+        logger.warning('Ignoring ${0}: {1}'.format(ENVIRONMENT, e))
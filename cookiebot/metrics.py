@@ -0,0 +1,374 @@
+'''
+Created on Oct 18, 2026
+
+Counters, gauges and histograms for the whole of cookiebot, served in
+Prometheus text format
+
+Metrics are registered once, at import, on the process's registry, and a
+label set is bound once, where its owner is made, so the hot path is a
+single call:
+
+    steps_issued = registry.counter(
+        'cookiebot_actuator_steps_total', 'Steps issued to each stepper', ('actuator',))
+    ...
+    self._steps_issued = steps_issued.labels(self.identity)
+    ...
+    self._steps_issued.inc(steps)
+
+Updates never take a lock.  Counters and histograms keep one cell per
+writing thread and add them up when read; the cells of threads that have
+finished (a paused actuator's step thread comes back as a new thread) are
+folded into one retired cell.  A gauge is a single value that is set, or a
+function called when read.  A histogram can also adopt a LatencyHistogram
+that is already being kept, like a RepeatedTimer's lateness, at no cost to
+its writer; it is retired once its owner is gone.
+
+MetricsServer serves registry.exposition() over HTTP for Prometheus to
+scrape; the stage CLI (--metrics) and the GUI (the COOKIEBOT_METRICS
+environment variable) start one.  Every series comes with
+cookiebot_info{machine="..."}, so machines can be compared side by side:
+
+    rate(cookiebot_trays_completed_total[1h]) * 3600    trays per hour
+'''
+import BaseHTTPServer
+import logging
+import platform
+import SocketServer
+import threading
+import weakref
+from collections import OrderedDict
+
+from cookiebot.multithreading import LatencyHistogram
+
+DEFAULT_PORT = 9441
+
+ENVIRONMENT = 'COOKIEBOT_METRICS'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+def _format_labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('{0}="{1}"'.format(
+        name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in pairs) + '}'
+
+
+class _Shards(object):
+    '''One cell per writing thread, made by factory on the thread's first
+    write, plus any adopted cells
+
+    Only the cell's own thread writes it.  Once that thread has finished
+    (or an adopted cell's owner has been collected), merge(retired, cell)
+    folds it into the retired cell, under the lock, when cells are next
+    read or a new thread first writes
+    '''
+
+    def __init__(self, factory, merge):
+        self._factory = factory
+        self._merge = merge
+        self._retired = factory()
+        # id(cell) -> (alive(), cell)
+        self._cells = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+
+    def mine(self):
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._factory()
+            self._add(threading.current_thread().is_alive, cell)
+            self._local.cell = cell
+            return cell
+
+    def adopt(self, cell, owner):
+        ref = weakref.ref(owner)
+        self._add(lambda: ref() is not None, cell)
+
+    def _add(self, alive, cell):
+        with self._lock:
+            self._retire()
+            self._cells[id(cell)] = (alive, cell)
+
+    def _retire(self):
+        for key, (alive, cell) in self._cells.items():
+            if not alive():
+                self._merge(self._retired, cell)
+                del self._cells[key]
+
+    def cells(self):
+        with self._lock:
+            self._retire()
+            return [cell for _, cell in self._cells.values()] + [self._retired]
+
+
+def _add_count(retired, cell):
+    retired[0] += cell[0]
+
+
+class _CounterChild(object):
+
+    def __init__(self, metric):
+        self._shards = _Shards(lambda: [0.0], _add_count)
+
+    def inc(self, amount=1):
+        self._shards.mine()[0] += amount
+
+    def value(self):
+        return sum(cell[0] for cell in self._shards.cells())
+
+    def samples(self, name):
+        yield name, (), self.value()
+
+
+class _GaugeChild(object):
+
+    def __init__(self, metric):
+        self._value = 0.0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        '''Read the gauge by calling function(), from the reading thread'''
+        self._function = function
+
+    def value(self):
+        return self._function() if self._function is not None else self._value
+
+    def samples(self, name):
+        yield name, (), self.value()
+
+
+class _HistogramChild(object):
+
+    def __init__(self, metric):
+        self._shards = _Shards(lambda: LatencyHistogram(metric.smallest, metric.buckets),
+                               LatencyHistogram.merge)
+        self.smallest = metric.smallest
+        self.buckets = metric.buckets
+
+    def observe(self, value):
+        self._shards.mine().add(value)
+
+    def adopt(self, histogram, owner):
+        '''Also count histogram, a LatencyHistogram with this metric's
+        buckets written by one thread at a time, for as long as owner lives
+        (and what it counted after that)'''
+        self._shards.adopt(histogram, owner)
+
+    def _parts(self):
+        return self._shards.cells()
+
+    def value(self):
+        '''{'count', 'sum', 'mean', 'max'} over every cell'''
+        parts = self._parts()
+        count = sum(p.count for p in parts)
+        total = sum(p.total for p in parts)
+        return {'count': count, 'sum': total,
+                'mean': total / count if count else 0.0,
+                'max': max([p.max for p in parts] or [0.0])}
+
+    def samples(self, name):
+        parts = self._parts()
+        cumulative = 0
+        # LatencyHistogram's last bucket also holds everything larger: +Inf
+        for idx in xrange(self.buckets):
+            cumulative += sum(p.counts[idx] for p in parts)
+            yield name + '_bucket', (('le', _format_value(self.smallest * 2 ** idx)),), cumulative
+        count = sum(p.count for p in parts)
+        yield name + '_bucket', (('le', '+Inf'),), count
+        yield name + '_sum', (), sum(p.total for p in parts)
+        yield name + '_count', (), count
+
+
+class Metric(object):
+    '''A named metric: one child per set of label values
+
+    An unlabelled metric has one child, which its own inc(), set(),
+    observe() and value() update and read
+    '''
+    kind = ''
+    _child_class = None
+
+    def __init__(self, name, help, labels=(), **options):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        for option, value in options.items():
+            setattr(self, option, value)
+        self._children = OrderedDict()
+        self._lock = threading.Lock()
+        if not self.label_names:
+            self._only = self.labels()
+
+    def labels(self, *values):
+        '''The child for these label values, made on first use; bind it once
+        rather than looking it up on every update'''
+        values = tuple(str(v) for v in values)
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.label_names):
+                raise ValueError('{0} takes labels {1}, not {2}'.format(
+                    self.name, self.label_names, values))
+            with self._lock:
+                child = self._children.setdefault(values, self._child_class(self))
+        return child
+
+    def value(self):
+        return self._only.value()
+
+    def children(self):
+        '''[(label values, child)]'''
+        return self._children.items()
+
+    def exposition(self):
+        lines = ['# HELP {0} {1}'.format(self.name, self.help),
+                 '# TYPE {0} {1}'.format(self.name, self.kind)]
+        for values, child in self.children():
+            pairs = tuple(zip(self.label_names, values))
+            for name, extra, value in child.samples(self.name):
+                lines.append('{0}{1} {2}'.format(
+                    name, _format_labels(pairs + extra), _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    kind = 'counter'
+    _child_class = _CounterChild
+
+    def inc(self, amount=1):
+        self._only.inc(amount)
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+    _child_class = _GaugeChild
+
+    def set(self, value):
+        self._only.set(value)
+
+    def set_function(self, function):
+        self._only.set_function(function)
+
+
+class Histogram(Metric):
+    '''Buckets are LatencyHistogram's: powers of two from smallest up'''
+    kind = 'histogram'
+    _child_class = _HistogramChild
+
+    def observe(self, value):
+        self._only.observe(value)
+
+
+class Registry(object):
+    '''Every metric of a process, by name'''
+
+    def __init__(self):
+        self._metrics = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _register(self, cls, name, help, labels, **options):
+        '''The metric called name, made if new
+
+        Raises ValueError if name is already registered as something else
+        '''
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **options)
+            elif type(metric) is not cls or metric.label_names != tuple(labels):
+                raise ValueError('Metric {0} is already a {1} with labels {2}'.format(
+                    name, metric.kind, metric.label_names))
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._register(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._register(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), smallest=1e-6, buckets=24):
+        return self._register(Histogram, name, help, labels,
+                              smallest=smallest, buckets=buckets)
+
+    def get(self, name):
+        '''The metric called name; raises KeyError if there is none'''
+        return self._metrics[name]
+
+    def snapshot(self):
+        '''{name: {label values: value}}, for reading in-process; a
+        histogram's value is {'count', 'sum', 'mean', 'max'}'''
+        return {name: {values: child.value() for values, child in metric.children()}
+                for name, metric in self._metrics.items()}
+
+    def exposition(self):
+        '''Every metric in Prometheus text format'''
+        return '\n'.join(m.exposition() for m in self._metrics.values()) + '\n'
+
+
+# the process's metrics
+registry = Registry()
+
+registry.gauge('cookiebot_info', 'The machine these metrics come from',
+               ('machine',)).labels(platform.node()).set(1)
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.exposition()
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # a scrape every few seconds would drown out everything else
+        pass
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class MetricsServer(object):
+    '''Serves registry on http://host:port/metrics, on a background thread'''
+    logger = logging.getLogger('cookiebot.MetricsServer')
+
+    def __init__(self, registry=registry, port=DEFAULT_PORT, host='127.0.0.1'):
+        self._server = _Server((host, port), _Handler)
+        self._server.registry = registry
+        self.address = self._server.server_address
+
+        self._thread = threading.Thread(
+            target=self._server.serve_forever, name='metrics server')
+        self._thread.daemon = True
+        self._thread.start()
+        self.logger.info('Serving metrics on http://{0}:{1}/metrics'.format(*self.address))
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+
+def parse_address(text):
+    '''(host, port) from "port" or "host:port"; the host defaults to
+    127.0.0.1, so only this machine can scrape unless told otherwise'''
+    host, _, port = text.rpartition(':')
+    return host or '127.0.0.1', int(port)
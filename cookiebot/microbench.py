@@ -0,0 +1,300 @@
+'''
+Created on Oct 18, 2026
+
+Microbenchmarks of the control software's hot paths
+
+Every benchmark runs without hardware.  Results are seconds (lower is
+better) and are appended to a history file, .benchmarks/microbench.json by
+default, with the commit and machine they were measured on.  Each run is
+compared with the latest earlier result from the same machine; a benchmark
+that got slower by more than the threshold fails the run.
+
+    python -m cookiebot.microbench [--filter NAME] [--threshold 0.2]
+
+tests/microbench_test.py runs the same suite under the test runner when
+COOKIEBOT_BENCHMARK is set.
+'''
+import argparse
+import array
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import time
+import timeit
+
+from cookiebot import hardware
+from cookiebot.actuators import Actuator, StepperActuator
+from cookiebot.multithreading import RepeatedTimer
+from cookiebot.layout import load_layout
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage, MAIN_DIR
+
+HISTORY = os.path.join(MAIN_DIR, '.benchmarks', 'microbench.json')
+
+# a benchmark may be this much slower (as a fraction) before it fails
+THRESHOLD = 0.2
+
+# differences smaller than this (seconds) are noise, whatever the ratio
+NOISE = 1e-6
+
+# ...except for these benchmarks (by name prefix), which depend on the
+# scheduler and so on whatever else the machine is doing
+NOISE_FLOORS = {'timer lateness': 1e-3}
+
+
+def measure(fn, repeat=5, min_time=0.05):
+    '''Best seconds per call of fn(), timeit-style
+
+    Calls are batched so every repeat lasts at least min_time
+    '''
+    timer = timeit.Timer(fn)
+    number = 1
+    while True:
+        if timer.timeit(number) >= min_time:
+            break
+        number *= 4
+    return min(timer.repeat(repeat, number)) / number
+
+
+class Suite(object):
+    '''The benchmarks, with the stage and actuators they share
+
+    Each bench_* method returns {name: seconds}
+    '''
+
+    def __init__(self):
+        self.stage = IcingStage(zero=False)
+        self.large_stage = IcingStage(zero=False, layout=load_layout('6x4'))
+        # idle step threads would only add noise
+        for act in self.stage._axes() + self.large_stage._axes():
+            act.pause()
+        self.carriage = self.stage._wrappers[IcingStage.WrapperID.carriage]
+        self.actuator = StepperActuator(identity='Benchmark Stepper')
+        self.actuator.pause()
+        self.task = array.array('b', [1, -1, 0, 1]) * 2500
+
+    def close(self):
+        self.actuator.kill()
+        self.stage.shutdown()
+        self.large_stage.shutdown()
+
+    def names(self):
+        return sorted(n[len('bench_'):] for n in dir(self) if n.startswith('bench_'))
+
+    def run(self, name):
+        return getattr(self, 'bench_' + name)()
+
+    def bench_bresenham(self):
+        return {'bresenham 700x300': measure(
+            lambda: self.carriage.bresenham((0, 0), (700, 300)))}
+
+    def bench_carriage_send(self):
+        acts = self.carriage._wrapped_actuators.values()
+
+        def send():
+            self.carriage.send((5.0, 2.0))
+            # drop the task, so the next send is not refused as blocked
+            for act in acts:
+                act._task = act._task[:0]
+                act.state = Actuator.State.ready
+                act.step_pos = 0
+
+        return {'carriage send 5x2in': measure(send)}
+
+    def bench_execute_task(self):
+        act = self.actuator
+
+        def execute():
+            act._task = self.task
+            while act._task:
+                act._execute_task()
+
+        return {'execute 10k-step task': measure(execute, repeat=3)}
+
+    def bench_validate_task(self):
+        return {'validate 10k-step task': measure(
+            lambda: self.actuator._validate_task(self.task))}
+
+    def bench_patterns(self):
+        results = {}
+        for icing in Recipe.IcingType:
+            recipe, large = Recipe(), Recipe()
+            for pos in self.stage.layout.positions():
+                recipe.add_cookie({'icing': icing}, pos)
+            for pos in self.large_stage.layout.positions():
+                large.add_cookie({'icing': icing}, pos)
+
+            results['load pattern ' + icing.name] = measure(
+                lambda: self.stage._load_icing_file(icing.value))
+            # loads of a recipe seen before reuse its steps, so parsing is
+            # the cost of a new one and reloading that of a repeat
+            results['parse 2x2 recipe ' + icing.name] = measure(
+                lambda: self.stage._parse_recipe(recipe))
+            results['reload 2x2 recipe ' + icing.name] = measure(
+                lambda: self.stage.load_recipe(recipe))
+            results['parse 6x4 recipe ' + icing.name] = measure(
+                lambda: self.large_stage._parse_recipe(large))
+        self.stage.clear_recipe()
+        self.large_stage.clear_recipe()
+        return results
+
+    def bench_timer(self):
+        '''Mean and p99 wake-up lateness of a 2ms RepeatedTimer'''
+        timer = RepeatedTimer(0.002, lambda: None, name='benchmark')
+        time.sleep(1.0)
+        timer.stop()
+        lateness = timer.timing_stats()['lateness']
+        return {'timer lateness mean': lateness['mean'],
+                'timer lateness p99': lateness['p99']}
+
+    def bench_console(self):
+        '''Line assembly behind the GUI console's OutLog.write'''
+        try:
+            from gui.threadsafety import LineBuffer
+        except ImportError:
+            logging.info('Skipping the console benchmark: PyQt4 is not installed')
+            return {}
+
+        lines = ['INFO: 2026-10-18 12:00:00 - step {0} finished\n'.format(i)
+                 for i in xrange(10000)]
+
+        def write():
+            buf = LineBuffer()
+            for line in lines:
+                buf.write(line)
+            buf.take()
+
+        return {'console 10k lines': measure(write, repeat=3)}
+
+
+def commit():
+    '''The current git commit, or None'''
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=MAIN_DIR,
+            stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_history(path, history):
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as f:
+        json.dump(history, f, indent=1, sort_keys=True)
+
+
+def baseline(history, machine):
+    '''The latest entry of history measured on machine, or None'''
+    for entry in reversed(history):
+        if entry.get('machine') == machine:
+            return entry
+    return None
+
+
+def noise_floor(name):
+    for prefix, floor in NOISE_FLOORS.items():
+        if name.startswith(prefix):
+            return floor
+    return NOISE
+
+
+def compare(results, base, threshold=THRESHOLD):
+    '''[(name, before, after)] of every result more than threshold slower
+    than in base'''
+    slower = []
+    for name, after in sorted(results.items()):
+        before = base.get(name)
+        if before is None:
+            continue
+        if after - before > noise_floor(name) and after > before * (1 + threshold):
+            slower.append((name, before, after))
+    return slower
+
+
+def run_suite(name_filter=None):
+    '''{benchmark: seconds} for every benchmark whose group contains name_filter'''
+    # benchmarks must never move real motors
+    hardware.select('none')
+    logging.getLogger('cookiebot').setLevel(logging.WARNING)
+
+    suite = Suite()
+    results = {}
+    try:
+        for name in suite.names():
+            if name_filter and name_filter not in name:
+                continue
+            results.update(suite.run(name))
+    finally:
+        suite.close()
+    return results
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Time the hot paths of the control software and compare with earlier runs',
+        add_help=True, prog='cookiebot_microbench')
+
+    parser.add_argument(
+        '--filter', default=None,
+        help='Only run benchmark groups whose name contains this')
+
+    parser.add_argument(
+        '--history', default=HISTORY,
+        help='JSON file of earlier results; this run is appended to it')
+
+    parser.add_argument(
+        '--threshold', type=float, default=THRESHOLD,
+        help='Fail if a benchmark is this fraction slower than the last run on this machine')
+
+    parser.add_argument(
+        '--no-save', action='store_true',
+        help='Compare, but do not record this run')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+
+    args = opts().parse_args()
+
+    results = run_suite(args.filter)
+    for name, seconds in sorted(results.items()):
+        logging.info('{0:>32s} {1:12.3f}us'.format(name, seconds * 1e6))
+
+    history = load_history(args.history)
+    machine = platform.node()
+    base = baseline(history, machine)
+
+    slower = compare(results, base['results'], args.threshold) if base else []
+    if base is None:
+        logging.info('No earlier results from {0} to compare with'.format(machine))
+    for name, before, after in slower:
+        logging.error('{0} is {1:.0%} slower than at {2}: {3:.3f}us -> {4:.3f}us'.format(
+            name, after / before - 1, base.get('commit'), before * 1e6, after * 1e6))
+
+    if not args.no_save:
+        history.append({'commit': commit(), 'machine': machine,
+                        'time': time.time(), 'results': results})
+        save_history(args.history, history)
+
+    sys.exit(1 if slower else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,29 +3,446 @@ Created on Feb 27, 2016
 
 @author: justinpalpant
 '''
+import array
+import logging
+import math
+import os
+import select
 import time
-from threading import Event, Thread
+from threading import Event, Lock, Thread
+
+from cookiebot.tracing import tracer
+
+# the best clock available for measuring short intervals
+_clock = getattr(time, 'perf_counter', time.time)
+
+
+class LatencyHistogram(object):
+    '''Streaming histogram of durations, in constant memory
+
+    Bucket k holds values in (smallest * 2**(k-1), smallest * 2**k], so with
+    the defaults the buckets run from 1us to about 8s.  Percentiles are
+    reported as the upper edge of their bucket - never better than reality
+    '''
+
+    def __init__(self, smallest=1e-6, buckets=24):
+        self.smallest = smallest
+        self.counts = array.array('L', [0]) * (buckets + 1)
+        self.reset()
+
+    def reset(self):
+        for i in xrange(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value <= self.smallest:
+            idx = 0
+        else:
+            # frexp's exponent is a cheap ceil(log2(...)) for values > 1
+            idx = min(math.frexp(value / self.smallest)[1], len(self.counts) - 1)
+
+        self.counts[idx] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        '''Add every value counted by other, a histogram with the same
+        buckets'''
+        for i, c in enumerate(other.counts):
+            self.counts[i] += c
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        '''Upper bound on the given fraction (0 to 1) of all values'''
+        if not self.count:
+            return 0.0
+
+        needed = fraction * self.count
+        seen = 0
+        for idx, c in enumerate(self.counts):
+            seen += c
+            if seen >= needed:
+                return min(self.smallest * 2 ** idx, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {'count': self.count,
+                'mean': self.mean,
+                'p50': self.percentile(0.50),
+                'p99': self.percentile(0.99),
+                'max': self.max}
+
+
+class DeadlineWatchdog(object):
+    '''Watches how late a RepeatedTimer fires, in units of its interval
+
+    Lateness above warn is logged (at most once per second, with a count of
+    the late wake-ups since the last message).  Lateness above fault calls
+    on_fault(lateness) from the timer thread.  Either threshold can be None
+    to turn that check off
+    '''
+    logger = logging.getLogger('cookiebot.DeadlineWatchdog')
+
+    def __init__(self, warn=1.0, fault=None, on_fault=None, name=''):
+        self.warn = warn
+        self.fault = fault
+        self.on_fault = on_fault
+        self.name = name
+
+        self.warnings = 0
+        self.faults = 0
+        self._unreported = 0
+        self._last_report = 0.0
+
+    def check(self, lateness, interval):
+        late = lateness / interval
+
+        if self.fault is not None and late > self.fault:
+            self.faults += 1
+            self.logger.error('{0} woke up {1:.2f}ms late, more than {2} intervals'.format(
+                self.name, lateness * 1e3, self.fault))
+            if self.on_fault is not None:
+                self.on_fault(lateness)
+
+        elif self.warn is not None and late > self.warn:
+            self.warnings += 1
+            self._unreported += 1
+            now = time.time()
+            if now - self._last_report > 1.0:
+                self.logger.warning('{0} woke up late {1} time(s), latest by {2:.2f}ms'.format(
+                    self.name, self._unreported, lateness * 1e3))
+                self._unreported = 0
+                self._last_report = now
+
+
+class FutureTimeout(Exception):
+    '''Raised by TaskFuture.result() and exception() when a wait times out'''
+    pass
+
+
+class TaskFuture(object):
+    '''Handle on the outcome of an actuator task, or of several at once
+
+    Resolves exactly once, with a result or an exception.  Callbacks run in
+    whichever thread resolves the future - usually an actuator's step
+    thread - so they must be quick and must never stop or join that
+    actuator (ActuatorWrapper.send does both); hand the work to another
+    thread instead, e.g. with RepeatedTimer.trigger
+    '''
+    logger = logging.getLogger('cookiebot.TaskFuture')
+
+    def __init__(self):
+        self._lock = Lock()
+        self._event = Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    @classmethod
+    def completed(cls, result=None):
+        '''A future that is already resolved with result'''
+        future = cls()
+        future.set_result(result)
+        return future
+
+    @classmethod
+    def gather(cls, futures):
+        '''A future that resolves to the list of results of every one of
+        futures, or fails as soon as any of them fails'''
+        futures = list(futures)
+        combined = cls()
+        if not futures:
+            combined.set_result([])
+            return combined
+
+        remaining = [len(futures)]
+        lock = Lock()
+
+        def one_done(future):
+            exc = future.exception()
+            if exc is not None:
+                combined.set_exception(exc)
+                return
+            with lock:
+                remaining[0] -= 1
+                last = not remaining[0]
+            if last:
+                combined.set_result([f.result() for f in futures])
+
+        for f in futures:
+            f.add_done_callback(one_done)
+        return combined
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        '''Block until resolved; False if timeout (seconds) ran out first'''
+        return self._event.wait(timeout)
+
+    def result(self, timeout=None):
+        '''The result, or raise the exception the future failed with'''
+        if not self._event.wait(timeout):
+            raise FutureTimeout('Task did not finish within {0}s'.format(timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise FutureTimeout('Task did not finish within {0}s'.format(timeout))
+        return self._exception
+
+    def add_done_callback(self, fn):
+        '''Call fn(future) once resolved - immediately if it already is'''
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        self._call(fn)
+
+    def set_result(self, result):
+        '''Resolve with result; returns False if already resolved'''
+        return self._resolve(result, None)
+
+    def set_exception(self, exception):
+        return self._resolve(None, exception)
+
+    def _resolve(self, result, exception):
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self._result = result
+            self._exception = exception
+            callbacks, self._callbacks = self._callbacks, []
+            self._event.set()
+
+        for fn in callbacks:
+            self._call(fn)
+        return True
+
+    def _call(self, fn):
+        try:
+            fn(self)
+        except Exception:
+            self.logger.exception('TaskFuture callback {0} failed'.format(fn))
+
+    def to_asyncio(self, loop=None):
+        '''An asyncio future that follows this one (needs Python 3)'''
+        import asyncio  # @UnresolvedImport
+
+        loop = loop or asyncio.get_event_loop()
+        mirror = loop.create_future()
+
+        def copy(future):
+            if mirror.cancelled():
+                return
+            if future._exception is not None:
+                mirror.set_exception(future._exception)
+            else:
+                mirror.set_result(future._result)
+
+        self.add_done_callback(lambda f: loop.call_soon_threadsafe(copy, f))
+        return mirror
+
+    def __await__(self):
+        return self.to_asyncio().__await__()
+
 
 class RepeatedTimer(object):
     """Repeat `function` every `interval` seconds.
 
     Class courtesy of Six on StackOverflow
     See http://stackoverflow.com/a/33054922/5370002 for more
+
+    Every wake-up is measured: `lateness` holds how far past its deadline the
+    timer woke, `intervals` the actual time between calls, and `missed` counts
+    deadlines skipped entirely because a wake-up was more than one interval
+    late.  See timing_stats().  An optional DeadlineWatchdog is checked on
+    every wake-up.
+
+    With precision=True the timer sleeps until `spin` seconds before each
+    deadline and then spins on the clock, which gets far closer to the
+    deadline than Event.wait alone.  Spinning only happens while spin_when()
+    (if given) returns True, so an idle actuator costs no CPU.  If a wake-up
+    is late by whole intervals, up to max_batch calls are made back to back
+    to catch up instead of silently dropping them.
+
+    With wakeable=True, trigger() makes the timer call function straight
+    away instead of at its next tick (not in precision mode).  The timer
+    then sleeps in select() on a pipe, since Event.wait with a timeout polls
+    on Python 2 and would add up to 50ms to every trigger; close() releases
+    the pipe once the timer is done with for good.
     """
 
-    def __init__(self, interval, function, start=True, *args, **kwargs):
+    def __init__(self, interval, function, start=True, name='', watchdog=None,
+                 precision=False, spin=0.002, spin_when=None, max_batch=4,
+                 wakeable=False, *args, **kwargs):
         self.interval = interval
         self.function = function
+        self.name = name
+        self.watchdog = watchdog
+        self.precision = precision
+        self.spin = spin
+        self.spin_when = spin_when
+        self.max_batch = max_batch
         self.args = args
         self.kwargs = kwargs
         self.start = time.time()
         self.running = False
+        self.triggers = 0
+        self._closed = False
+        self._wake_r, self._wake_w = os.pipe() if wakeable else (None, None)
+        # guards the wake-up pipe, and restart() against close()
+        self._wake_lock = Lock()
+
+        self.lateness = LatencyHistogram()
+        self.intervals = LatencyHistogram()
+        self.missed = 0
+        self.calls = 0
+        self._calls_since = time.time()
+
         if start:
             self.restart()
 
     def _target(self):
-        while not self.event.wait(self._time):
+        if self.precision:
+            self._target_precise()
+            return
+
+        last = time.time()
+        while True:
+            start = time.time()
+            wait = self._time
+            stopped = self._wait(wait)
+            woke = time.time()
+
+            if tracer.enabled:
+                tracer.complete('wait', 'timer', self.name, start, woke)
+
+            if stopped:
+                break
+
+            lateness = woke - start - wait
+            if lateness < 0:
+                # woken early by trigger(), so there is no deadline to score
+                self.triggers += 1
+            else:
+                if lateness > self.interval:
+                    self.missed += int(lateness / self.interval)
+                self._record(lateness, woke - last)
+                last = woke
+
             self.function(*self.args, **self.kwargs)
+            self.calls += 1
+
+    def _target_precise(self):
+        '''Hybrid sleep/spin loop used when precision is True'''
+        last = now = _clock()
+        deadline = now + self.interval
+
+        while True:
+            wait_start = time.time()
+            remaining = deadline - now
+            spinning = self.spin_when is None or self.spin_when()
+            sleep_for = remaining - self.spin if spinning else remaining
+
+            # coarse sleep; the spin below absorbs Event.wait's slop
+            if sleep_for > 0 and self.event.wait(sleep_for):
+                break
+
+            now = _clock()
+            while now < deadline:
+                if self.event.is_set():
+                    break
+                time.sleep(0)  # lets other threads have the GIL
+                now = _clock()
+
+            if tracer.enabled:
+                tracer.complete('wait', 'timer', self.name, wait_start, time.time())
+
+            if self.event.is_set():
+                break
+
+            lateness = now - deadline
+            due = int(lateness / self.interval) + 1
+            batch = min(due, self.max_batch)
+            self.missed += due - batch
+            self._record(lateness, now - last)
+            last = now
+
+            for _ in xrange(batch):
+                self.function(*self.args, **self.kwargs)
+            self.calls += batch
+
+            # keep to the original grid, whatever was skipped
+            deadline += due * self.interval
+            now = _clock()
+
+    def _wait(self, timeout):
+        '''Sleep for timeout, or until stop() or trigger(); True if stopped'''
+        if self._wake_r is None:
+            return self.event.wait(timeout)
+
+        readable, _, _ = select.select([self._wake_r], [], [], timeout)
+        if readable:
+            os.read(self._wake_r, 4096)
+        return self.event.is_set()
+
+    def trigger(self):
+        '''Call function as soon as possible (wakeable timers only)
+
+        Safe to call from any thread, including a TaskFuture callback
+        '''
+        with self._wake_lock:
+            if self._wake_w is not None and self.running:
+                os.write(self._wake_w, b'!')
+
+    def _record(self, lateness, interval):
+        self.lateness.add(lateness)
+        self.intervals.add(interval)
+        if self.watchdog is not None:
+            self.watchdog.check(lateness, self.interval)
+
+    def achieved_rate(self):
+        '''Calls per second since the timer was made or reset_stats(), paused
+        time included'''
+        elapsed = time.time() - self._calls_since
+        return self.calls / elapsed if elapsed > 0 else 0.0
+
+    def timing_stats(self):
+        '''Summary of how accurately this timer has been firing'''
+        stats = {'name': self.name,
+                 'interval': self.interval,
+                 'precision': self.precision,
+                 'missed': self.missed,
+                 'calls': self.calls,
+                 'rate': self.achieved_rate(),
+                 'target_rate': 1.0 / self.interval,
+                 'lateness': self.lateness.snapshot(),
+                 'intervals': self.intervals.snapshot()}
+        if self.watchdog is not None:
+            stats['warnings'] = self.watchdog.warnings
+            stats['faults'] = self.watchdog.faults
+        return stats
+
+    def reset_stats(self):
+        self.lateness.reset()
+        self.intervals.reset()
+        self.missed = 0
+        self.calls = 0
+        self._calls_since = time.time()
 
     @property
     def _time(self):
@@ -34,15 +451,46 @@ class RepeatedTimer(object):
     def stop(self):
         if self.running:
             self.event.set()
+            if self._wake_w is not None:
+                os.write(self._wake_w, b'!')
             self.my_thread.join()
             self.running = False
 
+    def close(self):
+        '''Stop for good and close the wake-up pipe; restart() does nothing
+        after this'''
+        with self._wake_lock:
+            self._closed = True
+        self.stop()
+        with self._wake_lock:
+            for fd in (self._wake_r, self._wake_w):
+                if fd is not None:
+                    os.close(fd)
+            self._wake_r = self._wake_w = None
+
     def restart(self):
-        if not self.running:
-            self.event = Event()
-            self.my_thread = Thread(target=self._target)
-            self.my_thread.start()
-            self.running = True
+        with self._wake_lock:
+            if not self.running and not self._closed:
+                self.event = Event()
+                self.my_thread = Thread(target=self._target, name=self.name or None)
+                # calls, like the histograms, run on across pauses until reset_stats()
+                self.my_thread.start()
+                self.running = True
+
+
+def format_timing_stats(stats):
+    '''Render a list of timing_stats() dictionaries as a text table'''
+    lines = ['{0:<20s} {1:>9s} {2:>9s} {3:>9s} {4:>9s} {5:>7s} {6:>9s}'.format(
+        'timer', 'period ms', 'late p50', 'late p99', 'late max', 'missed',
+        'rate Hz')]
+
+    for s in stats:
+        late = s['lateness']
+        lines.append('{0:<20s} {1:9.2f} {2:9.2f} {3:9.2f} {4:9.2f} {5:7d} {6:9.1f}'.format(
+            s['name'][:20], s['interval'] * 1e3, late['p50'] * 1e3,
+            late['p99'] * 1e3, late['max'] * 1e3, s['missed'], s['rate']))
+
+    return '\n'.join(lines)
 
 
 def demo():
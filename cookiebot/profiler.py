@@ -0,0 +1,300 @@
+'''
+Created on Oct 18, 2026
+
+On-demand sampling profiler and all-thread stack dumps, safe to trigger
+while a recipe runs
+
+A SamplingProfiler thread wakes every interval, takes the stack of every
+other thread from sys._current_frames() and counts it.  Nothing is hooked
+into the profiled code, so the actuator timers, the recipe timer and the
+GUI run exactly as they do without it; the cost is one stack walk per
+thread per sample, on the profiler's own thread.
+
+Each stack is rooted at its thread's name and tagged with what the machine
+was doing when it was taken: the cookie being iced and, on an actuator's
+step thread, that actuator's state.  Profiles are written as collapsed
+stacks (one "frame;frame;... count" line each, for flamegraph.pl and
+friends) and as speedscope JSON (https://www.speedscope.app).
+
+Start one by sending SIGUSR1 to the process once install() has run (the
+stage CLI and the GUI do), or over the control protocol:
+
+    kill -USR1 <pid>
+    python -m cookiebot.control profile 10
+    python -m cookiebot.control stacks
+
+Either way an all-thread stack dump is written at once, and the profile
+when it finishes, to profiles/ in the repository.  Actuators isolated in
+their own processes are seen only through their proxies' threads.
+'''
+import collections
+import json
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+import traceback
+
+PROFILE_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'profiles')
+
+DURATION = 10.0
+INTERVAL = 0.01
+
+# longer profiles are cut short, so a typo cannot profile all shift
+MAX_DURATION = 300.0
+
+logger = logging.getLogger('cookiebot.profiler')
+
+
+def _frame_name(code):
+    return '{0} ({1})'.format(code.co_name, os.path.basename(code.co_filename))
+
+
+def _thread_names():
+    return {t.ident: t.name for t in threading.enumerate()}
+
+
+class SamplingProfiler(object):
+    '''Counts the stacks of every thread, sampled every interval seconds
+
+    context, if given, is called once per sample and returns a function
+    from thread name to a list of tags, inserted between the thread name
+    and the stack
+    '''
+
+    def __init__(self, interval=INTERVAL, context=None):
+        self.interval = interval
+        self.context = context
+        self.counts = collections.Counter()
+        self.samples = 0
+        self.elapsed = 0.0
+
+    def sample(self):
+        '''Count the current stack of every thread but this one'''
+        me = threading.current_thread().ident
+        names = _thread_names()
+        tags = self.context() if self.context is not None else None
+
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                stack.append(_frame_name(frame.f_code))
+                frame = frame.f_back
+            stack.reverse()
+
+            name = names.get(ident, 'thread {0}'.format(ident))
+            prefix = [name] + (tags(name) if tags is not None else [])
+            self.counts[tuple(prefix + stack)] += 1
+        self.samples += 1
+
+    def run(self, duration, stop=None):
+        '''Sample for duration seconds, or until the stop Event is set'''
+        stop = stop or threading.Event()
+        start = time.time()
+        end = start + duration
+        while True:
+            self.sample()
+            wait = min(self.interval, end - time.time())
+            if wait <= 0 or stop.wait(wait):
+                break
+        self.elapsed += time.time() - start
+
+    def collapsed(self):
+        '''Lines of "frame;frame;... count", most frequent first'''
+        return ['{0} {1}'.format(';'.join(stack), count)
+                for stack, count in self.counts.most_common()]
+
+    def speedscope(self, name='cookiebot'):
+        '''A speedscope file: one sampled profile per thread, weighted in
+        seconds'''
+        frames, index = [], {}
+        profiles = collections.OrderedDict()
+        for stack, count in sorted(self.counts.items()):
+            ids = []
+            for frame in stack:
+                if frame not in index:
+                    index[frame] = len(frames)
+                    frames.append({'name': frame})
+                ids.append(index[frame])
+
+            profile = profiles.setdefault(stack[0], {
+                'type': 'sampled', 'name': stack[0], 'unit': 'seconds',
+                'startValue': 0.0, 'endValue': 0.0, 'samples': [], 'weights': []})
+            profile['samples'].append(ids)
+            profile['weights'].append(count * self.interval)
+            profile['endValue'] += count * self.interval
+
+        return {'$schema': 'https://www.speedscope.app/file-format-schema.json',
+                'name': name, 'exporter': 'cookiebot.profiler',
+                'shared': {'frames': frames}, 'profiles': profiles.values()}
+
+    def write(self, path):
+        '''Save as speedscope JSON if path ends in .json, collapsed stacks
+        otherwise'''
+        with open(path, 'w') as f:
+            if path.endswith('.json'):
+                json.dump(self.speedscope(os.path.basename(path)), f)
+            else:
+                for line in self.collapsed():
+                    f.write(line + '\n')
+
+
+def dump_stacks():
+    '''The current stack of every thread, as text'''
+    names = _thread_names()
+    lines = []
+    for ident, frame in sorted(sys._current_frames().items()):
+        lines.append('Thread {0} ({1}):\n'.format(names.get(ident, '?'), ident))
+        lines.extend(traceback.format_stack(frame))
+        lines.append('\n')
+    return ''.join(lines)
+
+
+def stage_context(stage):
+    '''A SamplingProfiler context tagging stacks with stage's current cookie
+    and, on an actuator's step thread, the actuator's state'''
+    def context():
+        cookie = stage.active_cookie
+        if not stage._recipe_active:
+            step = 'no recipe'
+        elif cookie is None:
+            step = 'between cookies'
+        else:
+            step = 'cookie {0}'.format(cookie)
+        states = {a.identity: a.state.name for a in stage._axes()}
+
+        def tags(thread):
+            state = states.get(thread)
+            return [step] if state is None else [step, state]
+        return tags
+    return context
+
+
+class OnDemandProfiler(object):
+    '''Runs one profile at a time, in the background, when asked
+
+    Profiles, and the stack dump taken as each starts, are written to
+    directory
+    '''
+
+    def __init__(self, directory=PROFILE_DIR, interval=INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        self.context = None
+
+        self._lock = threading.Lock()
+        self._running = None
+        self._stop = threading.Event()
+        self._requested = threading.Event()
+        self._watcher = None
+
+    def running(self):
+        return self._running is not None
+
+    def _path(self, kind, suffix):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        stamp = time.strftime('%Y%m%d-%H%M%S')
+        return os.path.join(self.directory, '{0}-{1}-{2}{3}'.format(
+            kind, stamp, os.getpid(), suffix))
+
+    def write_stacks(self):
+        '''Write an all-thread stack dump now; returns its path'''
+        path = self._path('stacks', '.txt')
+        with open(path, 'w') as f:
+            f.write(dump_stacks())
+        logger.info('Wrote a stack dump of every thread to {0}'.format(path))
+        return path
+
+    def start(self, duration=DURATION):
+        '''Dump every thread's stack and start a profile of duration seconds
+
+        Returns the paths the collapsed stacks and speedscope file will be
+        written to, or None if a profile is already running
+        '''
+        duration = min(float(duration), MAX_DURATION)
+        if duration <= 0:
+            raise ValueError('Profile duration must be positive, not {0}'.format(duration))
+
+        with self._lock:
+            if self._running is not None:
+                return None
+            base = self._path('profile', '')
+            paths = (base + '.collapsed', base + '.speedscope.json')
+            self._stop.clear()
+            self._running = threading.Thread(
+                target=self._profile, args=(duration, paths), name='profiler')
+            self._running.daemon = True
+
+        try:
+            self.write_stacks()
+        except (IOError, OSError):
+            self._running = None
+            raise
+        self._running.start()
+        return paths
+
+    def stop(self):
+        '''Cut a running profile short (it is still written)'''
+        self._stop.set()
+        thread = self._running
+        if thread is not None:
+            thread.join()
+
+    def _profile(self, duration, paths):
+        profiler = SamplingProfiler(self.interval, self.context)
+        logger.info('Profiling every thread for {0:.1f}s'.format(duration))
+        try:
+            profiler.run(duration, self._stop)
+            for path in paths:
+                profiler.write(path)
+            logger.info('Profiled {0} samples over {1:.1f}s to {2}'.format(
+                profiler.samples, profiler.elapsed, ', '.join(paths)))
+        except Exception:
+            logger.exception('Profile failed')
+        finally:
+            with self._lock:
+                self._running = None
+
+    def install_signal(self, signum=signal.SIGUSR1, duration=DURATION):
+        '''Start a profile of duration seconds whenever signum arrives
+
+        Must be called from the main thread.  The handler only sets an
+        Event: a watcher thread does the rest, so a signal arriving in the
+        middle of logging or a lock cannot deadlock the main thread
+        '''
+        if self._watcher is None:
+            self._watcher = threading.Thread(
+                target=self._watch, args=(duration,), name='profile trigger')
+            self._watcher.daemon = True
+            self._watcher.start()
+        signal.signal(signum, lambda *_: self._requested.set())
+
+    def _watch(self, duration):
+        while True:
+            # a timeout keeps the wait interruptible on Python 2
+            if not self._requested.wait(1.0):
+                continue
+            self._requested.clear()
+            try:
+                if self.start(duration) is None:
+                    logger.warning('A profile is already running; ignoring the signal')
+            except (IOError, OSError) as e:
+                logger.error('Cannot start a profile: {0}'.format(e))
+
+
+# the process's profiler, shared by the signal handler and control commands
+on_demand = OnDemandProfiler()
+
+
+def install(stage=None, signum=getattr(signal, 'SIGUSR1', None)):
+    '''Tag profiles with stage's progress, and profile on signum'''
+    if stage is not None:
+        on_demand.context = stage_context(stage)
+    if signum is not None:
+        on_demand.install_signal(signum)
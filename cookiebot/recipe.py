@@ -3,9 +3,25 @@ Created on Jan 18, 2016
 
 @author: justinpalpant
 '''
+import hashlib
+import json
+import os
+import struct
 
 import enum
 
+DATA_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.realpath(__file__))), 'data')
+
+# bumped whenever the serialized form changes; older versions are refused
+FORMAT_VERSION = 1
+
+# binary form: magic, version, cookie count, then per cookie column, row,
+# length of the icing name and the name itself
+_MAGIC = 'CBR'
+_HEADER = struct.Struct('<3sBH')
+_COOKIE = struct.Struct('<hhB')
+
 class RecipeError(Exception):
     pass
 
@@ -47,6 +63,20 @@ class Recipe(object):
     def __init__(self):
         self.cookies = {}
 
+    def __eq__(self, other):
+        return isinstance(other, Recipe) and self.cookies == other.cookies
+
+    def __ne__(self, other):
+        return not self == other
+
+    # nested enums do not pickle, so recipes travel between processes in
+    # their binary form
+    def __getstate__(self):
+        return self.to_bytes()
+
+    def __setstate__(self, state):
+        self.cookies = Recipe.from_bytes(state).cookies
+
     def add_cookie(self, cookiespec, pos=(0, 0)):
         '''Adds cookie to this recipe's cookie dictionary
 
@@ -62,3 +92,125 @@ class Recipe(object):
         '''
 
         self.cookies[pos] = cookiespec
+
+    def _entries(self):
+        '''(column, row, icing name) of every cookie, in position order'''
+        entries = []
+        for pos, spec in sorted(self.cookies.items()):
+            if set(spec) != set(['icing']):
+                raise RecipeError('Cannot serialize cookie {0}: only icing is supported, not {1}'.format(
+                    pos, ', '.join(sorted(spec))))
+            entries.append((pos[0], pos[1], spec['icing'].name))
+        return entries
+
+    @classmethod
+    def _from_entries(cls, entries):
+        recipe = cls()
+        for column, row, name in entries:
+            try:
+                icing = Recipe.IcingType[name]
+            except KeyError:
+                raise RecipeError('Unknown icing {0}'.format(name))
+            recipe.add_cookie({'icing': icing}, (column, row))
+        return recipe
+
+    def to_dict(self):
+        '''A JSON-ready dictionary of this recipe'''
+        return {'version': FORMAT_VERSION,
+                'cookies': [list(entry) for entry in self._entries()]}
+
+    @classmethod
+    def from_dict(cls, data):
+        '''The recipe of a to_dict() dictionary
+
+        Raises RecipeError for another format version or a malformed one
+        '''
+        try:
+            version = data['version']
+            entries = [(int(c), int(r), str(name)) for c, r, name in data['cookies']]
+        except (KeyError, TypeError, ValueError) as e:
+            raise RecipeError('Not a serialized recipe: {0}'.format(e))
+        if version != FORMAT_VERSION:
+            raise RecipeError('Recipe format version {0} is not supported (expected {1})'.format(
+                version, FORMAT_VERSION))
+        return cls._from_entries(entries)
+
+    def to_json(self):
+        '''Canonical JSON: the same recipe always gives the same text'''
+        return json.dumps(self.to_dict(), sort_keys=True, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        try:
+            data = json.loads(text)
+        except ValueError as e:
+            raise RecipeError('Not a serialized recipe: {0}'.format(e))
+        return cls.from_dict(data)
+
+    def to_bytes(self):
+        '''The compact binary form'''
+        entries = self._entries()
+        parts = [_HEADER.pack(_MAGIC, FORMAT_VERSION, len(entries))]
+        for column, row, name in entries:
+            parts.append(_COOKIE.pack(column, row, len(name)))
+            parts.append(name)
+        return ''.join(parts)
+
+    @classmethod
+    def from_bytes(cls, data):
+        '''The recipe of to_bytes() output
+
+        Raises RecipeError for another format version or a malformed one
+        '''
+        try:
+            magic, version, count = _HEADER.unpack_from(data)
+            if magic != _MAGIC:
+                raise RecipeError('Not a serialized recipe')
+            if version != FORMAT_VERSION:
+                raise RecipeError('Recipe format version {0} is not supported (expected {1})'.format(
+                    version, FORMAT_VERSION))
+
+            offset = _HEADER.size
+            entries = []
+            for _ in xrange(count):
+                column, row, length = _COOKIE.unpack_from(data, offset)
+                offset += _COOKIE.size
+                name = data[offset:offset + length]
+                if len(name) != length:
+                    raise RecipeError('Serialized recipe is truncated')
+                offset += length
+                entries.append((column, row, name))
+        except struct.error as e:
+            raise RecipeError('Serialized recipe is truncated: {0}'.format(e))
+        return cls._from_entries(entries)
+
+    def content_hash(self):
+        '''SHA-1 hex digest of this recipe and the contents of the pattern
+        files it uses
+
+        Equal recipes hash equally in any process, and editing a pattern
+        file changes the hash of every recipe that uses it
+        '''
+        digest = hashlib.sha1(self.to_bytes())
+        for filename in sorted(set(spec['icing'].value for spec in self.cookies.values())):
+            digest.update(filename)
+            digest.update(pattern_digest(filename))
+        return digest.hexdigest()
+
+
+_pattern_digests = {}
+
+
+def pattern_digest(filename):
+    '''SHA-1 digest of a pattern file (relative to DATA_DIR), cached until
+    the file changes'''
+    path = os.path.join(DATA_DIR, filename)
+    stat = os.stat(path)
+    key = (stat.st_mtime, stat.st_size)
+
+    cached = _pattern_digests.get(path)
+    if cached is None or cached[0] != key:
+        with open(path, 'rb') as f:
+            cached = (key, hashlib.sha1(f.read()).digest())
+        _pattern_digests[path] = cached
+    return cached[1]
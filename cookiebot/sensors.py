@@ -2,16 +2,307 @@
 Created on Jan 18, 2016
 
 @author: justinpalpant
+
+Sensors sampled in the background, so nothing on a step path does I/O
+
+A Sensor keeps its recent readings in a preallocated RingBuffer and its
+latest one in a single attribute, so value and active are O(1) reads that
+never touch the hardware.  Readings come from a SensorSampler thread, at a
+fixed rate per sensor, or - for DigitalSensors that watch() their pin - from
+GPIO edge interrupts as they happen.
+
+FakeGPIO implements the parts of RPi.GPIO used here, for tests and
+simulation; set_input() changes a pin and fires its edge callbacks.
+SimulatedEndStop is a switch for actuators that drive no hardware.
 '''
+import array
+import logging
+import threading
+import time
+
+from cookiebot.multithreading import RepeatedTimer
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class RingBuffer(object):
+    '''The last capacity (time, value) readings, in preallocated arrays
+
+    One thread appends; any thread may read.  latest() is lock-free
+    '''
+
+    def __init__(self, capacity=1024, typecode='d'):
+        self.capacity = capacity
+        self._times = array.array('d', [0.0]) * capacity
+        self._values = array.array(typecode, [0]) * capacity
+        self._next = 0
+        self._count = 0
+        self._lock = threading.Lock()
+        # replaced whole, so readers never see half an update
+        self._latest = None
+
+    def __len__(self):
+        return self._count
+
+    def append(self, t, value):
+        with self._lock:
+            self._times[self._next] = t
+            self._values[self._next] = value
+            self._next = (self._next + 1) % self.capacity
+            self._count = min(self._count + 1, self.capacity)
+        self._latest = (t, value)
+
+    def latest(self):
+        '''(time, value) of the newest reading, or None'''
+        return self._latest
+
+    def snapshot(self):
+        '''(times, values) arrays of every reading held, oldest first'''
+        with self._lock:
+            start = (self._next - self._count) % self.capacity
+            if start + self._count <= self.capacity:
+                end = start + self._count
+                return self._times[start:end], self._values[start:end]
+            return (self._times[start:] + self._times[:self._next],
+                    self._values[start:] + self._values[:self._next])
+
+    def as_numpy(self):
+        '''snapshot() as numpy arrays, sharing nothing with the buffer'''
+        if numpy is None:
+            raise ImportError('as_numpy needs numpy')
+        times, values = self.snapshot()
+        return (numpy.frombuffer(times, dtype=numpy.float64),
+                numpy.frombuffer(values, dtype=numpy.dtype(values.typecode)))
+
 
 class Sensor(object):
     '''
-    classdocs
+    Something that can be read: a name, a read() and a history
+
+    Subclasses implement read(), or a plain function is passed as read
+    '''
+    logger = logging.getLogger('cookiebot.Sensor')
+
+    def __init__(self, name='', read=None, history=1024, typecode='d'):
+        self.name = name
+        self.buffer = RingBuffer(history, typecode)
+        if read is not None:
+            self.read = read
+
+    def __str__(self):
+        return self.name
+
+    def read(self):
+        raise NotImplementedError
+
+    def sample(self):
+        '''Read the sensor now and record the reading'''
+        value = self.read()
+        self.buffer.append(time.time(), value)
+        return value
+
+    @property
+    def value(self):
+        '''The latest recorded reading, or None before the first'''
+        latest = self.buffer.latest()
+        return latest[1] if latest is not None else None
+
+    @property
+    def updated(self):
+        '''time.time() of the latest recorded reading, or None'''
+        latest = self.buffer.latest()
+        return latest[0] if latest is not None else None
+
+
+class DigitalSensor(Sensor):
+    '''A GPIO input such as an end-stop switch
+
+    active is True when the pin is at its active level - low by default,
+    for a switch to ground with the pull-up enabled.  watch() records every
+    edge as it happens and calls any listeners, in the GPIO library's
+    callback thread
     '''
 
+    def __init__(self, name, pin, gpio, active_low=True, history=256):
+        super(DigitalSensor, self).__init__(name, history=history, typecode='b')
+        self.pin = pin
+        self.gpio = gpio
+        self.active_level = gpio.LOW if active_low else gpio.HIGH
+        self._listeners = []
+
+        gpio.setup(pin, gpio.IN,
+                   pull_up_down=gpio.PUD_UP if active_low else gpio.PUD_DOWN)
+
+    def read(self):
+        return self.gpio.input(self.pin)
+
+    @property
+    def active(self):
+        '''Whether the latest reading is at the active level (False before
+        any reading)'''
+        latest = self.buffer.latest()
+        return latest is not None and latest[1] == self.active_level
+
+    def watch(self, listener=None, bouncetime=None):
+        '''Record edges as interrupts arrive; listener(sensor, active) is
+        called on every edge'''
+        if listener is not None:
+            self._listeners.append(listener)
+
+        kwargs = {'callback': self._edge}
+        if bouncetime is not None:
+            kwargs['bouncetime'] = bouncetime
+        self.gpio.add_event_detect(self.pin, self.gpio.BOTH, **kwargs)
+        # the level before the first edge
+        self.sample()
+
+    def unwatch(self):
+        self.gpio.remove_event_detect(self.pin)
+        self._listeners = []
+
+    def _edge(self, pin):
+        self.sample()
+        active = self.active
+        for listener in self._listeners:
+            try:
+                listener(self, active)
+            except Exception:
+                self.logger.exception('Edge listener of {0} failed'.format(self))
+
+
+class SensorSampler(object):
+    '''Samples registered sensors at their own rates, on one thread
+
+    The thread ticks at the fastest registered rate and samples every sensor
+    that is due.  A sensor that fails to read is logged and skipped, and
+    keeps its last good value
+    '''
+    logger = logging.getLogger('cookiebot.SensorSampler')
+
+    def __init__(self, name='sensors'):
+        self.name = name
+        self.sensors = []
+        self._lock = threading.Lock()
+        self._interval = None
+        self._timer = None
+
+    def add(self, sensor, rate):
+        '''Sample sensor rate times a second, starting now'''
+        with self._lock:
+            self.sensors.append([sensor, 1.0 / rate, 0.0])
+            self._interval = min(period for _, period, _ in self.sensors)
+
+        sensor.sample()
+        if self._timer is None:
+            self._timer = RepeatedTimer(self._interval, self._sample_due, name=self.name)
+        else:
+            self._timer.interval = self._interval
+
+    def remove(self, sensor):
+        '''Stop sampling sensor; the tick slows to the fastest sensor left,
+        and stops with the last one'''
+        with self._lock:
+            self.sensors = [s for s in self.sensors if s[0] is not sensor]
+            interval = self._interval = min([period for _, period, _ in self.sensors] or [None])
+            timer = self._timer
+            if interval is None:
+                self._timer = None
+
+        if timer is None:
+            return
+        if interval is None:
+            timer.stop()
+        else:
+            timer.interval = interval
+
+    def stop(self):
+        if self._timer is not None:
+            self._timer.stop()
+
+    def _sample_due(self):
+        now = time.time()
+        with self._lock:
+            due = [s for s in self.sensors if now >= s[2]]
+            for s in due:
+                # half a tick early counts as due, so rates that are a
+                # multiple of the tick never slip by one
+                s[2] = now + s[1] - self._interval / 2.0
+
+        for sensor, _, _ in due:
+            try:
+                sensor.sample()
+            except Exception as e:
+                self.logger.error('Reading {0} failed: {1}'.format(sensor, e))
+
+
+class SimulatedEndStop(object):
+    '''An end stop that is active once actuator is at or below position steps
+
+    For homing simulated stages, where an actuator's step_pos is where it
+    really is
+    '''
+
+    def __init__(self, actuator, position=0):
+        self.actuator = actuator
+        self.position = position
+
+    @property
+    def active(self):
+        return self.actuator.step_pos <= self.position
+
+
+class FakeGPIO(object):
+    '''The RPi.GPIO calls used by DigitalSensor, on simulated pins
+
+    Inputs start HIGH (pulled up).  reads counts input() calls, so tests
+    can check that a code path does no I/O
+    '''
+    BOARD = 10
+    BCM = 11
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    LOW = 0
+    HIGH = 1
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.mode = None
+        self.levels = {}
+        self.callbacks = {}
+        self.reads = 0
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pin, direction, pull_up_down=None):
+        self.levels.setdefault(pin, self.LOW if pull_up_down == self.PUD_DOWN else self.HIGH)
+
+    def input(self, pin):
+        self.reads += 1
+        return self.levels[pin]
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self.callbacks[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def cleanup(self):
+        self.callbacks = {}
 
-    def __init__(self, params):
-        '''
-        Constructor
-        '''
-        
\ No newline at end of file
+    def set_input(self, pin, level):
+        '''Drive a simulated input, firing its callback on an edge'''
+        old, self.levels[pin] = self.levels.get(pin), level
+        edge, callback = self.callbacks.get(pin, (None, None))
+        if callback is None or old == level:
+            return
+        if (edge == self.BOTH or (edge == self.RISING and level == self.HIGH) or
+                (edge == self.FALLING and level == self.LOW)):
+            callback(pin)
@@ -3,22 +3,75 @@ Created on Jan 18, 2016
 
 @author: justinpalpant
 '''
-from cookiebot.actuators import StepperActuator, ActuatorWrapper, ExecutionError
-from cookiebot.multithreading import RepeatedTimer
+from cookiebot.actuators import StepperActuator, ActuatorWrapper, ExecutionError, home_all
+from cookiebot.multithreading import RepeatedTimer, TaskFuture, format_timing_stats
+from cookiebot.journal import ExecutionJournal, fingerprint
+from cookiebot.i2c import I2CBusManager, COALESCE_WINDOW
+from cookiebot.stepstream import StepStreamLink, StreamedStepperActuator, FirmwareEmulator
+from cookiebot.isolation import IsolatedActuator
+from cookiebot.sensors import DigitalSensor, SimulatedEndStop
+from cookiebot.layout import TrayLayout, load_layout, available_layouts, LayoutError
+from cookiebot.recipe import RecipeError
+from cookiebot.events import (EventBus, StepStarted, StepFinished, CookieFinished,
+                              ActuatorFault, Progress, RecipeFinished, OverrideChanged)
+from cookiebot.tracing import tracer
+from cookiebot import hardware, logsetup, metrics
 import enum
+import functools
 import logging
+import threading
 from ast import literal_eval
 import array
 import time
 import os
 import sys
 import argparse
-from collections import defaultdict
+import weakref
+from collections import defaultdict, OrderedDict
 from enum import IntEnum
 
 MAIN_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DATA_DIR = os.path.join(MAIN_DIR, 'data')
 
+# per-command and per-dispatch debug output; see cookiebot.logsetup
+wrapper_debug = logsetup.step_log('wrapper')
+stage_debug = logsetup.step_log('stage')
+
+dispatch_latency = metrics.registry.histogram(
+    'cookiebot_dispatch_latency_seconds',
+    'Time from the actuators being ready for a step to its dispatch')
+nozzle_toggles = metrics.registry.counter(
+    'cookiebot_nozzle_toggles_total', 'Nozzle commands that changed what it does', ('command',))
+trays_completed = metrics.registry.counter(
+    'cookiebot_trays_completed_total', 'Recipes run to the end')
+tray_seconds = metrics.registry.histogram(
+    'cookiebot_tray_seconds', 'Time from the first dispatch of a recipe to its end',
+    smallest=1.0, buckets=12)
+steps_queued = metrics.registry.gauge(
+    'cookiebot_stage_steps_queued', 'Recipe steps waiting to be dispatched, on every stage')
+
+# every IcingStage in this process, for steps_queued; shut down stages have none
+_stages = weakref.WeakSet()
+steps_queued.set_function(lambda: sum(len(stage.steps) for stage in list(_stages)))
+
+
+class RecipeStep(dict):
+    '''One step of a loaded recipe: a dictionary of {WrapperID: command}
+
+    It behaves exactly like a dict, but also remembers where it came from
+    (e.g. 'square.txt:3') so that traces and logs can point back at the
+    pattern file line responsible for it, and which cookie position (if any)
+    it is icing
+    '''
+
+    def __init__(self, commands=(), source='', cookie=None):
+        super(RecipeStep, self).__init__(commands)
+        self.source = source
+        self.cookie = cookie
+
+    def copy(self):
+        return RecipeStep(self, self.source, self.cookie)
+
 
 class Stage(object):
     '''
@@ -52,35 +105,33 @@ class IcingStage(Stage):
     class CarriageWrapper(ActuatorWrapper):
         logger = logging.getLogger('cookiebot.ActuatorWrapper.CarriageWrapper')
 
-        def __init__(self):
+        def __init__(self, actuator_class=StepperActuator, **actuator_kwargs):
             super(IcingStage.CarriageWrapper, self).__init__()
 
             # set connection to stepper parameters here
             # addr, stepper_num, and dist_per_step especially are crucial
-            self._wrapped_actuators['xmotor'] = StepperActuator(
+            self._wrapped_actuators['xmotor'] = actuator_class(
                 identity='X-axis Stepper',
                 peak_rpm=8,
                 dist_per_step=0.014,
                 addr=0x60,
                 steps_per_rev=200,
                 stepper_num=1,
-                reversed=False
+                reversed=False,
+                **actuator_kwargs
             )
 
-            self._wrapped_actuators['ymotor'] = StepperActuator(
+            self._wrapped_actuators['ymotor'] = actuator_class(
                 identity='Y-axis Stepper',
                 peak_rpm=8,
                 dist_per_step=0.014,
                 addr=0x60,
                 steps_per_rev=200,
                 stepper_num=2,
-                reversed=False
+                reversed=False,
+                **actuator_kwargs
             )
 
-        def zero(self):
-            self._wrapped_actuators['xmotor'].go_to_zero()
-            self._wrapped_actuators['xmotor'].go_to_zero()
-
         def send(self, dest):
             xmotor = self._wrapped_actuators['xmotor']
             ymotor = self._wrapped_actuators['ymotor']
@@ -92,8 +143,9 @@ class IcingStage(Stage):
             step_delta = (
                 int(deltas[0] / xmotor.step_size), int(deltas[1] / ymotor.step_size))
 
-            self.logger.debug(
-                'Need to move {0} steps from {1} to {2}'.format(step_delta, pos, dest))
+            if wrapper_debug.enabled:
+                wrapper_debug.debug(
+                    'Need to move {0} steps from {1} to {2}'.format(step_delta, pos, dest))
 
             step_points = self.bresenham((0, 0), step_delta)
             step_points.append(step_delta)
@@ -110,14 +162,16 @@ class IcingStage(Stage):
             #self.logger.debug('Xsteps: {0}'.format(xsteps))
             #self.logger.debug('Ysteps: {0}'.format(ysteps))
 
-            xmotor.set_task(
+            xdone = xmotor.set_task(
                 task=array.array('b', xsteps),
                 blocking=True)
 
-            ymotor.set_task(
+            ydone = ymotor.set_task(
                 task=array.array('b', ysteps),
                 blocking=True)
 
+            return TaskFuture.gather([xdone, ydone])
+
         def bresenham(self, start_point, end_point):
             """Bresenham's line tracing algorithm, from roguebasin source
 
@@ -180,12 +234,12 @@ class IcingStage(Stage):
     class NozzleWrapper(ActuatorWrapper):
         logger = logging.getLogger('cookiebot.ActuatorWrapper.NozzleWrapper')
 
-        def __init__(self):
+        def __init__(self, actuator_class=StepperActuator, **actuator_kwargs):
             super(IcingStage.NozzleWrapper, self).__init__()
 
             # set connection to stepper parameters here
             # addr, stepper_num, and dist_per_step especially are crucial
-            self._wrapped_actuators['nozzle'] = StepperActuator(
+            self._wrapped_actuators['nozzle'] = actuator_class(
                 identity='Nozzle Stepper',
                 peak_rpm=3.6,
                 dist_per_step=0.00025,
@@ -193,18 +247,17 @@ class IcingStage(Stage):
                 max_dist=2.0,
                 steps_per_rev=200,
                 stepper_num=1,
-                reversed=True
+                reversed=True,
+                **actuator_kwargs
             )
 
-        def zero(self):
-            pass
-
         def send(self, command):
             act = self._wrapped_actuators['nozzle']
 
             if command == 'off':
-                self.logger.debug(
-                    'Sending a short, blocking, shutoff task to turn off the nozzle')
+                if wrapper_debug.enabled:
+                    wrapper_debug.debug(
+                        'Sending a short, blocking, shutoff task to turn off the nozzle')
                 act.set_rpm(15)
                 task = [-1 for _ in xrange(400)]
                 task.extend([0 for _ in xrange(325)])
@@ -213,38 +266,44 @@ class IcingStage(Stage):
                 act.set_task(
                     task=array.array('b', task),
                     blocking=False)
-                
+                return TaskFuture.completed()
+
             elif command == 'run':
                 ticks_to_go = act.max_steps - act.step_pos
-                self.logger.debug(
-                    'Sending {0} forward steps to keep the nozzle running until 1) it runs out or 2) the task is changed'.format(ticks_to_go))
+                if wrapper_debug.enabled:
+                    wrapper_debug.debug(
+                        'Sending {0} forward steps to keep the nozzle running until 1) it runs out or 2) the task is changed'.format(ticks_to_go))
                 act.set_rpm(3.6)
                 act.set_task(
                     task=array.array('b', [1 for _ in xrange(ticks_to_go)]),
                     blocking=False)
-                
+                return TaskFuture.completed()
+
             elif command == 'on':
                 act.set_rpm(15)
-                self.logger.debug('Sending a short, blocking, start-up command to turn on the nozzle')
+                if wrapper_debug.enabled:
+                    wrapper_debug.debug('Sending a short, blocking, start-up command to turn on the nozzle')
 
                 task = [1 for _ in xrange(250)]
                 task.extend([0 for _ in xrange(100)])
-                
-                act.set_task(
+
+                return act.set_task(
                     task=array.array('b', task),
                     blocking=True)
 
+            return TaskFuture.completed()
+
     class PlatformWrapper(ActuatorWrapper):
 
         logger = logging.getLogger('cookiebot.ActuatorWrapper.PlatformWrapper')
 
-        def __init__(self):
+        def __init__(self, actuator_class=StepperActuator, **actuator_kwargs):
             super(IcingStage.PlatformWrapper, self).__init__()
 
             # set connection to stepper parameters here
             # addr, stepper_num, and dist_per_step especially are crucial
             # also the value of go_to_zero
-            self._wrapped_actuators['platform'] = StepperActuator(
+            self._wrapped_actuators['platform'] = actuator_class(
                 identity='Platform Stepper',
                 peak_rpm=30,
                 dist_per_step=0.00025,
@@ -252,70 +311,236 @@ class IcingStage(Stage):
                 addr=0x61,
                 steps_per_rev=200,
                 stepper_num=2,
+                **actuator_kwargs
             )
 
-        def zero(self):
-            pass
-
         def send(self, bool_command):
             act = self._wrapped_actuators['platform']
 
             if bool_command:
                 ticks_to_go = act.max_steps - act.step_pos
-                act.set_task(
+                done = act.set_task(
                     task=array.array('b', [1 for _ in xrange(ticks_to_go)]),
                     blocking=True)
-                self.logger.debug(
-                    'Sending {0} raising steps'.format(ticks_to_go))
+                if wrapper_debug.enabled:
+                    wrapper_debug.debug('Sending {0} raising steps'.format(ticks_to_go))
             else:
                 ticks_to_go = act.step_pos
-                act.set_task(
+                done = act.set_task(
                     task=array.array('b', [-1 for _ in xrange(ticks_to_go)]),
                     blocking=True)
-                self.logger.debug(
-                    'Sending {0} lowering steps'.format(ticks_to_go))
+                if wrapper_debug.enabled:
+                    wrapper_debug.debug('Sending {0} lowering steps'.format(ticks_to_go))
+
+            return done
 
     logger = logging.getLogger('cookiebot.Stage.IcingStage')
 
-    def __init__(self, zero=False, actuators=[0, 1, 2]):
+    # live override factors: carriage speed with the nozzle off and with it
+    # running, and the nozzle's feed rate while it runs
+    OVERRIDES = ('travel', 'icing', 'flow')
+    OVERRIDE_LIMITS = (0.25, 2.0)
+
+    # compiled recipes kept, by Recipe.content_hash()
+    COMPILED_CACHE = 16
+
+    def __init__(self, zero=False, actuators=[0, 1, 2], time_scale=1.0,
+                 journal=None, bus=None, stream=None, isolate=False,
+                 end_stops=None, overrides=None, layout=None, **actuator_kwargs):
         '''
         constructor
+
+        time_scale is passed to every actuator and the recipe timer - values
+        above 1 run the whole stage faster than real time (simulation only!)
+        Any other keyword arguments are passed on to every StepperActuator
+
+        journal is an optional ExecutionJournal that records progress and axis
+        positions so that resume_recipe can pick up after a crash
+
+        bus is an optional I2CBusManager that every stepper sends its steps
+        through; the stage closes it on shutdown
+
+        stream is an optional StepStreamLink to a step-generator board.  If
+        given, every axis is a StreamedStepperActuator on that link and the
+        stage closes it on shutdown
+
+        isolate runs every actuator in its own process (see
+        cookiebot.isolation), so nothing in this process can delay a step.
+        It cannot be combined with bus or stream
+
+        end_stops gives every axis a start end stop to home against:
+        'gpio' watches each axis's zero_pins['start'] on the hardware
+        backend's GPIO, 'simulated' puts a cookiebot.sensors.SimulatedEndStop
+        at step 0.  Not available with isolate or stream, whose steps are not
+        taken in this process
+
+        overrides optionally maps names in OVERRIDES to their starting
+        factors; see set_override
+
+        layout is the cookiebot.layout.TrayLayout that recipe positions are
+        slots of.  The default is the 2x2 tray, placed for a zeroed or an
+        unzeroed stage
         '''
 
         super(IcingStage, self).__init__()
 
         self.steps = []
         self.step_ready = True
-
+        self.step_index = 0
+        self.journal = journal
+        self._recipe_active = False
+        self._compiled = OrderedDict()
+
+        # seconds between the actuators becoming ready and the latest dispatch
+        self.dispatch_latency = 0.0
+        self._dispatch_time = time.time()
+
+        _stages.add(self)
+
+        # resolves when every blocking task of the last dispatched step is done
+        self._pending = None
+
+        # cookie position of the step being run, None between cookies
+        self.active_cookie = None
+
+        # see cookiebot.events for what is published
+        self.events = EventBus()
+        # an actuator fault is logged and published once, not on every check
+        self._faulted = False
+        self._total_steps = 0
+        self._run_started = None
+        self._run_done = 0
+
+        self.bus = bus
+        actuator_kwargs['time_scale'] = time_scale
+        actuator_kwargs['bus'] = bus
+        self.stream = stream
+        if isolate:
+            if bus is not None or stream is not None:
+                raise ValueError('isolate cannot be combined with bus or stream')
+            actuator_kwargs['actuator_class'] = IsolatedActuator
+        elif stream is not None:
+            actuator_kwargs['actuator_class'] = StreamedStepperActuator
+            actuator_kwargs['stream'] = stream
         self._wrappers = {
-            IcingStage.WrapperID.carriage: IcingStage.CarriageWrapper(),
-            IcingStage.WrapperID.nozzle: IcingStage.NozzleWrapper(),
-            IcingStage.WrapperID.platform: IcingStage.PlatformWrapper()
+            IcingStage.WrapperID.carriage: IcingStage.CarriageWrapper(**actuator_kwargs),
+            IcingStage.WrapperID.nozzle: IcingStage.NozzleWrapper(**actuator_kwargs),
+            IcingStage.WrapperID.platform: IcingStage.PlatformWrapper(**actuator_kwargs)
         }
 
         self.active_wrappers = [id for id in self._wrappers.keys() if id.value in actuators]
         self.logger.debug('Active wrappers are {0}'.format(self.active_wrappers))
 
+        # the last command the nozzle was sent decides which overrides apply
+        self.overrides = dict.fromkeys(IcingStage.OVERRIDES, 1.0)
+        self._nozzle_command = 'off'
+        self._override_lock = threading.Lock()
+        for name, factor in (overrides or {}).items():
+            self.set_override(name, factor)
+
+        if end_stops is not None:
+            if isolate or stream is not None:
+                raise ValueError('end_stops cannot be combined with isolate or stream')
+            self._attach_end_stops(end_stops)
+
+        if self.journal is not None:
+            for axis, act in enumerate(self._axes()):
+                act.journal = self.journal
+                act.journal_axis = axis
+
         # Set up assorted parameters
-        if not zero:
-            self.x_cookie_shift = (0.0, 4.5)
-            self.y_cookie_shift = (0.0, 4.5)
+        if layout is None:
+            layout = (TrayLayout(origin=(9.0, 9.0), pitch=(4.0, 4.0)) if zero
+                      else TrayLayout(origin=(0.0, 0.0), pitch=(4.5, 4.5)))
+        self.layout = layout
+
         if zero:
             self.logger.info('Commanded to zero before execution')
-            self.x_cookie_shift = (9.0, 4.0)
-            self.y_cookie_shift = (9.0, 4.0)
-
-            for wrap in self._wrappers:
-                wrap.zero()
+            self.home()
 
         self._recipe_timer = RepeatedTimer(
-            0.1, self._check_recipe, start=False)
+            0.1 / time_scale, self._check_recipe, start=False,
+            name='IcingStage recipe', wakeable=True)
+        # held to check live and start the recipe timer in one go, so a
+        # start cannot slip in behind shutdown
+        self._run_lock = threading.Lock()
+
+    def home(self):
+        '''Home every axis, all at once, and log how long it took
+
+        Returns {axis identity: seconds}
+        '''
+        start = time.time()
+        times = home_all(self._axes())
+        self.logger.info('Homed {0} axes in {1:.2f}s ({2})'.format(
+            len(times), time.time() - start,
+            ', '.join('{0} {1:.2f}s'.format(a, t) for a, t in sorted(times.items()))))
+        return times
+
+    def set_override(self, name, factor):
+        '''Scale the speed of one kind of motion by factor, from now on
+
+        name is 'travel' (carriage moves with the nozzle off), 'icing'
+        (carriage moves while the nozzle runs) or 'flow' (the running
+        nozzle's feed rate).  Safe from any thread and while a recipe runs:
+        the recipe is not reloaded, moves under way ramp to the new speed and
+        every later step starts at it.  Publishes OverrideChanged
+
+        Raises ValueError for an unknown name or a factor outside
+        OVERRIDE_LIMITS
+        '''
+        if name not in IcingStage.OVERRIDES:
+            raise ValueError('Unknown override {0}, expected one of {1}'.format(
+                name, ', '.join(IcingStage.OVERRIDES)))
+        low, high = IcingStage.OVERRIDE_LIMITS
+        factor = float(factor)
+        if not low <= factor <= high:
+            raise ValueError('Override {0} must be between {1} and {2}, not {3}'.format(
+                name, low, high, factor))
+
+        with self._override_lock:
+            self.overrides[name] = factor
+            self._apply_overrides()
+        self.logger.info('{0} override set to {1:.0%}'.format(name.capitalize(), factor))
+        self.events.publish(OverrideChanged(self, name, factor, time.time()))
+
+    def _apply_overrides(self):
+        '''Give every axis the override factor for what it is doing now
+
+        Called with _override_lock held
+        '''
+        running = self._nozzle_command in ('on', 'run')
+        carriage = self.overrides['icing' if running else 'travel']
+        flow = self.overrides['flow'] if self._nozzle_command == 'run' else 1.0
+
+        for act in self._wrappers[IcingStage.WrapperID.carriage]._wrapped_actuators.values():
+            act.set_rate_override(carriage)
+        for act in self._wrappers[IcingStage.WrapperID.nozzle]._wrapped_actuators.values():
+            act.set_rate_override(flow)
+
+    def _attach_end_stops(self, source):
+        for act in self._axes():
+            if source == 'gpio':
+                gpio = hardware.backend().GPIO
+                if gpio is None:
+                    raise hardware.HardwareError('GPIO end stops need the motorhat backend')
+                stop = DigitalSensor(str(act) + ' start', act.zero_pins['start'], gpio)
+                stop.watch()
+            elif source == 'simulated':
+                stop = SimulatedEndStop(act)
+            else:
+                raise ValueError('Unknown end stop source {0}'.format(source))
+            act.set_end_stops(start=stop)
 
     def start_recipe(self):
-        self.logger.info('Starting recipe')
-        self._recipe_timer.restart()
-        for actuator in self._wrappers.values():
-            actuator.unpause()
+        with self._run_lock:
+            if not self.live:
+                self.logger.warning('Not starting a recipe on a stage that has been shut down')
+                return
+            self.logger.info('Starting recipe')
+            self._recipe_timer.restart()
+            for actuator in self._wrappers.values():
+                actuator.unpause()
 
     def stop_recipe(self):
         self.logger.info('Halting recipe progress immediately')
@@ -324,7 +549,17 @@ class IcingStage(Stage):
             actuator.pause()
 
     def recipe_done(self):
-        return not self.steps and self._check_actuators()
+        '''True once every step has run and the actuators are idle
+
+        Only a query, safe from any thread: a dead actuator just makes it
+        False, and is reported by the recipe timer (see ActuatorFault)
+        '''
+        if self.steps:
+            return False
+        try:
+            return all(w.check_ready() for w in self._wrappers.values())
+        except ExecutionError:
+            return False
 
     def shutdown(self):
         '''This recipe completely stops the execution of the stage
@@ -332,45 +567,206 @@ class IcingStage(Stage):
         It CANNOT BE CALLED by the self._recipe_timer, in any way
         '''
 
-        self.steps = []
-        self._recipe_timer.stop()
-        self.live = False
+        with self._run_lock:
+            self.steps = []
+            self.live = False
+        self._recipe_timer.close()
         for act in self._wrappers.values():
             act.kill()
 
+        # actuator threads are joined by now, so nothing else will write
+        if self.journal is not None:
+            self.journal.close()
+        if self.bus is not None:
+            self.bus.close()
+        if self.stream is not None:
+            self.stream.close()
+
+    def timing_stats(self):
+        '''Step timing of every actuator plus the recipe timer itself
+
+        A list of RepeatedTimer.timing_stats() dictionaries, ready for
+        cookiebot.multithreading.format_timing_stats
+        '''
+        stats = [act.timing_stats() for act in self._axes()]
+        stats.append(self._recipe_timer.timing_stats())
+        return stats
+
     def _check_recipe(self):
         '''Frequently-called method that checks if another step of the recipe
         should be executed, and executes it if so'''
 
-        if self.live and self.step_ready and self.steps and self._check_actuators():
+        if self.live and self.step_ready and self.steps and self._step_finished():
             # we need to start the next command
             self.step_ready = False #boring mutex on _check_recipe
-            next_step, self.steps = self.steps[0], self.steps[1:]
-            self.logger.info('Executing step {0}'.format(next_step))
+            dispatch_start = time.time()
+            ready_at = max(self._ready_time(), self._dispatch_time)
+            self.dispatch_latency = dispatch_start - ready_at
+            dispatch_latency.observe(self.dispatch_latency)
 
+            next_step, self.steps = self.steps[0], self.steps[1:]
+            if stage_debug.enabled:
+                stage_debug.debug('Executing step {0}'.format(next_step))
+            self.active_cookie = getattr(next_step, 'cookie', None)
+
+            if self._run_started is None:
+                self._run_started = dispatch_start
+            self.events.publish(StepStarted(
+                self, self.step_index, self._total_steps,
+                getattr(next_step, 'source', ''), dispatch_start))
+
+            # the cookie this step finishes, if it is the last one of a cookie
+            cookie = getattr(next_step, 'cookie', None)
+            if self.steps and getattr(self.steps[0], 'cookie', None) == cookie:
+                cookie = None
+
+            if self.journal is not None:
+                self.journal.step_dispatched(self.step_index)
+
+            nozzle = next_step.get(IcingStage.WrapperID.nozzle)
+            if nozzle is not None and nozzle != self._nozzle_command:
+                nozzle_toggles.labels(nozzle).inc()
+                with self._override_lock:
+                    self._nozzle_command = nozzle
+                    self._apply_overrides()
+
+            futures = []
             for actuator, command in next_step.items():
                 if actuator in self.active_wrappers:
-                    self._wrappers[actuator].pause()
-                    self._wrappers[actuator].send(command)
-                else:
-                    self.logger.debug(
-                        'Not taking steps for actuator {0}'.format(actuator))
+                    wrapper = self._wrappers[actuator]
+                    wrapper.pause()
+                    if tracer.enabled:
+                        send_start = time.time()
+                        futures.append(wrapper.send(command))
+                        tracer.complete(
+                            type(wrapper).__name__ + '.send', 'send', 'IcingStage',
+                            send_start, time.time(), {'command': repr(command)})
+                    else:
+                        futures.append(wrapper.send(command))
+                elif stage_debug.enabled:
+                    stage_debug.debug('Not taking steps for actuator {0}'.format(actuator))
 
             for actuator, command in next_step.items():
                 if actuator in self.active_wrappers:
                     self._wrappers[actuator].unpause()
 
+            self._pending = TaskFuture.gather(f for f in futures if f is not None)
+            self._pending.add_done_callback(functools.partial(
+                self._step_done, self.step_index, dispatch_start, cookie))
+
+            self._dispatch_time = time.time()
+            if tracer.enabled:
+                tracer.complete('dispatch gap', 'gap', 'IcingStage',
+                                ready_at, dispatch_start)
+                tracer.complete('dispatch', 'stage', 'IcingStage',
+                                dispatch_start, self._dispatch_time,
+                                {'step': self.step_index,
+                                 'source': getattr(next_step, 'source', ''),
+                                 'commands': {w.name: str(c) for w, c in next_step.items()}})
+
+            self.step_index += 1
             self.step_ready = True
 
+        elif self._recipe_active and not self.steps and self._check_actuators():
+            self._recipe_active = False
+            now = time.time()
+            elapsed = now - self._run_started if self._run_started else 0.0
+            trays_completed.inc()
+            tray_seconds.observe(elapsed)
+            self.events.publish(RecipeFinished(self, self._total_steps, elapsed, now))
+            if self.journal is not None:
+                self.journal.end_recipe()
+                self._log_journal_overhead()
+
+    def _step_finished(self):
+        '''True once everything the last step started is done
+
+        Waiting on the step's future costs nothing per tick; the actuators
+        themselves are only polled once it resolves, to catch any that died
+        while running a non-blocking task
+        '''
+        if self._pending is not None and not self._pending.done():
+            return False
+        return self._check_actuators()
+
+    def _step_done(self, index, started, cookie, future):
+        '''Done callback of each step - runs in an actuator thread, so it
+        only publishes events and wakes the recipe timer, which does the
+        next dispatch'''
+        if future.exception() is not None:
+            self.logger.error('Step {0} failed: {1}'.format(index, future.exception()))
+            self._recipe_timer.trigger()
+            return
+
+        now = time.time()
+        total = self._total_steps
+        self._run_done += 1
+        self.events.publish(StepFinished(self, index, total, now - started, now))
+        if cookie is not None:
+            self.events.publish(CookieFinished(self, cookie, index, now))
+
+        done = index + 1
+        eta = None
+        if self._run_started is not None:
+            eta = (now - self._run_started) / self._run_done * max(0, total - done)
+        self.events.publish(Progress(
+            self, done, total, float(done) / total if total else 1.0, eta, now))
+
+        self._recipe_timer.trigger()
+
+    def _log_journal_overhead(self):
+        '''Compare the cost of a journal write to the fastest step period'''
+        fastest = min(act.timing_stats()['interval'] for act in self._axes())
+        fraction = self.journal.overhead() / fastest
+
+        message = 'Journal writes took {0:.1f}us on average, {1:.2%} of a step'.format(
+            self.journal.overhead() * 1e6, fraction)
+        if fraction > 0.01:
+            self.logger.warning(message)
+        else:
+            self.logger.info(message)
+
+    def carriage_position(self):
+        '''Where the nozzle is now, in stage coordinates
+
+        Only reads the axes' positions, so it is cheap and never blocks
+        '''
+        carriage = self._wrappers[IcingStage.WrapperID.carriage]._wrapped_actuators
+        return (carriage['xmotor'].real_pos, carriage['ymotor'].real_pos)
+
+    def pattern_position(self):
+        '''(cookie, (x, y)): the cookie being iced and the nozzle position in
+        that cookie's pattern coordinates, or (None, None) between cookies'''
+        cookie = self.active_cookie
+        if cookie is None:
+            return (None, None)
+
+        return (cookie, self.layout.to_pattern(self.carriage_position(), cookie))
+
+    def _ready_time(self):
+        '''The time at which the last actuator became able to take a command'''
+        return max(act.ready_time for act in self._axes())
+
+    def _axes(self):
+        '''Every actuator on this stage, in a fixed order'''
+        return [wrapper._wrapped_actuators[name]
+                for _, wrapper in sorted(self._wrappers.items())
+                for name in sorted(wrapper._wrapped_actuators)]
+
     def _check_actuators(self):
+        '''True if every actuator can take a command; a dead one takes the
+        stage down, and is reported once.  Only the recipe timer calls this'''
         for w in self._wrappers.values():
             try:
                 ready = w.check_ready()
             except ExecutionError as e:
-                self.logger.error(
-                    'Wrapper says actuator is dead with error {0}'.format(e))
-                self.logger.error('Terminating stage')
                 self.live = False
+                if not self._faulted:
+                    self._faulted = True
+                    self.logger.error(
+                        'Wrapper says actuator is dead with error {0}'.format(e))
+                    self.logger.error('Terminating stage')
+                    self.events.publish(ActuatorFault(self, str(e), time.time()))
                 return False
 
             if not ready:
@@ -381,27 +777,127 @@ class IcingStage(Stage):
     def load_recipe(self, recipe):
         self.logger.info('Begining recipe load')
 
+        parsed = self._compile(recipe)
+
+        self.logger.info('Loaded a recipe with {0} steps'.format(len(parsed)))
+
+        self.steps = parsed[:]
+        self.step_index = 0
+        self._recipe_active = True
+        self._start_run(len(parsed))
+        if self.journal is not None:
+            self.journal.begin_recipe(parsed)
+
+    def resume_recipe(self, recipe):
+        '''Load recipe, but skip whatever the journal says was already done
+
+        Axis positions are restored from the journal, and execution restarts
+        at the beginning of the stroke that was interrupted, so cookies (and
+        strokes) that were finished are not iced again.  Falls back to a
+        normal load_recipe if the journal is missing, finished, or belongs to
+        a different recipe.
+
+        Returns the index of the first step that will be executed
+        '''
+        parsed = self._compile(recipe)
+        state = (ExecutionJournal.recover(self.journal.path)
+                 if self.journal is not None else None)
+
+        if (state is None or state.finished or state.dispatched < 0 or
+                state.total != len(parsed) or
+                state.fingerprint != fingerprint(parsed)):
+            self.logger.info('Nothing to resume, loading the recipe from the start')
+            self.load_recipe(recipe)
+            return 0
+
+        for axis, act in enumerate(self._axes()):
+            if axis in state.positions:
+                act.step_pos = state.positions[axis]
+
+        start = self._stroke_start(parsed, state.dispatched)
+        remaining = [s.copy() for s in parsed[start:]]
+        # the platform may have been lowered or left half-raised; raising it
+        # along with the first travel move costs no extra time
+        if start > 0:
+            remaining[0][IcingStage.WrapperID.platform] = True
+
+        self.logger.info('Resuming recipe at step {0} of {1} (interrupted at {2})'.format(
+            start, len(parsed), state.dispatched))
+
+        self.steps = remaining
+        self.step_index = start
+        self._recipe_active = True
+        self._start_run(len(parsed))
+        return start
+
+    def clear_recipe(self):
+        '''Forget whatever is left of the loaded recipe'''
+        self.steps = []
+        self._recipe_active = False
+        self.active_cookie = None
+
+    def _start_run(self, total):
+        self._total_steps = total
+        self._run_started = None
+        self._run_done = 0
+        # every run, and every resumed stroke, starts with the nozzle off
+        with self._override_lock:
+            self._nozzle_command = 'off'
+            self._apply_overrides()
+
+    @staticmethod
+    def _stroke_start(steps, index):
+        '''Index of the first step of the stroke that contains steps[index]
+
+        A stroke ends when the nozzle is turned off, so the next stroke starts
+        with the step after that
+        '''
+        for i in xrange(index - 1, -1, -1):
+            if steps[i].get(IcingStage.WrapperID.nozzle) == 'off':
+                return i + 1
+        return 0
+
+    def _compile(self, recipe):
+        '''_parse_recipe(recipe), reusing the steps of an identical recipe
+        (same cookies, same pattern file contents) loaded recently
+
+        The steps are shared, so they must never be changed in place
+        '''
+        key = recipe.content_hash()
+        parsed = self._compiled.pop(key, None)
+        if parsed is None:
+            parsed = self._parse_recipe(recipe)
+        else:
+            self.logger.debug('Reusing the compiled steps of recipe {0}'.format(key[:12]))
+
+        self._compiled[key] = parsed
+        while len(self._compiled) > IcingStage.COMPILED_CACHE:
+            self._compiled.popitem(last=False)
+        return parsed
+
+    def _parse_recipe(self, recipe):
+        '''Convert a recipe into the complete list of steps for this stage'''
         parsed = []
 
-        parsed.append({IcingStage.WrapperID.carriage: (0, 0),
-                       IcingStage.WrapperID.platform: True
-                       })
+        parsed.append(RecipeStep({IcingStage.WrapperID.carriage: (0, 0),
+                                  IcingStage.WrapperID.platform: True
+                                  }, source='recipe start'))
 
         for cookie_pos, cookie_spec in sorted(recipe.cookies.items(), key= lambda p: p[0]):
-            icing_coms = self._load_icing_file(cookie_spec['icing'].value)
-            offset_coms = self._offset_commands(icing_coms, cookie_pos)
-            parsed.extend(offset_coms)
+            if cookie_pos not in self.layout:
+                raise RecipeError('Cookie position {0} is not on the {1} tray'.format(
+                    cookie_pos, self.layout))
+            pattern = CompiledPattern.load(cookie_spec['icing'].value)
+            parsed.extend(pattern.place(self.layout, cookie_pos))
 
         # every recipe ends by stopping the nozzle, zeroing the carriage, and
         # lowering the platform
 
-        parsed.append({IcingStage.WrapperID.carriage: (0, 0),
-                       IcingStage.WrapperID.platform: False
-                       })
-
-        self.logger.info('Loaded a recipe with {0} steps'.format(len(parsed)))
+        parsed.append(RecipeStep({IcingStage.WrapperID.carriage: (0, 0),
+                                  IcingStage.WrapperID.platform: False
+                                  }, source='recipe end'))
 
-        self.steps = parsed[:]
+        return parsed
 
     def _load_icing_file(self, filename):
         '''Load an icing file and return a list of commands
@@ -423,49 +919,60 @@ class IcingStage(Stage):
 
         Assigned to Cynthia
         '''
-        coms = []
-
-        with open(os.path.join(DATA_DIR, filename), 'r') as icingspec:
-            for line in icingspec:
-                coms.append(
-                    {IcingStage.WrapperID(idx): com
-                     for idx, com in literal_eval(line).items()
-                     }
-                )
-
-        return coms
+        return load_pattern(filename)
 
-    def _offset_commands(self, commands, pos):
-        '''Take a list of command dictionaries and shift the positions based on
-        which cookie slot the cookie belongs to
 
-        Arguments:
-            commands - a list of command dictionaries, as returned by
-                load_icing_file
-            pos - a cookie position, as returned by a recipe
+def load_pattern(filename):
+    '''Parse an icing pattern file (relative to DATA_DIR) into RecipeSteps
 
-        Returns:
-            An updated list of command dictionaries
-        '''
-        new_commands = list(commands)
+    Each line is a dictionary literal {wrapper index: command}; every step
+    remembers its file and line as its source
+    '''
+    coms = []
 
-        for c in new_commands:
-            if IcingStage.WrapperID.carriage in c:
-                old_dest = c[IcingStage.WrapperID.carriage]
-                new_dest = self._shift_point(old_dest, pos)
-                c[IcingStage.WrapperID.carriage] = new_dest
+    with open(os.path.join(DATA_DIR, filename), 'r') as icingspec:
+        for lineno, line in enumerate(icingspec, 1):
+            coms.append(RecipeStep(
+                {IcingStage.WrapperID(idx): com
+                 for idx, com in literal_eval(line).items()
+                 },
+                source='{0}:{1}'.format(os.path.basename(filename), lineno)
+            ))
 
-        return new_commands
+    return coms
 
-    def _shift_point(self, coord, cookiepos):
-        '''Shift a single coordinate based on the cookiepos it belongs to'''
 
-        x = self.x_cookie_shift[0] + coord[0] + \
-            cookiepos[0] * self.x_cookie_shift[1]
-        y = self.y_cookie_shift[0] + coord[1] + \
-            cookiepos[1] * self.y_cookie_shift[1]
+class CompiledPattern(object):
+    '''A pattern file parsed once, with its carriage destinations gathered
+    into one list so that a TrayLayout can place them all at once
 
-        return (x, y)
+    load() caches patterns until their file changes
+    '''
+    _cache = {}
+
+    def __init__(self, steps):
+        self.steps = steps
+        carriage = IcingStage.WrapperID.carriage
+        self._moves = [i for i, step in enumerate(steps) if carriage in step]
+        self.points = [steps[i][carriage] for i in self._moves]
+
+    @classmethod
+    def load(cls, filename):
+        '''The compiled pattern of filename, relative to DATA_DIR'''
+        mtime = os.path.getmtime(os.path.join(DATA_DIR, filename))
+        cached = cls._cache.get(filename)
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, cls(load_pattern(filename)))
+            cls._cache[filename] = cached
+        return cached[1]
+
+    def place(self, layout, pos):
+        '''New RecipeSteps of this pattern, for the cookie in slot pos of layout'''
+        steps = [RecipeStep(step, step.source, pos) for step in self.steps]
+        carriage = IcingStage.WrapperID.carriage
+        for i, point in zip(self._moves, layout.apply(self.points, pos)):
+            steps[i][carriage] = point
+        return steps
 
 
 def opts():
@@ -486,21 +993,109 @@ def opts():
         '--zero', action='store_true',
         help='Choose whether or not to zero the actuators.  Default False')
 
+    parser.add_argument(
+        '--layout', default=None,
+        help='Tray layout: one of {0} from data/layouts, or a layout JSON file.  Recipes fill its slots row by row.  Default the 2x2 tray'.format(
+            ', '.join(available_layouts())))
+
+    parser.add_argument(
+        '--end-stops', choices=['gpio', 'simulated'], default=None,
+        help='Home against end stops on the GPIO pins, or simulated ones at step 0')
+
+    parser.add_argument(
+        '--journal', default=None,
+        help='Record progress to this journal file so a crashed run can be resumed')
+
+    parser.add_argument(
+        '--resume', action='store_true',
+        help='Resume the recipe recorded in --journal instead of starting over')
+
+    parser.add_argument(
+        '--hardware', choices=hardware.BACKENDS, default=None,
+        help='Hardware backend to drive; defaults to ${0} or auto'.format(hardware.ENVIRONMENT))
+
+    parser.add_argument(
+        '--i2c-bus', type=int, default=None,
+        help='Send all steps through one bus manager on this I2C bus number (usually 1)')
+
+    parser.add_argument(
+        '--i2c-coalesce', type=float, default=COALESCE_WINDOW, metavar='SECONDS',
+        help='With --i2c-bus, hold each batch of steps this long so other axes can join it; '
+             '0 writes every step as soon as it is queued')
+
+    parser.add_argument(
+        '--stream', default=None,
+        help='Offload step timing to step-stream firmware on this serial port')
+
+    parser.add_argument(
+        '--stream-emulator', action='store_true',
+        help='Run the step-stream firmware emulator on a pty and use it as --stream')
+
+    parser.add_argument(
+        '--isolate', action='store_true',
+        help='Run every actuator in its own process')
+
+    parser.add_argument(
+        '--precise', action='store_true',
+        help='Use the high-precision sleep/spin step timers (costs CPU while moving)')
+
+    parser.add_argument(
+        '--lateness-fault', type=float, default=None,
+        help='Kill the stage if a step fires more than this many step intervals late')
+
+    parser.add_argument(
+        '--trace', default=None,
+        help='Record a timing trace and save it to this file (Chrome trace format)')
+
+    for name, motion in zip(IcingStage.OVERRIDES,
+                            ['carriage moves with the nozzle off',
+                             'carriage moves while icing', 'the nozzle feed rate']):
+        parser.add_argument(
+            '--' + name, type=float, default=1.0,
+            help='Starting override factor for {0}; default 1.0'.format(motion))
+
+    parser.add_argument(
+        '--step-debug', nargs='*', default=[], choices=logsetup.SUBSYSTEMS + ('all',),
+        help='Log every step of these subsystems (slow); also ${0}'.format(logsetup.ENVIRONMENT))
+
+    parser.add_argument(
+        '--metrics', default=None, metavar='[HOST:]PORT',
+        help='Serve Prometheus metrics on this address (host default 127.0.0.1); also ${0}'.format(
+            metrics.ENVIRONMENT))
+
+    parser.add_argument(
+        '--control-port', type=int, default=None,
+        help='Serve the control protocol on this local port, so overrides can be changed while running')
+
     return parser
 
 
 def main():
-    from cookiebot.recipe import Recipe, RecipeError
+    from cookiebot.recipe import Recipe
 
     displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
 
     logging.basicConfig(
         level=logging.DEBUG, format=displayformat, stream=sys.stdout)
+    # the step threads only queue their records
+    logsetup.install()
 
     args = opts().parse_args()
+    logsetup.set_step_debug(args.step_debug)
+
+    layout = None
+    if args.layout:
+        try:
+            layout = load_layout(args.layout)
+        except LayoutError as e:
+            logging.error(e)
+            return
 
     r = Recipe()
-    cookie_positions = [(1, 0), (1, 1), (0, 1), (0, 0)]
+    if layout is not None:
+        cookie_positions = layout.positions()
+    else:
+        cookie_positions = [(1, 0), (1, 1), (0, 1), (0, 0)]
 
     for recipe, pos in zip(args.recipes, cookie_positions):
         logging.info('Adding a {0} cookie to position {1}'.format(recipe, pos))
@@ -509,14 +1104,57 @@ def main():
     s = set(args.freeze)
     actuators = [a for a in [0, 1, 2] if a not in s]
 
-    stage = IcingStage(zero=args.zero, actuators=actuators)
+    if args.trace:
+        tracer.enable()
+
+    if args.hardware:
+        hardware.select(args.hardware)
+
+    journal = ExecutionJournal(args.journal) if args.journal else None
+    bus = None
+    if args.i2c_bus is not None:
+        bus = I2CBusManager.open(args.i2c_bus, coalesce_window=args.i2c_coalesce)
+
+    emulator = FirmwareEmulator() if args.stream_emulator else None
+    port = emulator.port if emulator is not None else args.stream
+    stream = StepStreamLink.open(port) if port else None
+
+    stage = IcingStage(zero=args.zero, actuators=actuators, journal=journal, bus=bus,
+                       stream=stream, isolate=args.isolate, end_stops=args.end_stops,
+                       lateness_fault=args.lateness_fault,
+                       precise=args.precise,
+                       overrides={name: getattr(args, name) for name in IcingStage.OVERRIDES
+                                  if getattr(args, name) != 1.0},
+                       layout=layout)
+
+    # SIGUSR1 profiles every thread; see cookiebot.profiler
+    from cookiebot import profiler
+    profiler.install(stage)
+
+    control = None
+    if args.control_port is not None:
+        from cookiebot.control import ControlServer
+        control = ControlServer(stage, args.control_port)
+
+    metrics_server = None
+    address = args.metrics or os.environ.get(metrics.ENVIRONMENT)
+    if address:
+        host, port = metrics.parse_address(address)
+        metrics_server = metrics.MetricsServer(port=port, host=host)
 
     try:
-        stage.load_recipe(r)
+        if args.resume:
+            stage.resume_recipe(r)
+        else:
+            stage.load_recipe(r)
     except (RecipeError, IOError) as e:
         logging.error(
             'Something is wrong with that recipe file! Shutting down.')
         stage.shutdown()
+        if control is not None:
+            control.close()
+        if metrics_server is not None:
+            metrics_server.close()
         raise e
 
     try:
@@ -540,7 +1178,20 @@ def main():
         logging.info('Execution finished without error')
     finally:
         logging.info('Shutting down the stage and its actuators')
+        if control is not None:
+            control.close()
+        if metrics_server is not None:
+            metrics_server.close()
         stage.shutdown()
+        logging.info('Step timing:\n' + format_timing_stats(stage.timing_stats()))
+        if emulator is not None:
+            logging.info('Emulated firmware took {0} steps, worst lateness {1:.2f}ms'.format(
+                emulator.steps, emulator.max_lateness * 1e3))
+            emulator.close()
+
+        if args.trace:
+            logging.info('Saving timing trace to {0}'.format(args.trace))
+            tracer.export(args.trace)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,639 @@
+'''
+Created on Oct 18, 2026
+
+Step-stream backend: step timing generated by a co-processor, not by Python
+
+Instead of calling oneStep once per step from an actuator thread, a
+StreamedStepperActuator compresses each task into a few timed motion blocks
+and sends them over a serial link to a step-generator board, much like
+Klipper's queue_step.  Each block says "take count steps in this direction,
+the first at clock start, then every interval microseconds, adding add to
+the interval after each step", so the board times every pulse itself.
+
+Frames, in both directions:
+
+    0x7E, type, payload length, payload..., checksum
+
+The checksum is the low byte of the sum of type, length and payload.  All
+payload fields are little-endian.
+
+    host -> firmware
+        QUEUE         axis, direction, count, interval, add, start, seq
+        FLUSH         axis - drop the running and queued blocks
+        QUERY         ask for CLOCK and a POSITION of every axis
+        SET_POSITION  axis, position
+
+    firmware -> host
+        ACK           axis, seq, free - a block was queued
+        POSITION      axis, position, busy, free, seq, clock
+        CLOCK         clock
+        ERROR         axis, code
+
+Flow control is credit based: the host only sends a block when the
+firmware's last reported free queue slots, less the blocks still in flight,
+leave room for it.  POSITION reports are sent whenever a block finishes,
+after every FLUSH and SET_POSITION, and periodically while an axis moves.
+
+FirmwareEmulator implements the firmware side on a pseudo-terminal, so
+the whole path can be exercised without a board:
+
+    python -m cookiebot.stepstream
+'''
+import argparse
+import collections
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from cookiebot.actuators import StepperActuator, ExecutionError
+from cookiebot.multithreading import RepeatedTimer
+
+SYNC = 0x7E
+
+QUEUE = 0x01
+FLUSH = 0x02
+QUERY = 0x03
+SET_POSITION = 0x04
+
+ACK = 0x81
+POSITION = 0x82
+CLOCK = 0x83
+ERROR = 0x84
+
+PAYLOADS = {
+    QUEUE: struct.Struct('<BbHIiIH'),
+    FLUSH: struct.Struct('<B'),
+    QUERY: struct.Struct('<'),
+    SET_POSITION: struct.Struct('<Bi'),
+    ACK: struct.Struct('<BHB'),
+    POSITION: struct.Struct('<BiBBHI'),
+    CLOCK: struct.Struct('<I'),
+    ERROR: struct.Struct('<BB'),
+}
+
+ERROR_QUEUE_FULL = 1
+ERROR_BAD_AXIS = 2
+
+MAX_COUNT = 0xFFFF
+CLOCK_MASK = 0xFFFFFFFF
+SEQ_MASK = 0xFFFF
+
+
+def clock_diff(a, b):
+    '''a - b for two wrapping 32-bit microsecond clocks'''
+    return ((a - b + (1 << 31)) & CLOCK_MASK) - (1 << 31)
+
+
+def frame(ftype, *fields):
+    '''Pack one frame of type ftype'''
+    payload = PAYLOADS[ftype].pack(*fields)
+    body = bytearray([ftype, len(payload)]) + bytearray(payload)
+    return bytes(bytearray([SYNC]) + body + bytearray([sum(body) & 0xFF]))
+
+
+class FrameParser(object):
+    '''Reassembles frames from a byte stream, skipping anything corrupt'''
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self.dropped = 0
+
+    def feed(self, data):
+        '''Add received bytes; returns a list of (type, fields) tuples'''
+        self._buffer.extend(data)
+        frames = []
+        buf = self._buffer
+
+        while True:
+            start = buf.find(bytearray([SYNC]))
+            if start < 0:
+                self.dropped += len(buf)
+                del buf[:]
+                break
+            if start:
+                self.dropped += start
+                del buf[:start]
+            if len(buf) < 4:
+                break
+
+            ftype, length = buf[1], buf[2]
+            fmt = PAYLOADS.get(ftype)
+            if fmt is None or fmt.size != length:
+                # not a real frame start; look for the next one
+                self.dropped += 1
+                del buf[:1]
+                continue
+            if len(buf) < length + 4:
+                break
+
+            if sum(buf[1:3 + length]) & 0xFF != buf[3 + length]:
+                self.dropped += 1
+                del buf[:1]
+                continue
+
+            frames.append((ftype, fmt.unpack(bytes(buf[3:3 + length]))))
+            del buf[:4 + length]
+
+        return frames
+
+
+def encode_steps(task, tolerance=0.5):
+    '''Compress a task of -1/0/1 ticks into constant-rate blocks
+
+    Steps in the same direction join one block for as long as a single
+    interval puts every one of them within tolerance ticks of the tick it
+    was planned for, so a Bresenham line with steps 2, 3, 2, 3 ticks apart
+    becomes one block at 2.5 ticks.
+
+    Yields (direction, count, first_tick, interval_in_ticks)
+    '''
+    direction = count = first = 0
+    lo, hi = 0.0, float('inf')
+
+    for tick, step in enumerate(task):
+        if not step:
+            continue
+
+        if count and step == direction and count < MAX_COUNT:
+            new_lo = max(lo, (tick - tolerance - first) / float(count))
+            new_hi = min(hi, (tick + tolerance - first) / float(count))
+            if new_lo <= new_hi:
+                lo, hi = new_lo, new_hi
+                count += 1
+                continue
+
+        if count:
+            yield (direction, count, first, (lo + hi) / 2.0 if count > 1 else 0.0)
+        direction, count, first = step, 1, tick
+        lo, hi = 0.0, float('inf')
+
+    if count:
+        yield (direction, count, first, (lo + hi) / 2.0 if count > 1 else 0.0)
+
+
+class _LinkAxis(object):
+    '''What the host knows about one firmware axis'''
+
+    def __init__(self):
+        self.position = 0
+        self.busy = False
+        self.free = 0
+        self.sent = 0
+        self.acked = 0
+
+
+class StepStreamLink(object):
+    '''Host end of the step-stream protocol, over any serial file descriptor
+
+    Writes may come from any actuator thread; a reader thread applies ACKs
+    and reports as they arrive.  The firmware clock is tracked from CLOCK
+    replies to a QUERY sent every sync_interval seconds
+    '''
+    logger = logging.getLogger('cookiebot.StepStreamLink')
+
+    def __init__(self, fd, axes=4, sync_interval=1.0, timeout=2.0):
+        self._fd = fd
+        self._write_lock = threading.Lock()
+        self._parser = FrameParser()
+        self._axes = [_LinkAxis() for _ in xrange(axes)]
+        self._attached = []
+
+        self._offset = None
+        self._query_sent = 0.0
+        self._clock_event = threading.Event()
+
+        self.error = None
+        self.frames_sent = 0
+        self.bytes_sent = 0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._read, name='step stream')
+        self._thread.daemon = True
+        self._thread.start()
+
+        self.query()
+        if not self._clock_event.wait(timeout):
+            self._running = False
+            raise IOError('No answer from step-stream firmware')
+
+        self._sync_timer = RepeatedTimer(sync_interval, self.query,
+                                         name='step stream sync')
+
+    @classmethod
+    def open(cls, path, baudrate=115200, **kwargs):
+        '''Open a serial device (or emulator pty) in raw mode'''
+        import termios
+        import tty
+
+        fd = os.open(path, os.O_RDWR | os.O_NOCTTY)
+        tty.setraw(fd)
+        speed = getattr(termios, 'B{0}'.format(baudrate), None)
+        if speed is not None:
+            attrs = termios.tcgetattr(fd)
+            attrs[4] = attrs[5] = speed
+            termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+        return cls(fd, **kwargs)
+
+    def attach(self, identity):
+        '''Give the next unused firmware axis to an actuator'''
+        if len(self._attached) == len(self._axes):
+            raise IOError('No free step-stream axis for {0}'.format(identity))
+
+        self._attached.append(identity)
+        self.logger.debug('{0} drives step-stream axis {1}'.format(
+            identity, len(self._attached) - 1))
+        return len(self._attached) - 1
+
+    def clock(self):
+        '''Best estimate of the firmware clock right now'''
+        return int(time.time() * 1e6 + self._offset) & CLOCK_MASK
+
+    def credits(self, axis):
+        '''Blocks that can be sent to axis without overflowing its queue'''
+        a = self._axes[axis]
+        return a.free - ((a.sent - a.acked) & SEQ_MASK)
+
+    def idle(self, axis):
+        '''True once axis has finished every block sent to it'''
+        a = self._axes[axis]
+        return not a.busy and a.acked == a.sent
+
+    def position(self, axis):
+        return self._axes[axis].position
+
+    def queue_block(self, axis, direction, count, interval, add=0, start=0):
+        a = self._axes[axis]
+        a.sent = (a.sent + 1) & SEQ_MASK
+        self._send(frame(QUEUE, axis, direction, count, interval, add, start, a.sent))
+
+    def flush(self, axis):
+        self._send(frame(FLUSH, axis))
+
+    def set_position(self, axis, position):
+        self._axes[axis].position = position
+        self._send(frame(SET_POSITION, axis, position))
+
+    def query(self):
+        self._query_sent = time.time()
+        self._send(frame(QUERY))
+
+    def close(self):
+        if hasattr(self, '_sync_timer'):
+            self._sync_timer.stop()
+        self._running = False
+        self._thread.join()
+        os.close(self._fd)
+
+    def stats(self):
+        return {'frames': self.frames_sent, 'bytes': self.bytes_sent,
+                'dropped': self._parser.dropped}
+
+    def _send(self, data):
+        with self._write_lock:
+            os.write(self._fd, data)
+            self.frames_sent += 1
+            self.bytes_sent += len(data)
+
+    def _read(self):
+        while self._running:
+            r, _, _ = select.select([self._fd], [], [], 0.1)
+            if not r:
+                continue
+            try:
+                data = os.read(self._fd, 4096)
+            except OSError as e:
+                self.error = 'Step-stream link failed: {0}'.format(e)
+                self.logger.error(self.error)
+                return
+
+            for ftype, fields in self._parser.feed(data):
+                self._handle(ftype, fields)
+
+    def _handle(self, ftype, fields):
+        if ftype == ACK:
+            axis, seq, free = fields
+            a = self._axes[axis]
+            a.acked, a.free, a.busy = seq, free, True
+
+        elif ftype == POSITION:
+            axis, position, busy, free, seq, clock = fields
+            a = self._axes[axis]
+            a.position, a.busy, a.free, a.acked = position, bool(busy), free, seq
+
+        elif ftype == CLOCK:
+            now = time.time()
+            # assume the reply was made halfway through the round trip
+            self._offset = fields[0] - (self._query_sent + now) / 2.0 * 1e6
+            self._clock_event.set()
+
+        elif ftype == ERROR:
+            self.error = 'Step-stream firmware error {1} on axis {0}'.format(*fields)
+            self.logger.error(self.error)
+
+
+class StreamedStepperActuator(StepperActuator):
+    '''A StepperActuator whose steps are timed by step-stream firmware
+
+    Tasks are the same -1/0/1 arrays as always, at the same rpm.  Each new
+    task is compressed with encode_steps and its blocks are sent as credits
+    allow; the task is complete once the firmware reports the axis idle and
+    the task's last tick has passed.  A task replaced before it finishes is
+    flushed from the firmware first.
+
+    The step timer only polls the link, every poll_interval seconds.  lead is
+    how far ahead of the firmware clock a new task is scheduled to start.
+    '''
+    logger = logging.getLogger('cookiebot.Actuator.StreamedStepperActuator')
+
+    drives_hat = False
+
+    def __init__(self, stream=None, poll_interval=0.01, lead=0.02, **kwargs):
+        self.stream = stream
+        self.axis = stream.attach(kwargs.get('identity', ''))
+        self.lead = lead
+        self._lock = threading.RLock()
+
+        self._planned = None
+        self._blocks = iter(())
+        self._next_block = None
+        self._tick_us = 0.0
+        self._start = self._end = 0
+        self._reported_pos = None
+
+        super(StreamedStepperActuator, self).__init__(**kwargs)
+        self._timer.interval = poll_interval
+
+    @property
+    def step_pos(self):
+        return self.stream.position(self.axis) * self.direction
+
+    @step_pos.setter
+    def step_pos(self, value):
+        # called by StepperActuator.__init__ before direction is set
+        self.stream.set_position(self.axis, value * getattr(self, 'direction', 1))
+
+    def set_rpm(self, new_rpm):
+        '''Takes effect from the next task; the timer only polls the link'''
+        self.rpm = new_rpm
+
+    def _apply_override(self, factor):
+        # like rpm, the override is planned into the next task's blocks
+        self._applied_override = factor
+
+    def kill(self):
+        super(StepperActuator, self).kill()
+        self.stream.flush(self.axis)
+
+    def _task_is_complete(self):
+        return not self._task
+
+    def _execute_task(self):
+        with self._lock:
+            if self.stream.error:
+                raise ExecutionError(self.stream.error)
+
+            task = self._task
+            if self._planned is not task:
+                self._plan(task)
+
+            while self._next_block is not None and self.stream.credits(self.axis) > 0:
+                direction, count, first, interval = self._next_block
+                self.stream.queue_block(
+                    self.axis, direction * self.direction, count,
+                    int(round(interval * self._tick_us)), 0,
+                    (self._start + int(round(first * self._tick_us))) & CLOCK_MASK)
+                self._next_block = next(self._blocks, None)
+
+            self._journal_position()
+
+            if (self._next_block is None and self.stream.idle(self.axis) and
+                    clock_diff(self.stream.clock(), self._end) >= 0 and
+                    self._task is task):
+                self._task = None
+
+    def _plan(self, task):
+        '''Schedule a new task to start lead seconds from now'''
+        if self._planned is not None and not self.stream.idle(self.axis):
+            self.stream.flush(self.axis)
+
+        self._planned = task
+        self._tick_us = self._rpm_to_interval(self.rpm) / self.rate_override * 1e6
+        self._start = (self.stream.clock() + int(self.lead * 1e6)) & CLOCK_MASK
+        self._end = (self._start + int(round(len(task) * self._tick_us))) & CLOCK_MASK
+        self._blocks = encode_steps(task)
+        self._next_block = next(self._blocks, None)
+
+    def _journal_position(self):
+        pos = self.step_pos
+        if self.journal is not None and pos != self._reported_pos:
+            self.journal.position(self.journal_axis, pos)
+        self._reported_pos = pos
+
+
+class _EmulatedAxis(object):
+
+    def __init__(self):
+        self.position = 0
+        self.queue = collections.deque()
+        self.block = None
+        self.next_us = 0.0
+        self.remaining = 0
+        self.interval = 0
+        self.add = 0
+        self.direction = 0
+        self.seq = 0
+
+    @property
+    def busy(self):
+        return self.block is not None or bool(self.queue)
+
+
+class FirmwareEmulator(object):
+    '''Reference step-stream firmware running on a pseudo-terminal
+
+    Point StepStreamLink.open at port.  Steps are "taken" by updating the
+    axis position at the right time; steps and the worst lateness of any
+    step are counted so tests can check the timing.  With record=True every
+    step is kept as (axis, firmware clock, direction)
+    '''
+    logger = logging.getLogger('cookiebot.FirmwareEmulator')
+
+    def __init__(self, axes=4, queue_size=16, report_interval=0.05, record=False):
+        import pty
+        import tty
+
+        self.queue_size = queue_size
+        self.report_interval = report_interval
+        self.axes = [_EmulatedAxis() for _ in xrange(axes)]
+
+        self.steps = 0
+        self.max_lateness = 0.0
+        self.record = record
+        self.pulses = []
+
+        self._master, self._slave = pty.openpty()
+        # raw, so binary frames pass through the line discipline untouched
+        tty.setraw(self._slave)
+        self.port = os.ttyname(self._slave)
+
+        self._parser = FrameParser()
+        self._t0 = time.time()
+        self._last_report = 0.0
+
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='step stream emulator')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def close(self):
+        self._running = False
+        self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+    def _now_us(self):
+        return (time.time() - self._t0) * 1e6
+
+    def _run(self):
+        while self._running:
+            now = self._now_us()
+            wake = now + self.report_interval * 1e6
+            for a in self.axes:
+                if a.block is not None:
+                    wake = min(wake, a.next_us)
+
+            r, _, _ = select.select([self._master], [], [],
+                                    max(0.0, (wake - now) / 1e6))
+            if r:
+                try:
+                    data = os.read(self._master, 4096)
+                except OSError:
+                    # nobody has the port open
+                    data = ''
+                    time.sleep(0.01)
+                for ftype, fields in self._parser.feed(data):
+                    self._handle(ftype, fields)
+
+            now = self._now_us()
+            for axis, a in enumerate(self.axes):
+                self._step(axis, a, now)
+
+            if now - self._last_report >= self.report_interval * 1e6:
+                self._last_report = now
+                for axis, a in enumerate(self.axes):
+                    if a.busy:
+                        self._report(axis)
+
+    def _step(self, axis, a, now):
+        while a.block is not None or a.queue:
+            if a.block is None:
+                a.block = a.queue.popleft()
+                a.direction, a.remaining, a.interval, a.add, a.next_us = a.block
+
+            if a.next_us > now:
+                return
+
+            self.max_lateness = max(self.max_lateness, (now - a.next_us) / 1e6)
+            a.position += a.direction
+            self.steps += 1
+            if self.record:
+                self.pulses.append((axis, int(a.next_us) & CLOCK_MASK, a.direction))
+
+            a.remaining -= 1
+            if a.remaining:
+                a.next_us += a.interval
+                a.interval += a.add
+            else:
+                a.block = None
+                self._report(axis)
+
+    def _handle(self, ftype, fields):
+        if ftype == QUERY:
+            self._send(frame(CLOCK, int(self._now_us()) & CLOCK_MASK))
+            for axis in xrange(len(self.axes)):
+                self._report(axis)
+            return
+
+        axis = fields[0]
+        if axis >= len(self.axes):
+            self._send(frame(ERROR, axis, ERROR_BAD_AXIS))
+            return
+        a = self.axes[axis]
+
+        if ftype == QUEUE:
+            _, direction, count, interval, add, start, seq = fields
+            if len(a.queue) >= self.queue_size:
+                self._send(frame(ERROR, axis, ERROR_QUEUE_FULL))
+                return
+            now = self._now_us()
+            start_us = now + clock_diff(start, int(now) & CLOCK_MASK)
+            a.queue.append((direction, count, interval, add, start_us))
+            a.seq = seq
+            self._send(frame(ACK, axis, seq, self._free(a)))
+
+        elif ftype == FLUSH:
+            a.queue.clear()
+            a.block = None
+            self._report(axis)
+
+        elif ftype == SET_POSITION:
+            a.position = fields[1]
+            self._report(axis)
+
+    def _free(self, a):
+        return self.queue_size - len(a.queue)
+
+    def _report(self, axis):
+        a = self.axes[axis]
+        self._send(frame(POSITION, axis, a.position, int(a.busy), self._free(a),
+                         a.seq, int(self._now_us()) & CLOCK_MASK))
+
+    def _send(self, data):
+        os.write(self._master, data)
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Run the reference step-stream firmware on a pseudo-terminal',
+        add_help=True, prog='cookiebot_stepstream_emulator')
+
+    parser.add_argument(
+        '--axes', type=int, default=4,
+        help='Number of stepper axes to emulate')
+
+    parser.add_argument(
+        '--queue-size', type=int, default=16,
+        help='Motion blocks each axis can queue')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.DEBUG, format=displayformat, stream=sys.stdout)
+
+    args = opts().parse_args()
+
+    emulator = FirmwareEmulator(axes=args.axes, queue_size=args.queue_size)
+    logging.info('Step-stream firmware emulator listening on {0}'.format(emulator.port))
+
+    try:
+        while True:
+            time.sleep(5.0)
+            logging.info('{0} steps taken, worst lateness {1:.2f}ms'.format(
+                emulator.steps, emulator.max_lateness * 1e3))
+    except (KeyboardInterrupt, SystemExit):
+        logging.info('Stopping the emulator')
+    finally:
+        emulator.close()
+
+
+if __name__ == '__main__':
+    main()
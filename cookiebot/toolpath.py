@@ -0,0 +1,75 @@
+'''
+Created on Oct 18, 2026
+
+The path the nozzle follows for an icing pattern, for previews
+
+A Toolpath is worked out from the same steps IcingStage runs, so every
+pattern in data/icing_patterns gets a preview without anyone drawing one.
+Coordinates are pattern coordinates (inches, centred on the cookie), before
+IcingStage shifts them to a cookie position.
+'''
+from collections import namedtuple
+
+from cookiebot.stages import IcingStage, CompiledPattern
+
+# iced is True when icing flows during the move
+Segment = namedtuple('Segment', ['start', 'end', 'iced'])
+
+
+class Toolpath(object):
+    '''The carriage moves of a list of steps, and whether each one ices'''
+
+    _cache = {}
+
+    def __init__(self, steps, start=(0.0, 0.0)):
+        '''Trace steps (RecipeStep or {WrapperID: command} dictionaries)
+
+        The nozzle ices from a 'run' command until the move of the step that
+        turns it 'off' - that retraction is non-blocking, so the move that
+        goes with it is still iced
+        '''
+        self.segments = []
+
+        pos = start
+        running = False
+        for step in steps:
+            nozzle = step.get(IcingStage.WrapperID.nozzle)
+            iced = running or nozzle == 'run'
+            if nozzle is not None:
+                running = nozzle == 'run'
+
+            dest = step.get(IcingStage.WrapperID.carriage)
+            if dest is not None:
+                dest = (float(dest[0]), float(dest[1]))
+                if dest != pos:
+                    self.segments.append(Segment(pos, dest, iced))
+                pos = dest
+
+    @classmethod
+    def for_pattern(cls, filename):
+        '''The toolpath of a pattern file, relative to DATA_DIR
+
+        Toolpaths are traced from the stage's CompiledPattern, so the file
+        is parsed once for both, and cached until it changes
+        '''
+        pattern = CompiledPattern.load(filename)
+        cached = cls._cache.get(filename)
+        if cached is None or cached[0] is not pattern:
+            cached = (pattern, cls(pattern.steps))
+            cls._cache[filename] = cached
+        return cached[1]
+
+    @property
+    def bounds(self):
+        '''(xmin, ymin, xmax, ymax) of every point on the path'''
+        if not self.segments:
+            return (0.0, 0.0, 0.0, 0.0)
+
+        xs = [p[0] for s in self.segments for p in (s.start, s.end)]
+        ys = [p[1] for s in self.segments for p in (s.start, s.end)]
+        return (min(xs), min(ys), max(xs), max(ys))
+
+    def length(self, iced=True):
+        '''Total length of the iced (or, with iced=False, travel) moves'''
+        return sum(((s.end[0] - s.start[0]) ** 2 + (s.end[1] - s.start[1]) ** 2) ** 0.5
+                   for s in self.segments if s.iced == iced)
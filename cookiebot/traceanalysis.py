@@ -0,0 +1,220 @@
+'''
+Created on Oct 18, 2026
+
+Critical-path analysis of recorded stage traces (see cookiebot.tracing)
+
+Every moment of a recorded run is attributed to exactly one category:
+
+    carriage  - waiting on a blocking X/Y move
+    nozzle    - waiting on a blocking nozzle prime or retract
+    platform  - waiting on the platform to raise or lower
+    dispatch  - inside _check_recipe sending commands, plus the polling gap
+                between the actuators becoming ready and the next dispatch
+    idle      - polling gaps longer than idle_after (paused, waiting for an
+                operator) and time before the first or after the last step
+    other     - waiting on a blocking task on any other track, e.g. an
+                actuator added since TRACK_CATEGORIES was written
+
+Time spent on a step is also charged to the pattern file line it came from,
+so the worst lines of each icing file can be listed.
+'''
+import argparse
+import bisect
+import glob
+import json
+import sys
+from collections import defaultdict
+
+CATEGORIES = ('carriage', 'nozzle', 'platform', 'dispatch', 'idle', 'other')
+
+# task track name prefix -> category, see Actuator._trace_task
+TRACK_CATEGORIES = (
+    ('X-axis', 'carriage'),
+    ('Y-axis', 'carriage'),
+    ('Nozzle', 'nozzle'),
+    ('Platform', 'platform'),
+)
+
+
+class TraceAnalysis(object):
+    '''Accumulates time per category and per pattern line over many traces'''
+
+    def __init__(self, idle_after=1.0):
+        '''idle_after: longest polling gap (seconds) still counted as dispatch'''
+        self.idle_after = idle_after
+        self.totals = dict.fromkeys(CATEGORIES, 0.0)
+        self.lines = defaultdict(float)
+        self.traces = 0
+        self.steps = 0
+
+    @property
+    def total(self):
+        return sum(self.totals.values())
+
+    def add_file(self, path):
+        with open(path, 'r') as f:
+            self.add_trace(json.load(f))
+
+    def add_trace(self, trace):
+        '''Attribute the time in one Chrome trace dictionary'''
+        events = trace['traceEvents'] if isinstance(trace, dict) else trace
+
+        names = {}
+        dispatches = []
+        gaps = []
+        tasks = []
+        for e in events:
+            ph = e.get('ph')
+            if ph == 'M' and e.get('name') == 'thread_name':
+                names[e['tid']] = e['args']['name']
+            elif ph == 'X':
+                name = e['name']
+                if name == 'dispatch':
+                    dispatches.append(e)
+                elif name == 'dispatch gap':
+                    gaps.append(e)
+                elif name == 'task' and e.get('args', {}).get('blocking'):
+                    tasks.append(e)
+
+        if not dispatches:
+            return
+
+        dispatches.sort(key=lambda e: e['ts'])
+        gaps.sort(key=lambda e: e['ts'] + e['dur'])
+        gap_ends = [g['ts'] + g['dur'] for g in gaps]
+
+        tasks.sort(key=lambda e: e['ts'])
+        task_starts = [t['ts'] for t in tasks]
+
+        first = min(e['ts'] for e in events if e.get('ph') == 'X')
+        last = max(e['ts'] + e['dur'] for e in events if e.get('ph') == 'X')
+
+        # all times below are microseconds, converted to seconds in _charge
+        self._charge('idle', None, dispatches[0]['ts'] - first)
+        end_of_run = dispatches[0]['ts']
+
+        for i, d in enumerate(dispatches):
+            source = d.get('args', {}).get('source') or 'unknown'
+            d_end = d['ts'] + d['dur']
+            self._charge('dispatch', source, d['dur'])
+
+            # blocking tasks started by this dispatch; the last to finish is
+            # the one the next step was waiting on
+            lo = bisect.bisect_left(task_starts, d['ts'])
+            hi = bisect.bisect_right(task_starts, d_end)
+            critical = max(tasks[lo:hi], key=lambda t: t['ts'] + t['dur']) if hi > lo else None
+
+            if i + 1 < len(dispatches):
+                nxt = dispatches[i + 1]['ts']
+                # the gap drawn just before the next dispatch ends where it
+                # starts, give or take float rounding
+                g = bisect.bisect_left(gap_ends, nxt - 1)
+                if g < len(gaps) and abs(gap_ends[g] - nxt) < 1:
+                    ready = gaps[g]['ts']
+                else:
+                    ready = d_end
+            else:
+                ready = critical['ts'] + critical['dur'] if critical else d_end
+                nxt = ready
+
+            ready = min(max(ready, d_end), nxt)
+            if critical is not None:
+                self._charge(self._category(names.get(critical['tid'], '')),
+                             source, ready - d_end)
+            else:
+                self._charge('dispatch', source, ready - d_end)
+
+            gap = nxt - ready
+            if gap > self.idle_after * 1e6:
+                self._charge('idle', None, gap)
+            else:
+                self._charge('dispatch', source, gap)
+
+            end_of_run = nxt
+
+        self._charge('idle', None, max(0.0, last - end_of_run))
+        self.traces += 1
+        self.steps += len(dispatches)
+
+    def top_lines(self, count=5):
+        '''The count most expensive pattern lines of every icing file
+
+        Returns {filename: [(line, seconds), ...]}, most expensive first
+        '''
+        per_file = defaultdict(list)
+        for source, seconds in self.lines.items():
+            filename, _, line = source.rpartition(':')
+            if filename and line.isdigit():
+                per_file[filename].append((int(line), seconds))
+
+        return {f: sorted(lines, key=lambda l: -l[1])[:count]
+                for f, lines in per_file.items()}
+
+    def report(self, count=5):
+        '''A printable summary of the analysis'''
+        total = self.total or 1.0
+        out = ['{0} trace(s), {1} steps, {2:.1f}s total'.format(
+            self.traces, self.steps, self.total), '']
+
+        for cat in sorted(CATEGORIES, key=lambda c: -self.totals[c]):
+            out.append('{0:>10s} {1:10.2f}s {2:6.1%}'.format(
+                cat, self.totals[cat], self.totals[cat] / total))
+
+        for filename, lines in sorted(self.top_lines(count).items()):
+            out.append('')
+            out.append(filename)
+            for line, seconds in lines:
+                out.append('    line {0:4d} {1:10.2f}s {2:6.1%}'.format(
+                    line, seconds, seconds / total))
+
+        return '\n'.join(out)
+
+    def _charge(self, category, source, micros):
+        if micros <= 0:
+            return
+        seconds = micros / 1e6
+        self.totals[category] += seconds
+        if source is not None:
+            self.lines[source] += seconds
+
+    @staticmethod
+    def _category(track):
+        for prefix, category in TRACK_CATEGORIES:
+            if track.startswith(prefix):
+                return category
+        return 'other'
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Attribute recorded tray time to motion, nozzle, platform, dispatch and idle',
+        add_help=True, prog='cookiebot_trace_analysis')
+
+    parser.add_argument(
+        'traces', nargs='+',
+        help='Trace files saved with --trace (shell-style wildcards allowed)')
+
+    parser.add_argument(
+        '--top', type=int, default=5,
+        help='Number of pattern lines to list per icing file')
+
+    parser.add_argument(
+        '--idle-after', type=float, default=1.0,
+        help='Polling gaps longer than this many seconds are counted as idle')
+
+    return parser
+
+
+def main():
+    args = opts().parse_args()
+
+    analysis = TraceAnalysis(idle_after=args.idle_after)
+    for pattern in args.traces:
+        for path in sorted(glob.glob(pattern)) or [pattern]:
+            analysis.add_file(path)
+
+    sys.stdout.write(analysis.report(args.top) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+'''
+Created on Oct 18, 2026
+
+Low-overhead timing trace, exportable in Chrome trace (Perfetto) JSON format
+
+Events go into a preallocated ring buffer, so tracing can be left on for a
+whole shift: the oldest events are overwritten and memory use never grows.
+Every hook in cookiebot checks tracer.enabled first, so a disabled tracer
+costs one attribute lookup per call site.
+
+Open an exported file at https://ui.perfetto.dev or chrome://tracing
+'''
+import array
+import itertools
+import json
+import os
+import threading
+
+
+class TraceBuffer(object):
+    '''A fixed-size ring of complete ("X" phase) trace events
+
+    Each event has a name, a category, a track (the timeline row it is drawn
+    on - an actuator, a timer thread, the stage), a start time and duration
+    in seconds, and an optional dictionary of arguments
+    '''
+
+    def __init__(self, capacity=1 << 17, enabled=False):
+        self.capacity = capacity
+        self.enabled = enabled
+
+        self._names = [None] * capacity
+        self._cats = [None] * capacity
+        self._tracks = [None] * capacity
+        self._args = [None] * capacity
+        self._starts = array.array('d', [0.0]) * capacity
+        self._durs = array.array('d', [0.0]) * capacity
+
+        # which event each slot holds, set once the slot is fully written,
+        # so readers skip slots another thread is still filling in
+        self._seqs = array.array('l', [-1]) * capacity
+
+        # next() on a count is atomic under the GIL, so writers never wait
+        # for each other to claim a slot; only publishing the high-water
+        # mark, which step threads race on, takes the lock
+        self._counter = itertools.count()
+        self._written = 0
+        self._lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def clear(self):
+        with self._lock:
+            self._counter = itertools.count()
+            self._written = 0
+            self._seqs = array.array('l', [-1]) * self.capacity
+
+    def complete(self, name, cat, track, start, end, args=None):
+        '''Record a span that ran from start to end (time.time() values)'''
+        n = next(self._counter)
+        idx = n % self.capacity
+
+        self._names[idx] = name
+        self._cats[idx] = cat
+        self._tracks[idx] = track
+        self._args[idx] = args
+        self._starts[idx] = start
+        self._durs[idx] = end - start
+        self._seqs[idx] = n
+        with self._lock:
+            if n >= self._written:
+                self._written = n + 1
+
+    def __len__(self):
+        return min(self._written, self.capacity)
+
+    def events(self):
+        '''Yield (name, cat, track, start, duration, args), oldest first'''
+        written = self._written
+        first = max(0, written - self.capacity)
+
+        for n in xrange(first, written):
+            idx = n % self.capacity
+            if self._seqs[idx] != n:
+                # still being written, or already overwritten
+                continue
+            yield (self._names[idx], self._cats[idx], self._tracks[idx],
+                   self._starts[idx], self._durs[idx], self._args[idx])
+
+    def to_chrome(self):
+        '''Convert the buffer to a Chrome trace dictionary
+
+        Each track becomes its own named thread row; times are microseconds
+        from the oldest retained event
+        '''
+        events = list(self.events())
+        origin = min(e[3] for e in events) if events else 0.0
+        pid = os.getpid()
+
+        tids = {}
+        trace = []
+        for name, cat, track, start, dur, args in events:
+            if track not in tids:
+                tids[track] = len(tids) + 1
+                trace.append({'ph': 'M', 'name': 'thread_name', 'pid': pid,
+                              'tid': tids[track], 'args': {'name': str(track)}})
+
+            event = {'ph': 'X', 'name': name, 'cat': cat, 'pid': pid,
+                     'tid': tids[track],
+                     'ts': (start - origin) * 1e6, 'dur': dur * 1e6}
+            if args:
+                event['args'] = args
+            trace.append(event)
+
+        return {'traceEvents': trace, 'displayTimeUnit': 'ms',
+                'otherData': {'origin': origin}}
+
+    def export(self, path):
+        '''Write the buffer to path as Chrome trace JSON'''
+        with open(path, 'w') as f:
+            json.dump(self.to_chrome(), f)
+
+
+# Shared by every hook in cookiebot.  Set COOKIEBOT_TRACE=1 to start with
+# tracing on, or call tracer.enable()
+tracer = TraceBuffer(enabled=bool(os.environ.get('COOKIEBOT_TRACE')))
@@ -0,0 +1,261 @@
+'''
+Created on Oct 18, 2026
+
+Tray-time regression suite: whole trays through IcingStage, in virtual time
+
+Every tray runs through the real IcingStage, wrappers and StepperActuator
+state machine, but the actuators are SimulatedStepperActuators on a
+VirtualClock: instead of sleeping between steps, the clock jumps straight to
+the next moment a blocking task finishes.  Tray times are therefore exact
+and the same on every machine, and a whole tray takes well under a second.
+
+For every pattern (as a full 2x2 tray), a few mixed trays and a full 6x4
+tray, the suite
+records the simulated tray time, the final step position of every axis and
+the machine time spent dispatching each step, and compares them with the
+baselines in data/baselines/traytimes.json.  A tray that got slower or ends
+with an axis somewhere else fails; dispatch overhead is machine-dependent
+and only reported.
+
+    python -m cookiebot.traysim            compare with the baselines
+    python -m cookiebot.traysim --update   record new baselines
+'''
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+
+from cookiebot import hardware
+from cookiebot.actuators import Actuator, StepperActuator
+from cookiebot.layout import TrayLayout, load_layout
+from cookiebot.loadtest import build_trays
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage, DATA_DIR
+
+BASELINES = os.path.join(DATA_DIR, 'baselines', 'traytimes.json')
+
+# simulated times are exact, so anything beyond float noise is a change
+TOLERANCE = 1e-6
+
+MIXED_TRAYS = 3
+
+
+class VirtualClock(object):
+    '''Simulated seconds since the start of a run'''
+
+    def __init__(self):
+        self.now = 0.0
+
+
+class SimulatedStepperActuator(StepperActuator):
+    '''A StepperActuator whose steps happen on a VirtualClock
+
+    Its step thread is stopped for good; advance() fires the steps (and the
+    completion check) that are due by a given virtual time, exactly as the
+    step timer would have, one step interval apart starting with the
+    immediate step set_task takes
+    '''
+    drives_hat = False
+
+    def __init__(self, clock=None, **kwargs):
+        super(SimulatedStepperActuator, self).__init__(**kwargs)
+        self._timer.stop()
+        self.clock = clock or VirtualClock()
+        self._next_tick = None
+
+    def pause(self):
+        pass
+
+    def unpause(self):
+        pass
+
+    def set_task(self, task=None, blocking=False):
+        future = super(SimulatedStepperActuator, self).set_task(task, blocking)
+        self._next_tick = self.clock.now + self._timer.interval
+        return future
+
+    def busy(self, blocking_only=False):
+        if blocking_only:
+            return self.state == Actuator.State.executing_blocked
+        return self._is_executing()
+
+    def finish_time(self):
+        '''Virtual time at which the current task will be seen to finish'''
+        return self._next_tick + len(self._task) * self._timer.interval
+
+    def advance(self, until):
+        '''Run every tick due by virtual time until'''
+        while self._is_executing() and self._next_tick <= until + TOLERANCE:
+            self._run_execution()
+            self._next_tick += self._timer.interval
+
+
+def simulate(recipe, overrides=None, layout=None, subscriber=None):
+    '''Run recipe to completion in virtual time, at the given
+    IcingStage overrides and on the given tray layout, if any
+
+    subscriber, if given, is called with every event the stage publishes
+
+    Returns {'tray_time', 'steps', 'positions', 'dispatch_mean', 'live'}
+    '''
+    clock = VirtualClock()
+    stage = IcingStage(zero=False, actuator_class=SimulatedStepperActuator, clock=clock,
+                       overrides=overrides, layout=layout)
+    axes = stage._axes()
+    if subscriber is not None:
+        stage.events.subscribe(subscriber)
+
+    overhead = 0.0
+    try:
+        stage.load_recipe(recipe)
+        while stage.live and (stage.steps or not stage.recipe_done()):
+            remaining = len(stage.steps)
+            start = time.time()
+            stage._check_recipe()
+            if len(stage.steps) < remaining:
+                overhead += time.time() - start
+                continue
+
+            # nothing could be dispatched: jump to the next blocking task's end
+            blocked = [a.finish_time() for a in axes if a.busy(blocking_only=True)]
+            if not blocked:
+                raise RuntimeError('Simulated stage stuck with {0} steps left'.format(remaining))
+            clock.now = min(blocked)
+            for a in axes:
+                a.advance(clock.now)
+
+        tray_time = clock.now
+        stage._check_recipe()
+
+        # let background tasks (a retracting nozzle) settle before reading positions
+        while any(a.busy() for a in axes):
+            clock.now = min(a.finish_time() for a in axes if a.busy())
+            for a in axes:
+                a.advance(clock.now)
+
+        return {'tray_time': tray_time,
+                'steps': stage.step_index,
+                'positions': {str(a): a.step_pos for a in axes},
+                'dispatch_mean': overhead / stage.step_index if stage.step_index else 0.0,
+                'live': stage.live}
+    finally:
+        stage.shutdown()
+
+
+def trays():
+    '''{name: (Recipe, TrayLayout)} of every tray in the suite'''
+    suite = {}
+    square = TrayLayout()
+    for icing in Recipe.IcingType:
+        recipe = Recipe()
+        for pos in square.positions():
+            recipe.add_cookie({'icing': icing}, pos)
+        suite[icing.name] = (recipe, square)
+
+    for i, recipe in enumerate(build_trays(MIXED_TRAYS), 1):
+        suite['mixed-{0}'.format(i)] = (recipe, square)
+
+    large = load_layout('6x4')
+    for recipe in build_trays(1, layout=large):
+        suite['mixed-6x4'] = (recipe, large)
+    return suite
+
+
+def run_suite(names=None):
+    '''{tray name: simulate() result} for the named trays (default all)'''
+    hardware.select('none')
+    return {name: simulate(recipe, layout=layout)
+            for name, (recipe, layout) in sorted(trays().items())
+            if not names or name in names}
+
+
+def compare(results, baselines):
+    '''Lines describing every regression of results against baselines'''
+    problems = []
+    for name, result in sorted(results.items()):
+        base = baselines.get(name)
+        if base is None:
+            problems.append('{0}: no baseline'.format(name))
+            continue
+
+        if not result['live']:
+            problems.append('{0}: stage died'.format(name))
+        if result['tray_time'] > base['tray_time'] + TOLERANCE:
+            problems.append('{0}: tray time {1:.3f}s -> {2:.3f}s (+{3:.2%})'.format(
+                name, base['tray_time'], result['tray_time'],
+                result['tray_time'] / base['tray_time'] - 1))
+        for axis, pos in sorted(result['positions'].items()):
+            if base['positions'].get(axis) != pos:
+                problems.append('{0}: {1} ends at step {2}, was {3}'.format(
+                    name, axis, pos, base['positions'].get(axis)))
+    return problems
+
+
+def load_baselines(path=BASELINES):
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_baselines(results, path=BASELINES):
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    # dispatch overhead depends on the machine, so it is not a baseline
+    stored = {name: {k: v for k, v in r.items() if k in ('tray_time', 'steps', 'positions')}
+              for name, r in results.items()}
+    with open(path, 'w') as f:
+        json.dump(stored, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Check simulated tray times and final positions against stored baselines',
+        add_help=True, prog='cookiebot_traysim')
+
+    parser.add_argument(
+        'trays', nargs='*', default=[],
+        help='Trays to run: pattern names from Recipe.IcingType, mixed-N or mixed-6x4.  Default all')
+
+    parser.add_argument(
+        '--baselines', default=BASELINES,
+        help='Baseline file to compare with (or write, with --update)')
+
+    parser.add_argument(
+        '--update', action='store_true',
+        help='Record these results as the new baselines instead of comparing')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+    logging.getLogger('cookiebot').setLevel(logging.WARNING)
+
+    args = opts().parse_args()
+    results = run_suite(args.trays)
+
+    for name, r in sorted(results.items()):
+        logging.info('{0:>14s} {1:9.2f}s {2:6.1f} trays/h {3:4d} steps, {4:6.1f}us dispatch'.format(
+            name, r['tray_time'], 3600.0 / r['tray_time'], r['steps'], r['dispatch_mean'] * 1e6))
+
+    if args.update:
+        baselines = load_baselines(args.baselines) if os.path.exists(args.baselines) else {}
+        baselines.update(results)
+        save_baselines(baselines, args.baselines)
+        logging.info('Saved baselines to {0}'.format(args.baselines))
+        return
+
+    problems = compare(results, load_baselines(args.baselines))
+    for line in problems:
+        logging.error(line)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
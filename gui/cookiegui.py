@@ -3,25 +3,34 @@ Created on Jan 29, 2016
 
 @author: justinpalpant
 '''
+import time
+STARTED = time.time()
+
 # You need these things and probably don't have them
 from PyQt4 import QtGui, QtCore
 from PyQt4.QtCore import pyqtSignal, QRectF
-from PyQt4.QtGui import QGraphicsScene, QPixmap
-from PyQt4.uic import loadUiType
 import sys
 import logging
+import copy
 import datetime
 import os
 
 from cookiebot.recipe import Recipe, RecipeError
 from cookiebot.stages import IcingStage
-from cookiebot.multithreading import RepeatedTimer
-from threadsafety import OutLog, SignalStream
+from cookiebot import control, logsetup, metrics, profiler
+from cookiebot.layout import load_layout, DEFAULT as DEFAULT_LAYOUT
+from cookiebot.multithreading import format_timing_stats
+from preview import PreviewRenderer, NozzleOverlay
+from uicache import load_ui_type
+from threadsafety import (OutLog, ConsoleHandler, SignalStream, StageEventRelay,
+                          CommandRunner)
 
 MAIN_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
 DATA_DIR = os.path.join(MAIN_DIR, 'data')
 GUI_DIR = os.path.join(MAIN_DIR, 'gui')
-Ui_MainWindow, QMainWindow = loadUiType(os.path.join(GUI_DIR, 'main.ui'))
+# name of the tray layout (see cookiebot.layout) to show and ice
+LAYOUT_ENVIRONMENT = 'COOKIEBOT_TRAY_LAYOUT'
+Ui_MainWindow, QMainWindow = load_ui_type(os.path.join(GUI_DIR, 'main.ui'))
 
 
 class CookieGUI(Ui_MainWindow, QMainWindow):
@@ -57,23 +66,29 @@ class CookieGUI(Ui_MainWindow, QMainWindow):
         sys.stdout = self.printstream
         sys.stderr = self.printstream
         self.printstream.write_signal.connect(self.print_to_gui)
-        screen_handler = logging.StreamHandler(stream=self.printstream)
+        screen_handler = ConsoleHandler(self.printerbox)
         screen_format = logging.Formatter(fmt='%(asctime)s - %(message)s')
         screen_handler.setLevel(logging.INFO)
         screen_handler.setFormatter(screen_format)
         self.logger.addHandler(screen_handler)
-
-        self.logger.setLevel(logging.DEBUG)
+        # written to the console by the logging thread, not the one logging
+        logsetup.install('cookiebot')
 
         self.logger.info('Start of program execution '
                          '{0}'.format(datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
 
         self.recipe = Recipe()
-        self.stage = IcingStage(zero=False, actuators=[0, 1, 2])
-
-        self.positions = [(0, 0), (1, 0), (0, 1), (1, 1)]
-        self.q_image_displays = [
-            self.image_00, self.image_10, self.image_01, self.image_11]
+        self.tray_layout = load_layout(os.environ.get(LAYOUT_ENVIRONMENT, DEFAULT_LAYOUT))
+        self.stage = IcingStage(zero=False, actuators=[0, 1, 2], layout=self.tray_layout)
+
+        # one preview per slot, laid out like the tray
+        self.positions = self.tray_layout.positions()
+        self.q_image_displays = []
+        for pos in self.positions:
+            view = QtGui.QGraphicsView(self.centralwidget)
+            self.tray_grid.addWidget(view, pos[1], pos[0])
+            self.q_image_displays.append(view)
+            self.pos_select.addItem(str(pos))
 
         self.icings = [
             Recipe.IcingType.d_outline,
@@ -85,19 +100,77 @@ class CookieGUI(Ui_MainWindow, QMainWindow):
             Recipe.IcingType.blue_devil
         ]
 
-        self.pattern_images = [
-            Recipe.IcingImage.d_outline,
-            Recipe.IcingImage.u_outline,
-            Recipe.IcingImage.k_outline,
-            Recipe.IcingImage.e_outline,
-            Recipe.IcingImage.square,
-            Recipe.IcingImage.spiral_square,
-            Recipe.IcingImage.blue_devil
-        ]
-
-        self.pbar_timer = RepeatedTimer(0.25, self._update_progress_bar, start=False)
+        # previews are drawn from the patterns, and follow the nozzle
+        self.previews = PreviewRenderer()
+        self.nozzle_overlay = NozzleOverlay(
+            self.stage, self.previews,
+            dict(zip(self.positions, self.q_image_displays)))
+
+        # what the GUI knows of the stage, from its own commands and the
+        # relayed events - the stage is never polled from this thread
+        self._stage_live = True
+        self._recipe_unfinished = False
+
+        self.stage_events = StageEventRelay(self.stage.events)
+        self.stage_events.progress.connect(self._update_progress_bar)
+        self.stage_events.cookie_finished.connect(self._cookie_finished)
+        self.stage_events.actuator_fault.connect(self._actuator_fault)
+        self.stage_events.recipe_finished.connect(self._recipe_finished)
+        self.stage_events.override_changed.connect(self._override_changed)
+
+        self._add_override_controls()
+
+        # SIGUSR1 profiles every thread, GUI included; the console flush
+        # timer lets Python run the handler while Qt waits for events
+        profiler.install(self.stage)
+
+        self.control_server = None
+        if os.environ.get(control.ENVIRONMENT):
+            self.control_server = control.ControlServer(
+                self.stage, int(os.environ[control.ENVIRONMENT]))
+
+        self.metrics_server = None
+        if os.environ.get(metrics.ENVIRONMENT):
+            host, port = metrics.parse_address(os.environ[metrics.ENVIRONMENT])
+            self.metrics_server = metrics.MetricsServer(port=port, host=host)
+
+        # anything that loads files or joins threads runs here, off the GUI thread
+        self.commands = CommandRunner()
+        self.commands.busy.connect(self._command_busy)
+        self.commands.finished.connect(self._command_finished)
+        self.commands.failed.connect(self._command_failed)
 
         self.show()
+        # runs once the first frame has been drawn
+        QtCore.QTimer.singleShot(0, self._first_paint)
+
+    def _add_override_controls(self):
+        '''A row of percentage boxes, one per live override, under the buttons'''
+        row = QtGui.QHBoxLayout()
+        self.override_boxes = {}
+        low, high = IcingStage.OVERRIDE_LIMITS
+
+        for name in IcingStage.OVERRIDES:
+            box = QtGui.QSpinBox(self.centralwidget)
+            box.setRange(int(low * 100), int(high * 100))
+            box.setSingleStep(5)
+            box.setSuffix('%')
+            box.setValue(int(round(self.stage.overrides[name] * 100)))
+            # only apply typed values once they are finished
+            box.setKeyboardTracking(False)
+            box.valueChanged[int].connect(
+                lambda value, name=name: self._override_box_changed(name, value))
+
+            row.addWidget(QtGui.QLabel(name.capitalize(), self.centralwidget))
+            row.addWidget(box)
+            self.override_boxes[name] = box
+
+        row.addStretch()
+        # below the start/stop row, above the console
+        self.verticalLayout_3.insertLayout(3, row)
+
+    def _first_paint(self):
+        self.logger.info('Window ready {0:.2f}s after start'.format(time.time() - STARTED))
 
     @QtCore.pyqtSlot(str)
     def print_to_gui(self, text):
@@ -109,27 +182,22 @@ class CookieGUI(Ui_MainWindow, QMainWindow):
         self.printerbox.write(text)
 
     def _run_click_callback(self):
-        if self.stage.live:
-            if self.stage.recipe_done():
+        if self._stage_live:
+            if not self._recipe_unfinished:
                 self.logger.info('Starting a new recipe!')
-                try:
-                    self.stage.load_recipe(self.recipe)
-                    self.num_steps = float(len(self.stage.steps))
-                except (RecipeError, IOError) as e:
-                    logging.error(
-                        'Something is wrong with that recipe file! Shutting down.')
-                    self.stage.shutdown()
-                    raise e
-                #self.pbar_timer.restart()
+                self.progress_bar.setValue(0)
+                self._recipe_unfinished = True
+                self.commands.submit('load', self._load_and_start,
+                                     copy.deepcopy(self.recipe))
             else:
                 self.logger.info('Rebooting the recipe that was running')
-            self.stage.start_recipe()
+                self.commands.submit('start', self.stage.start_recipe)
         else:
             self.logger.info(
                 'Stage is dead, cannot do anything.  Please exit.')
 
     def _add_cookie_callback(self):
-        if self.stage.live:
+        if self._stage_live:
             cookie_idx = self.cookie_select.currentIndex()
             pos_idx = self.pos_select.currentIndex()
 
@@ -138,60 +206,129 @@ class CookieGUI(Ui_MainWindow, QMainWindow):
             self.recipe.add_cookie(
                 {'icing': self.icings[cookie_idx]}, self.positions[pos_idx])
 
-            image = self.q_image_displays[pos_idx]
-
-            scene = QGraphicsScene()
-            scene.addPixmap(
-                QPixmap(os.path.join(DATA_DIR, self.pattern_images[cookie_idx].value)))
-            image.setScene(scene)
-            image.fitInView(scene.itemsBoundingRect())
-
-            image.show()
+            self.nozzle_overlay.show(
+                self.positions[pos_idx], self.icings[cookie_idx].value)
 
         else:
             self.logger.info(
                 'Stage is dead, cannot do anything.  Please exit.')
 
     def _reset_recipe_callback(self):
-        if self.stage.live:
+        if self._stage_live:
             self.recipe = Recipe()
-            if self.stage.steps:
-                self.stage.steps = []
-                
-            for image in self.q_image_displays:
-                image.setScene(QGraphicsScene())
+            self.stage.clear_recipe()
+            self._recipe_unfinished = False
+            self.progress_bar.setValue(0)
+
+            self.nozzle_overlay.clear()
 
             self.logger.info('Recipe cleared')
         else:
             self.logger.info(
                 'Stage is dead, cannot do anything.  Please exit.')
 
+    def _override_box_changed(self, name, value):
+        # cheap and thread-safe, so not queued behind a slow command
+        self.stage.set_override(name, value / 100.0)
+
+    def _override_changed(self, event):
+        '''Keep the boxes in step with overrides set from anywhere'''
+        box = self.override_boxes[event.name]
+        box.blockSignals(True)
+        box.setValue(int(round(event.factor * 100)))
+        box.blockSignals(False)
+
     def _cancel_execution_callback(self):
-        if self.stage.live and not self.stage.recipe_done():
+        if self._stage_live and self._recipe_unfinished:
             self.logger.info('Pausing recipe execution')
-            self.stage.stop_recipe()
-            self.logger.info('Recipe execution paused')
+            self.commands.submit('pause', self._stop_and_time, self.stage.stop_recipe)
 
     def _shutdown_stage_callback(self):
         self.logger.warning('Terminating the icing stage')
-        self.stage.shutdown()
-        self.logger.warning('Stage terminated.  Please exit.')
+        self._stage_live = False
+        # an emergency stop: never queued behind a load or a pause
+        self.commands.preempt('shutdown', self._stop_and_time, self.stage.shutdown)
+
+    # these run on the command thread
+
+    def _load_and_start(self, recipe):
+        self.stage.load_recipe(recipe)
+        # does nothing if terminate ran while the recipe loaded
+        self.stage.start_recipe()
+
+    def _stop_and_time(self, stop):
+        stop()
+        return format_timing_stats(self.stage.timing_stats())
+
+    # and these on the GUI thread, when a command is done
+
+    def _command_busy(self, busy):
+        # terminate stays enabled: it pre-empts whatever is running
+        for button in (self.start_button, self.stop_button,
+                       self.add_cookie_button, self.clear_recipe_button):
+            button.setEnabled(not busy)
+
+    def _command_finished(self, name, result):
+        if name == 'pause':
+            self.logger.info('Recipe execution paused')
+        elif name == 'shutdown':
+            self.logger.warning('Stage terminated.  Please exit.')
+
+        if name in ('pause', 'shutdown'):
+            self.logger.info('Step timing:\n' + result)
+
+    def _command_failed(self, name, error):
+        if name == 'load':
+            self._recipe_unfinished = False
+        if name == 'load' and isinstance(error, (RecipeError, IOError)):
+            self.logger.error(
+                'Something is wrong with that recipe file! Shutting down.')
+            self._stage_live = False
+            self.commands.submit('shutdown', self._stop_and_time, self.stage.shutdown)
+        self.logger.error('Stage command {0} failed: {1}'.format(name, error))
         
-    def _update_progress_bar(self):
-        fraction_to_go = len(self.stage.steps) / self.num_steps if self.num_steps else 1
-        self.progress_bar.setValue(100*(1-fraction_to_go))
+    def _update_progress_bar(self, progress):
+        self.progress_bar.setValue(int(100 * progress.fraction))
+        if progress.eta is not None:
+            self.progress_bar.setFormat('%p% - {0:.0f}s left'.format(progress.eta))
+        else:
+            self.progress_bar.setFormat('%p%')
+
+    def _cookie_finished(self, event):
+        self.logger.info('Finished the cookie at {0}'.format(event.position))
+
+    def _actuator_fault(self, event):
+        self._stage_live = False
+        self.logger.error('Stage stopped by a fault: {0}'.format(event.error))
+
+    def _recipe_finished(self, event):
+        self._recipe_unfinished = False
+        self.progress_bar.setFormat('%p%')
+        self.logger.info('Recipe of {0} steps finished in {1:.0f} seconds'.format(
+            event.steps, event.elapsed))
+        trays = metrics.registry.get('cookiebot_tray_seconds').value()
+        if trays['mean']:
+            self.logger.info('{0} trays this session, {1:.1f} trays/hour on average'.format(
+                trays['count'], 3600.0 / trays['mean']))
 
     def closeEvent(self, event):
         self.logger.info("User has clicked the red x on the main window")
-        self.stage.shutdown()
-        self.pbar_timer.stop()
+        self.nozzle_overlay.stop()
+        if self.control_server is not None:
+            self.control_server.close()
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+        self.commands.submit('shutdown', self.stage.shutdown)
+        self.commands.close()
+        self.stage_events.close()
         event.accept()
 
 def main():
     displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
 
     logging.basicConfig(
-        level=logging.DEBUG, format=displayformat, stream=sys.stdout)
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+    logsetup.install()
 
     app = QtGui.QApplication(sys.argv)
 
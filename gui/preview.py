@@ -0,0 +1,141 @@
+'''
+Created on Oct 18, 2026
+
+Cookie previews drawn from the icing patterns themselves, with the nozzle
+shown live on the cookie being iced
+'''
+from PyQt4 import QtCore
+from PyQt4.QtCore import QObject, QTimer, QPointF, QRectF, Qt
+from PyQt4.QtGui import (QPixmap, QPainter, QPen, QColor, QBrush,
+                         QGraphicsScene)
+
+from cookiebot.toolpath import Toolpath
+
+
+class PreviewRenderer(object):
+    '''Renders a pattern's toolpath to a QPixmap, once per pattern
+
+    Iced moves are drawn solid and travel moves faint and dashed.
+    to_scene() maps pattern coordinates onto the pixmap, for overlays
+    '''
+
+    ICED = QColor(30, 60, 200)
+    TRAVEL = QColor(170, 170, 170)
+
+    def __init__(self, size=240, margin=12):
+        self.size = size
+        self.margin = margin
+        self._pixmaps = {}
+
+    def pixmap(self, filename):
+        '''The cached preview of the pattern file filename'''
+        path = Toolpath.for_pattern(filename)
+        cached = self._pixmaps.get(filename)
+        if cached is None or cached[0] is not path:
+            cached = (path, self._render(path))
+            self._pixmaps[filename] = cached
+        return cached[1]
+
+    def to_scene(self, filename, point):
+        '''Where pattern point (x, y) is drawn on filename's pixmap'''
+        return self._transform(Toolpath.for_pattern(filename))(point)
+
+    def _transform(self, path):
+        xmin, ymin, xmax, ymax = path.bounds
+        span = max(xmax - xmin, ymax - ymin) or 1.0
+        scale = (self.size - 2 * self.margin) / span
+        # centre the path, with +y up as on the stage
+        cx, cy = (xmin + xmax) / 2.0, (ymin + ymax) / 2.0
+        half = self.size / 2.0
+        return lambda p: QPointF(half + (p[0] - cx) * scale, half - (p[1] - cy) * scale)
+
+    def _render(self, path):
+        pixmap = QPixmap(self.size, self.size)
+        pixmap.fill(Qt.white)
+        transform = self._transform(path)
+
+        iced = QPen(self.ICED, 2.5)
+        iced.setCapStyle(Qt.RoundCap)
+        travel = QPen(self.TRAVEL, 1, Qt.DashLine)
+
+        painter = QPainter(pixmap)
+        painter.setRenderHint(QPainter.Antialiasing)
+        for segment in path.segments:
+            painter.setPen(iced if segment.iced else travel)
+            painter.drawLine(transform(segment.start), transform(segment.end))
+        painter.end()
+
+        return pixmap
+
+
+class NozzleOverlay(QObject):
+    '''Moves a marker over the preview of the cookie being iced
+
+    Polls stage.pattern_position(), which only reads axis positions, every
+    interval_ms (20 Hz by default) on the GUI thread.  views maps cookie
+    positions to QGraphicsViews; show() tells the overlay which pattern a
+    view is displaying
+    '''
+
+    def __init__(self, stage, renderer, views, interval_ms=50, radius=5):
+        super(NozzleOverlay, self).__init__()
+        self.stage = stage
+        self.renderer = renderer
+        self.views = views
+        self.radius = radius
+
+        self._patterns = {}
+        self._markers = {}
+        self._visible = None
+
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self._update)
+        self.timer.start()
+
+    def show(self, cookie, filename):
+        '''Display filename's preview in cookie's view, with a hidden marker'''
+        view = self.views[cookie]
+
+        scene = QGraphicsScene()
+        scene.addPixmap(self.renderer.pixmap(filename))
+        r = self.radius
+        marker = scene.addEllipse(QRectF(-r, -r, 2 * r, 2 * r),
+                                  QPen(Qt.black), QBrush(QColor(230, 40, 40)))
+        marker.setZValue(1)
+        marker.hide()
+
+        view.setScene(scene)
+        view.fitInView(QRectF(0, 0, self.renderer.size, self.renderer.size),
+                       Qt.KeepAspectRatio)
+        view.show()
+
+        self._patterns[cookie] = filename
+        self._markers[cookie] = marker
+        if self._visible == cookie:
+            self._visible = None
+
+    def clear(self):
+        for view in self.views.values():
+            view.setScene(QGraphicsScene())
+        self._patterns = {}
+        self._markers = {}
+        self._visible = None
+
+    def stop(self):
+        self.timer.stop()
+
+    @QtCore.pyqtSlot()
+    def _update(self):
+        cookie, point = self.stage.pattern_position()
+
+        if cookie != self._visible and self._visible in self._markers:
+            self._markers[self._visible].hide()
+        self._visible = cookie
+
+        if cookie not in self._markers:
+            return
+
+        marker = self._markers[cookie]
+        marker.setPos(self.renderer.to_scene(self._patterns[cookie], point))
+        marker.show()
@@ -0,0 +1,113 @@
+'''
+Created on Oct 18, 2026
+
+Startup-time benchmark: how long until the GUI can be used
+
+Every phase runs in a fresh interpreter, so each run pays for its imports
+the way a real launch does.  Each phase reports the seconds from its first
+line to the point being measured, and the wall time of the whole process,
+interpreter start-up and clean-up included.  Phases that need PyQt4 are
+skipped where it is not installed.
+'''
+import argparse
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+MAIN_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+PREAMBLE = 'import time\nt0 = time.time()\n'
+MEASURED = '\nelapsed = time.time() - t0\n'
+REPORT = '\nprint(repr(elapsed))\n'
+
+# (name, measured code, untimed clean-up, needs PyQt4)
+PHASES = [
+    ('python', 'pass', '', False),
+    ('import cookiebot', 'import cookiebot.stages', '', False),
+    ('import gui', 'import gui.cookiegui', '', True),
+    ('first paint', '''
+from PyQt4 import QtGui, QtCore
+app = QtGui.QApplication([])
+from gui.cookiegui import CookieGUI
+window = CookieGUI()
+QtCore.QTimer.singleShot(0, app.quit)
+app.exec_()
+''', 'window.close()', True),
+]
+
+
+def has_qt():
+    try:
+        import PyQt4  # @UnusedImport
+    except ImportError:
+        return False
+    return True
+
+
+def run_phase(code, cleanup, runs, python=sys.executable):
+    '''Median seconds the snippet code took, and median process wall time,
+    over runs fresh interpreters'''
+    env = dict(os.environ, PYTHONPATH=MAIN_DIR, COOKIEBOT_HARDWARE='none')
+    measured = []
+    process = []
+    for _ in xrange(runs):
+        start = time.time()
+        out = subprocess.check_output(
+            [python, '-c', PREAMBLE + code + MEASURED + cleanup + REPORT],
+            cwd=MAIN_DIR, env=env)
+        process.append(time.time() - start)
+        measured.append(float(out.strip().splitlines()[-1]))
+
+    median = lambda values: sorted(values)[len(values) // 2]
+    return {'measured': median(measured), 'process': median(process)}
+
+
+def opts():
+    parser = argparse.ArgumentParser(
+        description='Measure import and first-paint time of the GUI',
+        add_help=True, prog='cookiebot_startup_benchmark')
+
+    parser.add_argument(
+        '--runs', type=int, default=5,
+        help='Fresh interpreters to start per phase; the median is reported')
+
+    parser.add_argument(
+        '--save', default=None,
+        help='Append the results to this JSON file, to track them over time')
+
+    return parser
+
+
+def main():
+    displayformat = '%(levelname)s: %(asctime)s from %(name)s in %(funcName)s: %(message)s'
+
+    logging.basicConfig(
+        level=logging.INFO, format=displayformat, stream=sys.stdout)
+
+    args = opts().parse_args()
+    qt = has_qt()
+
+    results = {}
+    for name, code, cleanup, needs_qt in PHASES:
+        if needs_qt and not qt:
+            logging.info('Skipping {0}: PyQt4 is not installed'.format(name))
+            continue
+        results[name] = run_phase(code, cleanup, args.runs)
+        logging.info('{0:>16s} {1:8.1f}ms ({2:.1f}ms with the interpreter)'.format(
+            name, results[name]['measured'] * 1e3, results[name]['process'] * 1e3))
+
+    if args.save:
+        history = []
+        if os.path.exists(args.save):
+            with open(args.save, 'r') as f:
+                history = json.load(f)
+        history.append(results)
+        with open(args.save, 'w') as f:
+            json.dump(history, f, indent=1)
+
+
+if __name__ == '__main__':
+    main()
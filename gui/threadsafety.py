@@ -7,6 +7,12 @@ from PyQt4 import QtCore, QtGui
 from PyQt4.QtCore import QThread, QObject, QTimer, QMutex, QMutexLocker
 from PyQt4.QtCore import pyqtSignal, pyqtSlot
 import collections
+import logging
+import time
+import Queue
+
+from cookiebot.events import (StepStarted, StepFinished, CookieFinished,
+                              ActuatorFault, Progress, RecipeFinished, OverrideChanged)
 
 class BGThread(QThread):
     '''
@@ -34,6 +40,100 @@ class BGThread(QThread):
         self._function()
 
 
+class CommandRunner(QObject):
+    '''Runs slow stage commands one at a time on a BGThread
+
+    submit() returns immediately; started, finished and failed are emitted
+    for every command (finished with the command's return value, failed with
+    the exception it raised), and busy whenever the runner goes from idle to
+    busy or back.  Connected slots on the GUI thread run there, queued, so
+    the window keeps redrawing while a recipe loads or the stage shuts down
+
+    preempt() is for stopping the machine: it never waits behind another
+    command
+    '''
+
+    started = pyqtSignal(str)
+    finished = pyqtSignal(str, object)
+    failed = pyqtSignal(str, object)
+    busy = pyqtSignal(bool)
+
+    def __init__(self):
+        super(CommandRunner, self).__init__()
+        self.pending = 0
+        self._commands = Queue.Queue()
+
+        self.finished.connect(self._command_done)
+        self.failed.connect(self._command_done)
+
+        self.thread = BGThread(self._work, name='stage commands')
+        self.thread.start()
+        self._preempting = []
+
+    def submit(self, name, fn, *args):
+        '''Queue fn(*args) to run after every command already submitted'''
+        self.pending += 1
+        if self.pending == 1:
+            self.busy.emit(True)
+        self._commands.put((name, fn, args))
+
+    def preempt(self, name, fn, *args):
+        '''Run fn(*args) straight away on its own thread, alongside any
+        command already running, and drop every queued command (each is
+        reported as failed)'''
+        dropped = []
+        while True:
+            try:
+                command = self._commands.get_nowait()
+            except Queue.Empty:
+                break
+            if command is None:
+                # close() has been called; the thread must still see it
+                self._commands.put(None)
+                break
+            dropped.append(command[0])
+
+        self.pending += 1
+        if self.pending == 1:
+            self.busy.emit(True)
+        for other in dropped:
+            self.failed.emit(other, RuntimeError('dropped for {0}'.format(name)))
+
+        thread = BGThread(lambda: self._run((name, fn, args)), name=name)
+        self._preempting.append(thread)
+        thread.start()
+
+    def close(self):
+        '''Finish the queued commands, then stop the thread'''
+        self._commands.put(None)
+        self.thread.wait()
+        for thread in self._preempting:
+            thread.wait()
+
+    def _work(self):
+        while True:
+            command = self._commands.get()
+            if command is None:
+                return
+            self._run(command)
+
+    def _run(self, command):
+        name, fn, args = command
+        self.started.emit(name)
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self.failed.emit(name, e)
+        else:
+            self.finished.emit(name, result)
+
+    @pyqtSlot(str, object)
+    def _command_done(self, name, result):
+        self.pending -= 1
+        if not self.pending:
+            self.busy.emit(False)
+
+
 class SignalStream(QObject):
     '''SignalStream is a file-like object that emits a text signal on writing
 
@@ -92,62 +192,238 @@ class SignalStream(QObject):
         '''Alter the pbar_timer period'''
         self.pbar_timer.setInteval(interval_ms)
         
-class OutLog:
-    '''OutLog pipes output from a stream to a QTextEdit widget
+class LineBuffer(object):
+    '''Assembles written text into lines, keeping at most max_lines of them
+
+    Text is handled a chunk at a time: a carriage return means the rest of
+    the line replaces what came before it, as on a terminal, so progress
+    output that rewrites one line stays one line.  take() returns the lines
+    completed since the last take(), the unfinished line (or None) and how
+    many completed lines were dropped because more than max_lines arrived
+    in between.  Not threadsafe by itself - OutLog locks around it
     '''
 
-    def __init__(self, edit, interval_ms=200):
-        """
+    def __init__(self, max_lines=5000):
+        self.lines = collections.deque(maxlen=max_lines)
+        self.partial = ''
+        self.returned = False
+        self.dropped = 0
+
+    def write(self, text):
+        segments = text.split('\n')
+        for segment in segments[:-1]:
+            self._append(segment)
+            self._complete()
+        self._append(segments[-1])
+
+    def write_line(self, line):
+        '''Add one finished line that is known to hold no control characters'''
+        if self.partial or self.returned:
+            self._complete()
+        self._complete(line)
+
+    def take(self):
+        lines = list(self.lines)
+        self.lines.clear()
+        dropped, self.dropped = self.dropped, 0
+        return lines, self.partial or None, dropped
+
+    def _append(self, segment):
+        if '\r' not in segment:
+            if self.returned and segment:
+                self.partial = segment
+                self.returned = False
+            else:
+                self.partial += segment
+            return
+
+        pieces = segment.split('\r')
+        self._append(pieces[0])
+        for piece in pieces[1:]:
+            self.returned = True
+            self._append(piece)
+
+    def _complete(self, line=None):
+        if line is None:
+            line, self.partial, self.returned = self.partial, '', False
+        if len(self.lines) == self.lines.maxlen:
+            self.dropped += 1
+        self.lines.append(line)
+
+
+class OutLog(QObject):
+    '''OutLog pipes output from a stream to a QPlainTextEdit widget
+
+    write() may be called from any thread and only buffers text; every
+    interval_ms the buffered lines are added to the widget in one insert on
+    the thread that created the OutLog (create it on the GUI thread).  The
+    widget keeps the last max_lines lines, and at most max_lines are
+    buffered between updates, so a flood of output costs a bounded amount of
+    memory and one redraw per interval
+    '''
 
-        """
-        self.mutex = QtCore.QMutex()
-        self.flag = False
+    def __init__(self, edit, interval_ms=200, max_lines=5000):
+        super(OutLog, self).__init__()
+        self.mutex = QMutex()
 
         self.edit = edit
-        self.cache = collections.deque()
+        self.edit.setMaximumBlockCount(max_lines)
+        self.buffer = LineBuffer(max_lines)
 
-        self.thread = QtCore.QThread()
-        self.pbar_timer = QtCore.QTimer()
-        self.pbar_timer.moveToThread(self.thread)
-        self.pbar_timer.setInterval(interval_ms)
-        self.pbar_timer.timeout.connect(self.flush)
-        self.thread.started.connect(self.pbar_timer.start)
-        self.thread.start()
+        # whether the widget's last line is unfinished, to be replaced
+        self._showing_partial = False
 
-    def __del__(self):
-        self.thread.quit()
-        self.thread.wait()
+        self.timer = QTimer(self)
+        self.timer.setInterval(interval_ms)
+        self.timer.timeout.connect(self._update)
+        self.timer.start()
 
     def write(self, m):
-        locker = QtCore.QMutexLocker(self.mutex)
+        locker = QMutexLocker(self.mutex)
+        self.buffer.write(str(m))
 
-        for char in str(m):
-            if char == '\r':
-                if not self.flag:
-                    self.edit.moveCursor(
-                        QtGui.QTextCursor.StartOfLine,
-                        mode=QtGui.QTextCursor.KeepAnchor
-                    )
-                    self.flag = True
+    def write_line(self, line):
+        locker = QMutexLocker(self.mutex)
+        self.buffer.write_line(line)
 
-                while char != '\n' and self.cache:
-                    char = self.cache.pop()
+    def flush(self):
+        '''Output is shown by the timer; present for file-like callers'''
+        pass
 
-                if char == '\n':
-                    self.cache.append('\n')
+    @pyqtSlot()
+    def _update(self):
+        locker = QMutexLocker(self.mutex)
+        lines, partial, dropped = self.buffer.take()
+        locker.unlock()
 
-            else:
-                self.cache.append(char)
+        if not lines and partial is None and not self._showing_partial:
+            return
 
-    @QtCore.pyqtSlot()
-    def flush(self):
-        locker = QtCore.QMutexLocker(self.mutex)
-        if self.flag:
-            self.edit.textCursor().removeSelectedText()
-            self.flag = False
-
-        if self.cache:
-            self.edit.moveCursor(QtGui.QTextCursor.End)
-            self.edit.insertPlainText(''.join(self.cache))
-            self.cache = []
-            self.edit.moveCursor(QtGui.QTextCursor.End)
+        if dropped:
+            lines.insert(0, '... {0} lines not shown ...'.format(dropped))
+
+        cursor = self.edit.textCursor()
+        cursor.movePosition(QtGui.QTextCursor.End)
+        if self._showing_partial:
+            cursor.movePosition(QtGui.QTextCursor.StartOfBlock,
+                                QtGui.QTextCursor.KeepAnchor)
+            cursor.removeSelectedText()
+
+        # always ends with the unfinished line, which is empty when there
+        # is none, so the next update can carry on from the last block
+        text = '\n'.join(lines + [partial or ''])
+        cursor.insertText(text)
+        self._showing_partial = partial is not None
+
+        self.edit.moveCursor(QtGui.QTextCursor.End)
+        self.edit.ensureCursorVisible()
+
+
+class ConsoleHandler(logging.Handler):
+    '''Logging handler that writes straight into an OutLog
+
+    Records below the handler's level are dropped by logging before they
+    reach emit(), so they are never formatted; the rest are formatted on
+    the logging thread and buffered as whole lines
+    '''
+
+    def __init__(self, outlog, level=logging.NOTSET):
+        logging.Handler.__init__(self, level)
+        self.outlog = outlog
+
+    def emit(self, record):
+        try:
+            text = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+
+        if '\n' in text or '\r' in text:
+            self.outlog.write(text + '\n')
+        else:
+            self.outlog.write_line(text)
+
+
+class StageEventRelay(QObject):
+    '''Re-emits the events of a stage's EventBus as Qt signals
+
+    Events arrive on stage and actuator threads; the signals are emitted on
+    the thread that owns the relay (create it on the GUI thread).  A burst of
+    events costs one queued wake-up, and deliveries are at least
+    min_interval_ms apart.  Only the latest StepStarted, StepFinished and
+    Progress of a burst is delivered, since only the latest matters to a
+    display - every other event is always delivered, in order
+    '''
+
+    step_started = pyqtSignal(object)
+    step_finished = pyqtSignal(object)
+    cookie_finished = pyqtSignal(object)
+    actuator_fault = pyqtSignal(object)
+    progress = pyqtSignal(object)
+    recipe_finished = pyqtSignal(object)
+    override_changed = pyqtSignal(object)
+
+    _wake = pyqtSignal()
+
+    COALESCED = (StepStarted, StepFinished, Progress)
+
+    def __init__(self, bus, min_interval_ms=50):
+        super(StageEventRelay, self).__init__()
+        self.mutex = QMutex()
+        self.min_interval_ms = min_interval_ms
+
+        self._latest = {}
+        self._queue = []
+        self._scheduled = False
+        self._last_flush = 0.0
+
+        self._signals = {
+            StepStarted: self.step_started,
+            StepFinished: self.step_finished,
+            CookieFinished: self.cookie_finished,
+            ActuatorFault: self.actuator_fault,
+            Progress: self.progress,
+            RecipeFinished: self.recipe_finished,
+            OverrideChanged: self.override_changed,
+        }
+
+        self._wake.connect(self._schedule, QtCore.Qt.QueuedConnection)
+        self._bus = bus
+        self._token = bus.subscribe(self._on_event, self._signals.keys())
+
+    def close(self):
+        self._bus.unsubscribe(self._token)
+
+    def _on_event(self, event):
+        '''EventBus subscriber - called on whichever thread published'''
+        locker = QMutexLocker(self.mutex)
+
+        if isinstance(event, self.COALESCED):
+            self._latest[type(event)] = event
+        else:
+            self._queue.append(event)
+
+        if not self._scheduled:
+            self._scheduled = True
+            self._wake.emit()
+
+    @pyqtSlot()
+    def _schedule(self):
+        wait_ms = self.min_interval_ms - (time.time() - self._last_flush) * 1e3
+        if wait_ms > 0:
+            QTimer.singleShot(int(wait_ms), self._flush)
+        else:
+            self._flush()
+
+    @pyqtSlot()
+    def _flush(self):
+        locker = QMutexLocker(self.mutex)
+        events = self._queue + self._latest.values()
+        self._queue = []
+        self._latest = {}
+        self._scheduled = False
+        locker.unlock()
+
+        self._last_flush = time.time()
+        for event in sorted(events, key=lambda e: e.time):
+            self._signals[type(event)].emit(event)
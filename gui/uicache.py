@@ -0,0 +1,82 @@
+'''
+Created on Oct 18, 2026
+
+Designer forms compiled once to Python and imported from then on
+
+loadUiType parses and compiles the .ui XML on every launch.  load_ui_type
+does the same job through a generated module next to the .ui file, which is
+only regenerated when the .ui file's contents change, so a normal start is
+just an import (of cached bytecode, after the first one).
+'''
+import hashlib
+import imp
+import logging
+import os
+import sys
+from xml.etree import ElementTree
+
+from PyQt4 import QtGui
+from PyQt4.uic import compileUi, loadUiType
+
+logger = logging.getLogger('cookiebot.uicache')
+
+HEADER = '# generated from {0} by gui.uicache - do not edit\n# source sha1 {1}\n'
+
+
+def load_ui_type(ui_path):
+    '''(form class, base class) of ui_path, like PyQt4.uic.loadUiType'''
+    with open(ui_path, 'rb') as f:
+        source = f.read()
+    digest = hashlib.sha1(source).hexdigest()
+
+    py_path = generated_path(ui_path)
+    header = HEADER.format(os.path.basename(ui_path), digest)
+
+    if not _is_current(py_path, header):
+        try:
+            _generate(ui_path, py_path, header, digest, source)
+        except (IOError, OSError) as e:
+            # e.g. a read-only install; still works, just slowly
+            logger.warning('Cannot cache the compiled {0}: {1}'.format(ui_path, e))
+            return loadUiType(ui_path)
+
+    name = os.path.splitext(os.path.basename(py_path))[0]
+    module = sys.modules.get(name)
+    if module is None or getattr(module, 'UI_SOURCE_SHA1', None) != digest:
+        module = imp.load_source(name, py_path)
+
+    return module.FORM_CLASS, getattr(QtGui, module.BASE_CLASS)
+
+
+def generated_path(ui_path):
+    '''Where the compiled module of ui_path lives: main.ui -> _main_ui.py'''
+    directory, filename = os.path.split(ui_path)
+    return os.path.join(directory, '_{0}_ui.py'.format(os.path.splitext(filename)[0]))
+
+
+def _is_current(py_path, header):
+    try:
+        with open(py_path, 'r') as f:
+            return f.read(len(header)) == header
+    except IOError:
+        return False
+
+
+def _generate(ui_path, py_path, header, digest, source):
+    logger.info('Compiling {0}'.format(ui_path))
+
+    root = ElementTree.fromstring(source)
+    widget = root.find('widget')
+    form_class = 'Ui_' + widget.get('name')
+
+    tmp_path = py_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        f.write(header)
+        with open(ui_path, 'r') as ui:
+            compileUi(ui, f, from_imports=False)
+        f.write('\nUI_SOURCE_SHA1 = {0!r}\n'.format(digest))
+        f.write('FORM_CLASS = {0}\n'.format(form_class))
+        f.write('BASE_CLASS = {0!r}\n'.format(widget.get('class')))
+
+    # replace atomically, so a crash never leaves a half-written module
+    os.rename(tmp_path, py_path)
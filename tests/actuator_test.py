@@ -3,25 +3,101 @@ Created on Feb 8, 2016
 
 @author: justinpalpant
 '''
+import array
 import unittest
 import mock
 
+from cookiebot.actuators import StepperActuator, ExecutionError
+from cookiebot.i2c import I2CBusManager, FakeSMBus, MODE1, AUTO_INCREMENT
+from cookiebot.sensors import SimulatedEndStop
+
 
 class ActuatorTest(unittest.TestCase):
 
 
     def setUp(self):
-        pass
+        self.act = StepperActuator(identity='Test', peak_rpm=30, time_scale=20.0)
 
 
     def tearDown(self):
-        pass
+        self.act.kill()
 
 
     def testName(self):
         pass
 
+    def testTaskFutureResolves(self):
+        done = self.act.set_task(array.array('b', [1] * 20), blocking=True)
+
+        self.assertTrue(done.result(5.0))
+        self.assertEqual(self.act.step_pos, 20)
+
+    def testReplacedTaskResolvesFalse(self):
+        first = self.act.set_task(array.array('b', [1] * 1000))
+        second = self.act.set_task(array.array('b', [-1] * 5))
+
+        self.assertFalse(first.result(0))
+        self.assertTrue(second.result(5.0))
+
+    def testKillFailsTask(self):
+        done = self.act.set_task(array.array('b', [1] * 1000), blocking=True)
+        self.act.kill()
+
+        self.assertIsInstance(done.exception(0), ExecutionError)
+
+    def testHomingFindsTheStop(self):
+        self.act.set_end_stops(start=SimulatedEndStop(self.act, position=-37))
+
+        self.assertTrue(self.act.home(fast_rpm=300, slow_rpm=100, backoff=5, timeout=5.0) > 0)
+        self.assertEqual(self.act.step_pos, 0)
+        self.assertEqual(self.act.rpm, 30)
+
+    def testHomingGivesUp(self):
+        self.act.set_end_stops(start=SimulatedEndStop(self.act, position=-1000))
+
+        self.assertRaises(ExecutionError, self.act.home, fast_rpm=300, travel=10, timeout=5.0)
+
+    def testRateOverrideRamps(self):
+        self.act.pause()
+        base = self.act._timer.interval
+        self.act.set_task(array.array('b', [1] * 100))
+        self.act.set_rate_override(2.0)
+
+        intervals = []
+        for _ in xrange(50):
+            self.act._execute_task()
+            intervals.append(self.act._timer.interval)
+
+        # no jump mid-task, but there in the end
+        self.assertAlmostEqual(intervals[0], base / 1.02)
+        self.assertAlmostEqual(intervals[-1], base / 2.0)
+
+        # and the next task starts at the new rate
+        self.act.set_rate_override(1.0)
+        self.act.set_task(array.array('b', [1] * 10))
+        self.assertAlmostEqual(self.act._timer.interval, base)
+
+    def testBusActuatorBuildsNoHAT(self):
+        backend = mock.Mock(present=True)
+        smbus = FakeSMBus()
+        bus = I2CBusManager(smbus)
+        with mock.patch('cookiebot.hardware.backend', return_value=backend):
+            act = StepperActuator(identity='Bus', peak_rpm=30, time_scale=20.0,
+                                  addr=0x60, stepper_num=1, bus=bus)
+        try:
+            # a MotorHAT would reset the chip the bus manager set up
+            self.assertFalse(backend.MotorHAT.called)
+            self.assertIsNone(act.hat)
+
+            self.assertTrue(act.set_task(array.array('b', [1] * 4), blocking=True).result(5))
+            bus.flush()
+            self.assertTrue(smbus.registers[0x60][MODE1] & AUTO_INCREMENT)
+            self.assertEqual(bus.commands, 4)
+        finally:
+            act.kill()
+            bus.close()
+
 
 if __name__ == "__main__":
     #import sys;sys.argv = ['', 'Test.testName']
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -0,0 +1,38 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot import hardware
+from cookiebot.control import ControlServer, ControlError, send_command
+from cookiebot.stages import IcingStage
+
+
+class ControlTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select('none')
+        self.stage = IcingStage(zero=False)
+        self.server = ControlServer(self.stage, port=0)
+        self.port = self.server.address[1]
+
+    def tearDown(self):
+        self.server.close()
+        self.stage.shutdown()
+
+    def testOverrideReachesTheAxes(self):
+        self.assertEqual(send_command('override travel 1.5', self.port), 'travel 1.5')
+
+        carriage = self.stage._wrappers[IcingStage.WrapperID.carriage]._wrapped_actuators
+        self.assertEqual([a.rate_override for a in carriage.values()], [1.5, 1.5])
+        self.assertIn('travel=1.5', send_command('overrides', self.port))
+
+    def testBadRequestsAreRefused(self):
+        self.assertRaises(ControlError, send_command, 'override speed 1.5', self.port)
+        self.assertRaises(ControlError, send_command, 'override flow 10', self.port)
+        self.assertRaises(ControlError, send_command, 'dance', self.port)
+        self.assertEqual(self.stage.overrides['flow'], 1.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
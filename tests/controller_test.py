@@ -0,0 +1,78 @@
+'''
+Created on Oct 18, 2026
+'''
+import time
+import unittest
+
+from cookiebot import hardware
+from cookiebot.controller import Controller
+from cookiebot.loadtest import SimulatedIcingStage, build_trays, run_stages, summarize
+from cookiebot.recipe import Recipe
+
+TIME_SCALE = 500.0
+
+# quick patterns, so a few trays take a second or two at TIME_SCALE
+PATTERNS = [Recipe.IcingType.square, Recipe.IcingType.maze]
+
+
+class ControllerTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select('none')
+
+    def testEveryTrayCompletes(self):
+        stages = [SimulatedIcingStage(name='stage-{0}'.format(i), time_scale=TIME_SCALE)
+                  for i in range(2)]
+        controller = Controller(stages)
+        try:
+            # the same tray, four times: duplicates still run unless rejected
+            trays = build_trays(4, PATTERNS)
+            for recipe in trays:
+                self.assertIsNotNone(controller.submit(recipe))
+            self.assertTrue(controller.busy())
+
+            finished = controller.poll()
+            deadline = time.time() + 30.0
+            while controller.busy() and time.time() < deadline:
+                time.sleep(0.01)
+                finished += controller.poll()
+
+            self.assertFalse(controller.busy())
+            self.assertEqual(finished, len(trays))
+            self.assertEqual(controller.completed, len(trays))
+            self.assertTrue(all(s.live for s in stages))
+            # both stages took trays
+            self.assertTrue(all(s.steps_dispatched for s in stages))
+        finally:
+            controller.shutdown()
+
+    def testRejectDuplicates(self):
+        controller = Controller(reject_duplicates=True)
+        recipe = build_trays(1, PATTERNS)[0]
+        key = controller.submit(recipe)
+
+        self.assertEqual(key, recipe.content_hash())
+        self.assertIsNone(controller.submit(build_trays(1, PATTERNS)[0]))
+        self.assertEqual(len(controller.queue), 1)
+
+
+class LoadTestTest(unittest.TestCase):
+
+    def setUp(self):
+        hardware.select('none')
+
+    def testRunStages(self):
+        results = run_stages(2, trays_per_stage=1, time_scale=TIME_SCALE,
+                             patterns=PATTERNS, poll_interval=0.01)
+
+        self.assertEqual([r['stage'] for r in results], ['stage-0', 'stage-1'])
+        self.assertTrue(all(r['live'] for r in results))
+        self.assertTrue(all(r['steps'] > 0 for r in results))
+
+        row = summarize(2, results)
+        self.assertEqual(row['failed'], 0)
+        self.assertTrue(row['steps_per_sec'] > 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
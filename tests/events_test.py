@@ -0,0 +1,103 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot import hardware, traysim
+from cookiebot.events import (EventBus, StepStarted, StepFinished, CookieFinished,
+                              ActuatorFault, Progress, RecipeFinished)
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage
+
+
+class EventBusTest(unittest.TestCase):
+
+    def testSubscribeByType(self):
+        bus = EventBus()
+        everything, progress = [], []
+        bus.subscribe(everything.append)
+        token = bus.subscribe(progress.append, [Progress])
+
+        started = StepStarted(None, 0, 2, 'square.txt:1', 0.0)
+        half = Progress(None, 1, 2, 0.5, 1.0, 0.0)
+        bus.publish(started)
+        bus.publish(half)
+        bus.unsubscribe(token)
+        bus.publish(half)
+
+        self.assertEqual(everything, [started, half, half])
+        self.assertEqual(progress, [half])
+
+    def testFailingSubscriberDoesNotStopOthers(self):
+        bus = EventBus()
+        seen = []
+        bus.subscribe(lambda e: 1 / 0)
+        bus.subscribe(seen.append)
+
+        bus.publish(Progress(None, 1, 1, 1.0, 0.0, 0.0))
+
+        self.assertEqual(len(seen), 1)
+
+
+class StageEventsTest(unittest.TestCase):
+
+    def testEventsFollowTheRecipe(self):
+        hardware.select('none')
+        recipe = Recipe()
+        for pos in ((0, 0), (1, 0)):
+            recipe.add_cookie({'icing': Recipe.IcingType.square}, pos)
+        events = []
+        traysim.simulate(recipe, subscriber=events.append)
+
+        finished = [e for e in events if isinstance(e, StepFinished)]
+        total = finished[0].total
+        self.assertEqual([e.index for e in finished], range(total))
+
+        # every step: started, finished, its cookie if it ends one, progress
+        cookies = []
+        for i, event in enumerate(events[:-1]):
+            if not isinstance(event, StepFinished):
+                continue
+            self.assertIsInstance(events[i - 1], StepStarted)
+            self.assertEqual(events[i - 1].index, event.index)
+
+            after = events[i + 1]
+            if isinstance(after, CookieFinished):
+                self.assertEqual(after.index, event.index)
+                cookies.append(after.position)
+                after = events[i + 2]
+            self.assertIsInstance(after, Progress)
+            self.assertEqual(after.done, event.index + 1)
+            self.assertIsNotNone(after.eta)
+
+        self.assertEqual(cookies, [(0, 0), (1, 0)])
+        progress = [e for e in events if isinstance(e, Progress)]
+        self.assertEqual(progress[-1].fraction, 1.0)
+        self.assertEqual(progress[-1].eta, 0.0)
+
+        self.assertIsInstance(events[-1], RecipeFinished)
+        self.assertEqual(events[-1].steps, total)
+
+    def testFaultIsPublishedOnce(self):
+        hardware.select('none')
+        stage = IcingStage(zero=False)
+        faults = []
+        stage.events.subscribe(faults.append, [ActuatorFault])
+        try:
+            stage._axes()[0].kill()
+
+            # asking is only a query, from any thread
+            self.assertFalse(stage.recipe_done())
+            self.assertTrue(stage.live)
+            self.assertEqual(faults, [])
+
+            for _ in range(3):
+                self.assertFalse(stage._check_actuators())
+            self.assertFalse(stage.live)
+            self.assertEqual(len(faults), 1)
+        finally:
+            stage.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,32 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import unittest
+
+from cookiebot import hardware
+
+
+class HardwareTest(unittest.TestCase):
+
+    def setUp(self):
+        self._saved = (hardware._selected, hardware._backend)
+        hardware._selected = hardware._backend = None
+
+    def tearDown(self):
+        hardware._selected, hardware._backend = self._saved
+
+    def testEnvironmentSelectsTheBackend(self):
+        os.environ[hardware.ENVIRONMENT] = 'none'
+        try:
+            self.assertFalse(hardware.backend().present)
+            self.assertIs(hardware.backend(), hardware.backend())
+        finally:
+            del os.environ[hardware.ENVIRONMENT]
+
+    def testUnknownBackend(self):
+        self.assertRaises(hardware.HardwareError, hardware.select, 'abacus')
+
+
+if __name__ == "__main__":
+    unittest.main()
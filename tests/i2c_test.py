@@ -0,0 +1,101 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot.i2c import (I2CBusManager, FakeSMBus, StepperChannel, STEPPER_PINS,
+                           FORWARD, BACKWARD, DOUBLE, PIN_HIGH, PIN_LOW,
+                           MODE1, MODE2, PRESCALE, ALL_LED_ON_L, AUTO_INCREMENT,
+                           SLEEP, OUTDRV)
+
+
+class StepperChannelTest(unittest.TestCase):
+
+    def testDoubleStepCycle(self):
+        channel = StepperChannel(1)
+        pins = STEPPER_PINS[1]
+
+        seen = []
+        for _ in xrange(4):
+            values = channel.step(FORWARD, DOUBLE)
+            seen.append(tuple(values[pins[p]] == PIN_HIGH
+                              for p in ('ain2', 'bin1', 'ain1', 'bin2')))
+
+        # two coils on at every full step, and four distinct phases
+        self.assertTrue(all(sum(s) == 2 for s in seen))
+        self.assertEqual(len(set(seen)), 4)
+
+        channel.step(BACKWARD, DOUBLE)
+        self.assertEqual(channel.currentstep, 20)
+
+
+class I2CBusManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.smbus = FakeSMBus()
+        # long enough that steps queued back to back share a batch
+        self.manager = I2CBusManager(self.smbus, coalesce_window=0.05)
+        self.manager.register(0x60, 1)
+        self.manager.register(0x60, 2)
+        self.manager.flush()
+
+    def tearDown(self):
+        self.manager.close()
+
+    def _steps(self, smbus, manager, flush_each):
+        '''Three steps on each stepper, in turn; returns the bus transactions'''
+        smbus.transactions = 0
+        for _ in xrange(3):
+            for num in (1, 2):
+                manager.step(0x60, num, FORWARD, DOUBLE)
+                if flush_each:
+                    manager.flush()
+        manager.flush()
+        return smbus.transactions
+
+    def testStepsAreCoalesced(self):
+        # one batch per step, as with no coalescing and an idle bus
+        smbus = FakeSMBus()
+        alone = I2CBusManager(smbus)
+        try:
+            alone.register(0x60, 1)
+            alone.register(0x60, 2)
+            alone.flush()
+            uncoalesced = self._steps(smbus, alone, flush_each=True)
+        finally:
+            alone.close()
+
+        coalesced = self._steps(self.smbus, self.manager, flush_each=False)
+
+        # the X and Y steps of a tick share writes; a second step for the
+        # same stepper still gets its own, so none of its phases is skipped
+        self.assertLess(coalesced, uncoalesced)
+        self.assertEqual(self.manager.commands, alone.commands)
+        self.assertEqual(self.smbus.registers[0x60], smbus.registers[0x60])
+
+    def testRegisterSetsTheChipUp(self):
+        chip = self.smbus.registers[0x60]
+        self.assertTrue(chip[MODE1] & AUTO_INCREMENT)
+        self.assertFalse(chip[MODE1] & SLEEP)
+        self.assertEqual(chip[MODE2], OUTDRV)
+        # 25MHz / 4096 / 1600Hz - 1, as Adafruit_MotorHAT sets it
+        self.assertEqual(chip[PRESCALE], 3)
+        self.assertEqual(list(chip[ALL_LED_ON_L:ALL_LED_ON_L + 4]), [0, 0, 0, 0])
+
+        # the second stepper on the HAT does not set it up again
+        transactions = self.smbus.transactions
+        self.manager.register(0x60, 2)
+        self.manager.flush()
+        self.assertEqual(self.smbus.transactions, transactions)
+
+    def testRelease(self):
+        self.manager.step(0x60, 2, FORWARD, DOUBLE)
+        self.manager.release(0x60, 2)
+        self.manager.flush()
+
+        for name in ('ain1', 'ain2', 'bin1', 'bin2'):
+            self.assertEqual(self.smbus.channel(0x60, STEPPER_PINS[2][name]), PIN_LOW)
+
+
+if __name__ == "__main__":
+    unittest.main()
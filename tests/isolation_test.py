@@ -0,0 +1,61 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot.actuators import Actuator, CommandError
+from cookiebot.isolation import CommandRing, IsolatedActuator
+
+
+class CommandRingTest(unittest.TestCase):
+
+    def testRecordsSurviveWrapAround(self):
+        ring = CommandRing(capacity=64)
+
+        received = []
+        for seq in xrange(1, 20):
+            ring.push(1, seq, 'x' * (seq % 7))
+            received.append(ring.pop())
+
+        self.assertEqual(received, [(1, seq, 'x' * (seq % 7)) for seq in xrange(1, 20)])
+        self.assertIsNone(ring.pop())
+
+
+class IsolatedActuatorTest(unittest.TestCase):
+
+    def testTaskRunsInChild(self):
+        act = IsolatedActuator(identity='Isolated', peak_rpm=30, time_scale=20.0)
+        try:
+            done = act.set_task([1] * 40 + [-1] * 10, blocking=True)
+            # the child may not have seen the task yet, but it must not look ready
+            self.assertEqual(act.state, Actuator.State.executing_blocked)
+
+            self.assertTrue(done.result(5.0))
+            self.assertEqual(act.state, Actuator.State.ready)
+            self.assertEqual(act.step_pos, 30)
+            self.assertEqual(act.progress(), (50, 50))
+        finally:
+            act.kill()
+
+        self.assertEqual(act.state, Actuator.State.dead)
+
+    def testHomingWaitsForTheChild(self):
+        act = IsolatedActuator(identity='Isolated', peak_rpm=30, time_scale=20.0)
+        try:
+            self.assertTrue(act.set_task([1] * 10, blocking=True).result(5.0))
+            self.assertGreaterEqual(act.go_to_zero(5.0), 0.0)
+            # read from the child's own state, not the parent's prediction
+            self.assertEqual(act._block.read()[1], 0)
+        finally:
+            act.kill()
+
+    def testCommandsAfterKillAreRefused(self):
+        act = IsolatedActuator(identity='Isolated', peak_rpm=30, time_scale=20.0)
+        act.kill()
+        act.kill()
+        self.assertRaises(CommandError, act.pause)
+        self.assertRaises(CommandError, act.set_rpm, 60)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,127 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import shutil
+import tempfile
+import unittest
+
+from cookiebot import hardware
+from cookiebot.journal import ExecutionJournal, RECORD_SIZE
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage
+
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'stage.journal')
+        self.journal = ExecutionJournal(self.path)
+
+    def tearDown(self):
+        self.journal.close()
+        shutil.rmtree(self.tmpdir)
+
+    def testRecoverPositions(self):
+        self.journal.begin_recipe([{0: (0, 0)}, {0: (1, 1)}])
+        self.journal.step_dispatched(0)
+        self.journal.position(0, 5)
+        self.journal.position(1, -3)
+        self.journal.position(0, 6)
+        self.journal.step_dispatched(1)
+
+        state = ExecutionJournal.recover(self.path)
+
+        self.assertEqual(state.total, 2)
+        self.assertEqual(state.dispatched, 1)
+        self.assertEqual(state.positions, {0: 6, 1: -3})
+        self.assertFalse(state.finished)
+
+    def testTornRecordIsIgnored(self):
+        self.journal.begin_recipe([{0: (0, 0)}])
+        self.journal.position(0, 5)
+        self.journal.position(0, 6)
+        self.journal.close()
+
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - RECORD_SIZE // 2)
+
+        self.assertEqual(ExecutionJournal.recover(self.path).positions, {0: 5})
+
+    def testBeginTruncatesOldRecipe(self):
+        self.journal.begin_recipe([{0: (0, 0)}])
+        self.journal.end_recipe()
+        self.journal.begin_recipe([{0: (0, 0)}, {0: (1, 1)}])
+
+        state = ExecutionJournal.recover(self.path)
+
+        self.assertEqual(state.total, 2)
+        self.assertFalse(state.finished)
+
+
+class ResumeTest(unittest.TestCase):
+    '''A stage that crashed part-way through a stroke, resumed from its journal'''
+
+    def setUp(self):
+        hardware.select('none')
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'stage.journal')
+        self.recipe = self._recipe(Recipe.IcingType.square)
+
+        # run the recipe into its second stroke, then crash
+        stage = IcingStage(zero=False, journal=ExecutionJournal(self.path))
+        stage.load_recipe(self.recipe)
+        self.steps = stage.steps[:]
+        nozzle = IcingStage.WrapperID.nozzle
+        offs = [i for i, step in enumerate(self.steps) if step.get(nozzle) == 'off']
+        self.stroke = offs[0] + 1
+        self.crashed_at = (self.stroke + offs[1]) // 2
+        self.assertGreater(self.crashed_at, self.stroke)
+
+        for i in xrange(self.crashed_at + 1):
+            stage.journal.step_dispatched(i)
+        stage.journal.position(0, 120)
+        stage.journal.position(1, -40)
+        stage.journal.position(0, 121)
+        stage.shutdown()
+
+        self.stage = IcingStage(zero=False, journal=ExecutionJournal(self.path))
+
+    def tearDown(self):
+        self.stage.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def _recipe(self, icing):
+        recipe = Recipe()
+        for pos in [(0, 0), (1, 0)]:
+            recipe.add_cookie({'icing': icing}, pos)
+        return recipe
+
+    def testResumeAtInterruptedStroke(self):
+        start = self.stage.resume_recipe(self.recipe)
+
+        self.assertEqual(start, self.stroke)
+        self.assertEqual(self.stage.step_index, self.stroke)
+        self.assertEqual(len(self.stage.steps), len(self.steps) - self.stroke)
+
+        axes = self.stage._axes()
+        self.assertEqual((axes[0].step_pos, axes[1].step_pos), (121, -40))
+        self.assertTrue(all(a.step_pos == 0 for a in axes[2:]))
+
+        platform = IcingStage.WrapperID.platform
+        self.assertNotIn(platform, self.steps[self.stroke])
+        self.assertIs(self.stage.steps[0][platform], True)
+        # the compiled steps are shared, and must not pick up the raise
+        self.assertEqual(self.stage._compile(self.recipe)[self.stroke], self.steps[self.stroke])
+
+    def testDifferentRecipeStartsOver(self):
+        start = self.stage.resume_recipe(self._recipe(Recipe.IcingType.maze))
+
+        self.assertEqual(start, 0)
+        self.assertEqual(self.stage.step_index, 0)
+        self.assertTrue(all(a.step_pos == 0 for a in self.stage._axes()))
+
+
+if __name__ == "__main__":
+    unittest.main()
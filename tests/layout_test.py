@@ -0,0 +1,58 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot import hardware
+from cookiebot.layout import TrayLayout, LayoutError, load_layout
+from cookiebot.recipe import Recipe, RecipeError
+from cookiebot.stages import IcingStage
+
+
+class TrayLayoutTest(unittest.TestCase):
+
+    def testGridPlacement(self):
+        layout = TrayLayout(3, 2, origin=(1.0, 2.0), pitch=(4.0, 5.0))
+
+        self.assertEqual(len(layout), 6)
+        self.assertEqual(layout.apply([(0.5, -0.5), (0.0, 0.0)], (2, 1)),
+                         [(9.5, 6.5), (9.0, 7.0)])
+        self.assertRaises(LayoutError, layout.apply, [(0.0, 0.0)], (3, 0))
+
+    def testRotatedSlotRoundTrips(self):
+        layout = TrayLayout(2, 2, slots={(1, 1): {'rotation': 90, 'scale': 0.5}})
+
+        stage_point = layout.apply([(1.0, 0.0)], (1, 1))[0]
+        self.assertAlmostEqual(stage_point[0], 4.5)
+        self.assertAlmostEqual(stage_point[1], 5.0)
+
+        back = layout.to_pattern(stage_point, (1, 1))
+        self.assertAlmostEqual(back[0], 1.0)
+        self.assertAlmostEqual(back[1], 0.0)
+
+    def testLayoutFilesLoad(self):
+        layout = load_layout('6x4')
+
+        self.assertEqual(len(layout.positions()), 24)
+        self.assertEqual(TrayLayout.from_dict(layout.to_dict()).pitch, layout.pitch)
+
+    def testStagePlacesPatternsOnItsLayout(self):
+        hardware.select('none')
+        stage = IcingStage(zero=False, layout=load_layout('6x4'))
+        try:
+            recipe = Recipe()
+            recipe.add_cookie({'icing': Recipe.IcingType.square}, (5, 3))
+            stage.load_recipe(recipe)
+
+            first = stage.steps[1]
+            self.assertEqual(first.cookie, (5, 3))
+            self.assertEqual(first[IcingStage.WrapperID.carriage], (15 - 0.583, 9 + 0.583))
+
+            recipe.add_cookie({'icing': Recipe.IcingType.square}, (6, 0))
+            self.assertRaises(RecipeError, stage.load_recipe, recipe)
+        finally:
+            stage.shutdown()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+'''
+Created on Oct 18, 2026
+'''
+import logging
+import Queue
+import unittest
+
+from cookiebot import logsetup
+
+
+class ListHandler(logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+class LogSetupTest(unittest.TestCase):
+
+    def testListenerHandlesQueuedRecords(self):
+        queue = Queue.Queue()
+        handler = ListHandler()
+        listener = logsetup.QueueListener(queue, handler)
+        logger = logging.getLogger('cookiebot.test.queued')
+        logger.propagate = False
+        logger.addHandler(logsetup.QueueHandler(queue))
+
+        listener.start()
+        position = [1]
+        logger.warning('At step %s', position)
+        # formatted when logged, not when handled
+        position.append(2)
+        logger.warning('Done')
+        listener.stop()
+
+        self.assertEqual(handler.messages, ['At step [1]', 'Done'])
+
+    def testFullQueueDropsRecords(self):
+        handler = logsetup.QueueHandler(Queue.Queue(1))
+        record = logging.LogRecord('test', logging.INFO, __file__, 1, 'step', None, None)
+
+        handler.emit(record)
+        handler.emit(record)
+
+        self.assertEqual(handler.dropped, 1)
+
+    def testStepDebugSwitch(self):
+        steps = logsetup.step_log('wrapper')
+        self.assertFalse(steps.enabled)
+
+        logsetup.set_step_debug('wrapper')
+        self.assertTrue(steps.enabled)
+        logsetup.set_step_debug('all', enabled=False)
+        self.assertFalse(steps.enabled)
+
+        self.assertRaises(ValueError, logsetup.set_step_debug, ['motors'])
+
+
+if __name__ == "__main__":
+    unittest.main()
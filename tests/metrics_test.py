@@ -0,0 +1,127 @@
+'''
+Created on Oct 18, 2026
+'''
+import threading
+import unittest
+import urllib2
+
+from cookiebot import hardware
+from cookiebot.multithreading import LatencyHistogram
+from cookiebot.metrics import Registry, MetricsServer, registry, parse_address
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage
+from cookiebot.traysim import simulate
+
+
+class MetricsTest(unittest.TestCase):
+
+    def testThreadShardsAddUp(self):
+        metrics = Registry()
+        counter = metrics.counter('test_total', 'Test counter', ('who',)).labels('me')
+        histogram = metrics.histogram('test_seconds', 'Test histogram')
+
+        def work():
+            for _ in xrange(1000):
+                counter.inc()
+                histogram.observe(0.001)
+
+        threads = [threading.Thread(target=work, name='worker {0}'.format(i)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(counter.value(), 4000)
+        self.assertEqual(histogram.value()['count'], 4000)
+        self.assertAlmostEqual(histogram.value()['sum'], 4.0)
+
+    def testSameNamedThreadsDoNotShareCells(self):
+        # every stage's recipe thread has this name
+        counter = Registry().counter('test_total', 'Test counter')
+
+        def work():
+            for _ in xrange(20000):
+                counter.inc()
+
+        for _ in range(2):
+            threads = [threading.Thread(target=work, name='IcingStage recipe') for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            # finished threads' cells are retired, not lost
+            self.assertEqual(len(counter._only._shards.cells()), 1)
+
+        self.assertEqual(counter.value(), 160000)
+
+    def testAdoptedHistogramOutlivesItsOwner(self):
+        histogram = Registry().histogram('test_seconds', 'Test histogram', ('who',)).labels('x')
+
+        class Owner(object):
+            pass
+
+        owners = [Owner(), Owner()]
+        for owner in owners:
+            kept = LatencyHistogram()
+            kept.add(0.5)
+            histogram.adopt(kept, owner)
+        self.assertEqual(histogram.value()['count'], 2)
+
+        del owners[:], owner
+        self.assertEqual(histogram.value()['count'], 2)
+        self.assertEqual(len(histogram._shards.cells()), 1)
+
+    def testStepsQueuedCoversEveryStage(self):
+        hardware.select('none')
+        queued = registry.get('cookiebot_stage_steps_queued')
+        before = queued.value()
+        stages = [IcingStage(zero=False) for _ in range(2)]
+        try:
+            for stage in stages:
+                recipe = Recipe()
+                recipe.add_cookie({'icing': Recipe.IcingType.square}, (0, 0))
+                stage.load_recipe(recipe)
+            self.assertEqual(queued.value() - before, sum(len(s.steps) for s in stages))
+        finally:
+            for stage in stages:
+                stage.shutdown()
+
+    def testExposition(self):
+        metrics = Registry()
+        metrics.counter('test_total', 'Test counter', ('who',)).labels('a "b"').inc(2)
+        metrics.gauge('test_depth', 'Test gauge').set_function(lambda: 7)
+        metrics.histogram('test_seconds', 'Test histogram', smallest=1.0, buckets=3).observe(3.0)
+        lines = metrics.exposition().splitlines()
+
+        self.assertIn('# TYPE test_total counter', lines)
+        self.assertIn('test_total{who="a \\"b\\""} 2.0', lines)
+        self.assertIn('test_depth 7.0', lines)
+        self.assertIn('test_seconds_bucket{le="2.0"} 0.0', lines)
+        self.assertIn('test_seconds_bucket{le="4.0"} 1.0', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1.0', lines)
+        self.assertIn('test_seconds_count 1.0', lines)
+
+        self.assertRaises(ValueError, metrics.gauge, 'test_total', 'Not a gauge')
+        self.assertEqual(parse_address('9000'), ('127.0.0.1', 9000))
+        self.assertEqual(parse_address('0.0.0.0:9000'), ('0.0.0.0', 9000))
+
+    def testScrapeAfterATray(self):
+        hardware.select('none')
+        trays = registry.get('cookiebot_trays_completed_total').value()
+        recipe = Recipe()
+        recipe.add_cookie({'icing': Recipe.IcingType.square}, (0, 0))
+        simulate(recipe)
+        self.assertEqual(registry.get('cookiebot_trays_completed_total').value(), trays + 1)
+
+        server = MetricsServer(port=0)
+        try:
+            text = urllib2.urlopen('http://127.0.0.1:{0}/metrics'.format(server.address[1])).read()
+        finally:
+            server.close()
+        self.assertIn('cookiebot_actuator_steps_total{actuator="X-axis Stepper"}', text)
+        self.assertIn('cookiebot_dispatch_latency_seconds_count', text)
+        self.assertIn('cookiebot_info{machine=', text)
+
+
+if __name__ == "__main__":
+    unittest.main()
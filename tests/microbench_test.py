@@ -0,0 +1,32 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import platform
+import unittest
+
+from cookiebot import microbench
+
+
+class MicrobenchTest(unittest.TestCase):
+
+    def testCompareFlagsOnlyRealSlowdowns(self):
+        base = {'a': 1e-3, 'b': 1e-3, 'timer lateness p99': 1e-4, 'gone': 1.0}
+        results = {'a': 1.1e-3, 'b': 2e-3, 'timer lateness p99': 4e-4, 'new': 1.0}
+
+        self.assertEqual(microbench.compare(results, base, threshold=0.2),
+                         [('b', 1e-3, 2e-3)])
+
+    @unittest.skipUnless(os.environ.get('COOKIEBOT_BENCHMARK'),
+                         'set COOKIEBOT_BENCHMARK=1 to run the benchmarks')
+    def testNoRegressions(self):
+        results = microbench.run_suite(os.environ.get('COOKIEBOT_BENCHMARK_FILTER'))
+        history = microbench.load_history(microbench.HISTORY)
+        base = microbench.baseline(history, platform.node())
+
+        if base is not None:
+            self.assertEqual(microbench.compare(results, base['results']), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
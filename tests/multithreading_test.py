@@ -0,0 +1,138 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import time
+import unittest
+
+from cookiebot.multithreading import (LatencyHistogram, DeadlineWatchdog, TaskFuture,
+                                      RepeatedTimer)
+
+
+class LatencyHistogramTest(unittest.TestCase):
+
+    def testPercentilesBoundValues(self):
+        hist = LatencyHistogram()
+        for _ in xrange(99):
+            hist.add(0.0001)
+        hist.add(0.05)
+
+        self.assertEqual(hist.count, 100)
+        self.assertGreaterEqual(hist.percentile(0.5), 0.0001)
+        self.assertLess(hist.percentile(0.5), 0.0002)
+        self.assertEqual(hist.percentile(1.0), 0.05)
+        self.assertAlmostEqual(hist.max, 0.05)
+
+    def testMemoryIsConstant(self):
+        hist = LatencyHistogram(buckets=8)
+        for i in xrange(1000):
+            hist.add(i * 1e-3)
+
+        self.assertEqual(len(hist.counts), 9)
+        self.assertEqual(sum(hist.counts), 1000)
+
+
+class DeadlineWatchdogTest(unittest.TestCase):
+
+    def testFaultCallback(self):
+        faults = []
+        dog = DeadlineWatchdog(warn=0.5, fault=2.0, on_fault=faults.append)
+
+        dog.check(0.001, 0.01)
+        dog.check(0.008, 0.01)
+        dog.check(0.05, 0.01)
+
+        self.assertEqual(dog.warnings, 1)
+        self.assertEqual(faults, [0.05])
+
+
+
+class RepeatedTimerTest(unittest.TestCase):
+
+    def testPreciseTimerBatchesAfterALateWakeUp(self):
+        calls = []
+
+        def tick():
+            calls.append(time.time())
+            if len(calls) == 1:
+                # makes the next wake-up about two and a half intervals late
+                time.sleep(0.07)
+
+        timer = RepeatedTimer(0.02, tick, start=False, precision=True, max_batch=2)
+        timer.restart()
+        time.sleep(0.2)
+        timer.stop()
+
+        # the second and third calls catch up back to back; the rest are skipped
+        self.assertLess(calls[2] - calls[1], 0.01)
+        self.assertGreaterEqual(timer.missed, 1)
+        self.assertGreater(timer.lateness.max, 0.04)
+        self.assertEqual(timer.calls, len(calls))
+
+    def testStatsRunOnAcrossPauses(self):
+        calls = []
+        timer = RepeatedTimer(0.01, lambda: calls.append(None))
+        time.sleep(0.1)
+        timer.stop()
+        time.sleep(0.1)
+        timer.restart()
+        time.sleep(0.1)
+        timer.stop()
+
+        self.assertEqual(timer.calls, len(calls))
+        self.assertEqual(timer.lateness.count, len(calls))
+        # about 20 calls in 0.3s, counting the pause
+        self.assertGreater(timer.achieved_rate(), 40)
+        self.assertLess(timer.achieved_rate(), 80)
+
+        timer.reset_stats()
+        self.assertEqual((timer.calls, timer.lateness.count), (0, 0))
+
+    def testCloseReleasesTheWakePipe(self):
+        calls = []
+        timer = RepeatedTimer(10.0, lambda: calls.append(None), wakeable=True)
+        pipe = (timer._wake_r, timer._wake_w)
+        timer.trigger()
+        deadline = time.time() + 5.0
+        while not calls and time.time() < deadline:
+            time.sleep(0.001)
+        self.assertEqual(len(calls), 1)
+
+        timer.close()
+        for fd in pipe:
+            self.assertRaises(OSError, os.fstat, fd)
+        # a trigger racing the shutdown is harmless
+        timer.trigger()
+        self.assertEqual(len(calls), 1)
+        # and a restart racing it starts nothing
+        timer.restart()
+        self.assertFalse(timer.running)
+
+
+class TaskFutureTest(unittest.TestCase):
+
+    def testGatherWaitsForAll(self):
+        a, b = TaskFuture(), TaskFuture()
+        seen = []
+        combined = TaskFuture.gather([a, b])
+        combined.add_done_callback(seen.append)
+
+        a.set_result(True)
+        self.assertFalse(combined.done())
+        b.set_result(False)
+
+        self.assertEqual(combined.result(0), [True, False])
+        self.assertEqual(seen, [combined])
+
+    def testGatherFailsFast(self):
+        a, b = TaskFuture(), TaskFuture()
+        combined = TaskFuture.gather([a, b])
+
+        a.set_exception(ValueError('dead'))
+
+        self.assertIsInstance(combined.exception(0), ValueError)
+        self.assertFalse(b.done())
+
+
+if __name__ == "__main__":
+    unittest.main()
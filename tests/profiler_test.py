@@ -0,0 +1,72 @@
+'''
+Created on Oct 18, 2026
+'''
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from cookiebot import hardware
+from cookiebot.profiler import SamplingProfiler, OnDemandProfiler, stage_context
+from cookiebot.stages import IcingStage
+
+
+def spin_until(stop):
+    while not stop.is_set():
+        pass
+
+
+class ProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.stop = threading.Event()
+        self.spinner = threading.Thread(target=spin_until, args=(self.stop,), name='spinner')
+        self.spinner.start()
+
+    def tearDown(self):
+        self.stop.set()
+        self.spinner.join()
+        shutil.rmtree(self.directory)
+
+    def testSamplesOtherThreads(self):
+        profiler = SamplingProfiler(interval=0.002, context=lambda: lambda name: ['tag'])
+        profiler.run(0.1)
+
+        spinning = [line for line in profiler.collapsed() if line.startswith('spinner;tag;')]
+        self.assertTrue(spinning)
+        self.assertIn('spin_until (profiler_test.py)', spinning[0])
+
+        profile = profiler.speedscope()
+        names = [p['name'] for p in profile['profiles']]
+        self.assertIn('spinner', names)
+        frames = profile['shared']['frames']
+        spinner = profile['profiles'][names.index('spinner')]
+        self.assertEqual(frames[spinner['samples'][0][0]]['name'], 'spinner')
+        self.assertAlmostEqual(sum(spinner['weights']), spinner['endValue'])
+
+    def testOnDemandWithAStage(self):
+        hardware.select('none')
+        stage = IcingStage(zero=False)
+        on_demand = OnDemandProfiler(self.directory, interval=0.002)
+        on_demand.context = stage_context(stage)
+        try:
+            paths = on_demand.start(0.1)
+            self.assertIsNone(on_demand.start(0.1))
+            on_demand.stop()
+        finally:
+            stage.shutdown()
+
+        self.assertFalse(on_demand.running())
+        files = os.listdir(self.directory)
+        self.assertEqual(len([f for f in files if f.startswith('stacks-')]), 1)
+        with open(paths[0], 'r') as f:
+            self.assertIn('spinner;no recipe;', f.read())
+        with open(paths[1], 'r') as f:
+            self.assertTrue(json.load(f)['profiles'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,74 @@
+'''
+Created on Oct 18, 2026
+'''
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from cookiebot import recipe as recipes
+from cookiebot.controller import Controller
+from cookiebot.recipe import Recipe, RecipeError
+
+
+def tray(*icings):
+    r = Recipe()
+    for icing, pos in zip(icings, [(0, 0), (1, 0), (0, 1), (1, 1)]):
+        r.add_cookie({'icing': icing}, pos)
+    return r
+
+
+class RecipeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.recipe = tray(Recipe.IcingType.square, Recipe.IcingType.maze,
+                           Recipe.IcingType.blue_devil)
+
+    def testRoundTrips(self):
+        self.assertEqual(Recipe.from_json(self.recipe.to_json()), self.recipe)
+        self.assertEqual(Recipe.from_bytes(self.recipe.to_bytes()), self.recipe)
+        self.assertEqual(pickle.loads(pickle.dumps(self.recipe, 2)), self.recipe)
+
+    def testOtherVersionsAreRefused(self):
+        data = self.recipe.to_dict()
+        data['version'] += 1
+
+        self.assertRaises(RecipeError, Recipe.from_dict, data)
+        self.assertRaises(RecipeError, Recipe.from_bytes, self.recipe.to_bytes()[:-1])
+
+    def testHashIsCanonical(self):
+        backwards = Recipe()
+        for pos, spec in reversed(sorted(self.recipe.cookies.items())):
+            backwards.add_cookie(dict(spec), pos)
+
+        self.assertEqual(backwards.content_hash(), self.recipe.content_hash())
+        self.assertNotEqual(tray(Recipe.IcingType.square).content_hash(),
+                            self.recipe.content_hash())
+
+    def testPatternDigestFollowsTheFile(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'pattern.txt')
+            with open(path, 'w') as f:
+                f.write("{0: (0, 0)}\n")
+            before = recipes.pattern_digest(path)
+
+            with open(path, 'w') as f:
+                f.write("{0: (0, 1)}\n")
+            os.utime(path, (0, 0))
+
+            self.assertNotEqual(recipes.pattern_digest(path), before)
+        finally:
+            shutil.rmtree(directory)
+
+    def testControllerSpotsDuplicateOrders(self):
+        controller = Controller(reject_duplicates=True)
+
+        self.assertIsNotNone(controller.submit(self.recipe))
+        self.assertIsNone(controller.submit(Recipe.from_json(self.recipe.to_json())))
+        self.assertEqual(len(controller.queue), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+'''
+Created on Oct 18, 2026
+'''
+import array
+import time
+import unittest
+
+from cookiebot.actuators import StepperActuator, ExecutionError
+from cookiebot.sensors import RingBuffer, DigitalSensor, SensorSampler, FakeGPIO
+
+
+def readings(sensor):
+    return len(sensor.buffer.snapshot()[0])
+
+
+class SensorsTest(unittest.TestCase):
+
+    def testRingBufferKeepsTheNewest(self):
+        ring = RingBuffer(4)
+        for i in xrange(6):
+            ring.append(float(i), i * 10)
+
+        times, values = ring.snapshot()
+        self.assertEqual(list(times), [2.0, 3.0, 4.0, 5.0])
+        self.assertEqual(list(values), [20, 30, 40, 50])
+        self.assertEqual(ring.latest(), (5.0, 50))
+
+    def testEndStopStopsTheActuatorWithoutReading(self):
+        gpio = FakeGPIO()
+        stop = DigitalSensor('X start', 7, gpio)
+        stop.watch()
+
+        act = StepperActuator(identity='X', peak_rpm=600,
+                              end_stops={'start': stop})
+        reads = gpio.reads
+
+        gpio.set_input(7, gpio.LOW)
+        self.assertTrue(stop.active)
+
+        # moving away from the stop is fine
+        self.assertTrue(act.set_task(array.array('b', [1, 1]), blocking=True).result(5))
+
+        done = act.set_task(array.array('b', [-1] * 10), blocking=True)
+        self.assertRaises(ExecutionError, done.result, 5)
+        self.assertEqual(act.step_pos, 2)
+        self.assertEqual(gpio.reads, reads + 1)
+        act.kill()
+
+    def testSamplerRatesAndReadErrors(self):
+        gpio = FakeGPIO()
+        slow = DigitalSensor('slow', 3, gpio)
+        fast = DigitalSensor('fast', 5, gpio)
+        sampler = SensorSampler()
+        try:
+            sampler.add(slow, 10)
+            self.assertAlmostEqual(sampler._timer.interval, 0.1)
+            # a faster sensor speeds the tick up
+            sampler.add(fast, 100)
+            self.assertAlmostEqual(sampler._timer.interval, 0.01)
+
+            gpio.set_input(5, gpio.LOW)
+            time.sleep(0.5)
+            self.assertTrue(3 <= readings(slow) <= 8, readings(slow))
+            self.assertTrue(readings(fast) >= 4 * readings(slow), readings(fast))
+            self.assertEqual(fast.value, gpio.LOW)
+
+            def fail():
+                raise IOError('GPIO read failed')
+            fast.read = fail
+            # let a sample already under way finish
+            time.sleep(0.05)
+            before = readings(fast), readings(slow)
+            time.sleep(0.25)
+
+            # the failing sensor keeps its last good value; the other goes on
+            self.assertEqual(readings(fast), before[0])
+            self.assertEqual(fast.value, gpio.LOW)
+            self.assertTrue(readings(slow) > before[1])
+        finally:
+            sampler.stop()
+
+    def testRemovingSensorsSlowsTheTick(self):
+        gpio = FakeGPIO()
+        slow = DigitalSensor('slow', 3, gpio)
+        fast = DigitalSensor('fast', 5, gpio)
+        sampler = SensorSampler()
+        try:
+            sampler.add(slow, 10)
+            sampler.add(fast, 100)
+            timer = sampler._timer
+
+            sampler.remove(fast)
+            self.assertAlmostEqual(timer.interval, 0.1)
+
+            # the last one out stops the thread
+            sampler.remove(slow)
+            self.assertFalse(timer.running)
+            before = readings(slow)
+            time.sleep(0.15)
+            self.assertEqual(readings(slow), before)
+        finally:
+            sampler.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
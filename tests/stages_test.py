@@ -0,0 +1,34 @@
+'''
+Created on Oct 18, 2026
+'''
+import threading
+import unittest
+
+from cookiebot import hardware
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage
+
+
+class StageTest(unittest.TestCase):
+
+    def testNothingStartsAfterShutdown(self):
+        hardware.select('none')
+        stage = IcingStage(zero=False)
+        recipe = Recipe()
+        recipe.add_cookie({'icing': Recipe.IcingType.square}, (0, 0))
+        stage.load_recipe(recipe)
+
+        # a load-and-start on a command thread, racing terminate
+        starter = threading.Thread(target=stage.start_recipe)
+        starter.start()
+        stage.shutdown()
+        starter.join()
+        stage.start_recipe()
+
+        self.assertFalse(stage.live)
+        self.assertFalse(stage._recipe_timer.running)
+        self.assertNotIn('IcingStage recipe', [t.name for t in threading.enumerate()])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,71 @@
+'''
+Created on Oct 18, 2026
+'''
+import array
+import time
+import unittest
+
+from cookiebot.stepstream import (encode_steps, frame, FrameParser, FirmwareEmulator,
+                                  StepStreamLink, StreamedStepperActuator, ACK)
+
+
+class EncodeStepsTest(unittest.TestCase):
+
+    def testUnevenSpacingIsOneBlock(self):
+        blocks = list(encode_steps([1, 0, 1, 0, 0, 1, 0, 1, 0, 0, 1]))
+
+        self.assertEqual(len(blocks), 1)
+        direction, count, first, interval = blocks[0]
+        self.assertEqual((direction, count, first), (1, 5, 0))
+        self.assertTrue(2.0 < interval < 3.0)
+
+    def testDirectionChangeSplitsBlocks(self):
+        blocks = list(encode_steps([1, 1, 1, 0, -1, -1]))
+
+        self.assertEqual([b[:3] for b in blocks], [(1, 3, 0), (-1, 2, 4)])
+
+
+class FrameParserTest(unittest.TestCase):
+
+    def testResyncAfterGarbage(self):
+        good = frame(ACK, 1, 7, 3)
+        corrupt = good[:-1] + chr((ord(good[-1]) + 1) & 0xFF)
+
+        parser = FrameParser()
+        frames = parser.feed('\x00\x7e' + corrupt + good[:3])
+        frames += parser.feed(good[3:])
+
+        self.assertEqual(frames, [(ACK, (1, 7, 3))])
+
+
+class StreamedStepperActuatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.emulator = FirmwareEmulator(queue_size=2)
+        self.link = StepStreamLink.open(self.emulator.port)
+
+    def tearDown(self):
+        self.link.close()
+        self.emulator.close()
+
+    def testTaskRunsOnFirmware(self):
+        act = StreamedStepperActuator(stream=self.link, identity='Test',
+                                      peak_rpm=30, reversed=True, time_scale=20.0)
+
+        # four direction changes, so more blocks than the firmware can queue
+        task = [1] * 30 + [-1] * 10 + [1] * 10 + [-1] * 5 + [0] * 10
+        act.set_task(array.array('b', task), blocking=True)
+
+        deadline = time.time() + 10.0
+        while not act._task_is_complete() and time.time() < deadline:
+            time.sleep(0.01)
+        act.kill()
+
+        self.assertTrue(act._task_is_complete())
+        self.assertEqual(act.step_pos, 25)
+        self.assertEqual(self.emulator.axes[0].position, -25)
+        self.assertEqual(self.emulator.steps, 55)
+
+
+if __name__ == "__main__":
+    unittest.main()
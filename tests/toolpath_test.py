@@ -0,0 +1,46 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+import mock
+
+from cookiebot import stages
+from cookiebot.recipe import Recipe
+from cookiebot.stages import IcingStage, CompiledPattern
+from cookiebot.toolpath import Toolpath
+
+carriage = IcingStage.WrapperID.carriage
+nozzle = IcingStage.WrapperID.nozzle
+
+
+class ToolpathTest(unittest.TestCase):
+
+    def testIcedUntilTheOffMove(self):
+        path = Toolpath([{carriage: (-1, 1)},
+                         {nozzle: 'on'},
+                         {carriage: (1, 1), nozzle: 'run'},
+                         {carriage: (1, -1), nozzle: 'off'},
+                         {carriage: (0, 0)}])
+
+        self.assertEqual([s.iced for s in path.segments], [False, True, True, False])
+        self.assertEqual(path.bounds, (-1.0, -1.0, 1.0, 1.0))
+        self.assertAlmostEqual(path.length(), 4.0)
+
+    def testEveryPatternHasAPath(self):
+        for icing in Recipe.IcingType:
+            path = Toolpath.for_pattern(icing.value)
+            self.assertTrue(path.length() > 0, icing)
+            self.assertIs(Toolpath.for_pattern(icing.value), path)
+
+    def testSharesTheStagesPattern(self):
+        filename = Recipe.IcingType.square.value
+        CompiledPattern._cache.pop(filename, None)
+        with mock.patch('cookiebot.stages.load_pattern', wraps=stages.load_pattern) as load:
+            Toolpath.for_pattern(filename)
+            CompiledPattern.load(filename)
+        self.assertEqual(load.call_count, 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+'''
+Created on Oct 18, 2026
+'''
+import unittest
+
+from cookiebot.traceanalysis import TraceAnalysis
+
+
+def span(name, tid, ts, dur, **args):
+    return {'ph': 'X', 'name': name, 'cat': 'test', 'pid': 1, 'tid': tid,
+            'ts': ts, 'dur': dur, 'args': args}
+
+
+def track(tid, name):
+    return {'ph': 'M', 'name': 'thread_name', 'pid': 1, 'tid': tid, 'args': {'name': name}}
+
+
+class TraceAnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        # three steps, waiting on the carriage, an unknown track and the
+        # nozzle in turn; times in microseconds
+        self.trace = {'traceEvents': [
+            track(1, 'X-axis Stepper tasks'), track(2, 'Nozzle Stepper tasks'),
+            track(3, 'Gripper Stepper tasks'), track(9, 'IcingStage'),
+            span('step', 1, 0, 10),
+            span('dispatch', 9, 1000, 100, source='square.txt:1'),
+            span('task', 1, 1050, 2000, blocking=True),
+            span('dispatch gap', 9, 3050, 50),
+            span('dispatch', 9, 3100, 100, source='square.txt:2'),
+            span('task', 3, 3150, 1000, blocking=True),
+            span('dispatch gap', 9, 4150, 50),
+            span('dispatch', 9, 4200, 100, source='square.txt:3'),
+            span('task', 2, 4250, 500, blocking=True),
+            # non-blocking tasks are never waited on
+            span('task', 1, 4250, 5000, blocking=False),
+        ]}
+
+    def testTimeIsAttributedPerCategory(self):
+        analysis = TraceAnalysis()
+        analysis.add_trace(self.trace)
+
+        expected = {'carriage': 1950, 'other': 950, 'nozzle': 450, 'platform': 0,
+                    'dispatch': 400, 'idle': 1000 + 4500}
+        for category, micros in expected.items():
+            self.assertAlmostEqual(analysis.totals[category], micros / 1e6, msg=category)
+        self.assertAlmostEqual(analysis.total, 9.25e-3)
+        self.assertEqual((analysis.traces, analysis.steps), (1, 3))
+
+        self.assertEqual([line for line, _ in analysis.top_lines()['square.txt']], [1, 2, 3])
+        self.assertAlmostEqual(analysis.lines['square.txt:2'], 1100 / 1e6)
+        self.assertIn('other', analysis.report())
+
+
+if __name__ == "__main__":
+    unittest.main()
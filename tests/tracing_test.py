@@ -0,0 +1,82 @@
+'''
+Created on Oct 18, 2026
+'''
+import threading
+import unittest
+
+from cookiebot import hardware
+from cookiebot.recipe import Recipe
+from cookiebot.tracing import TraceBuffer, tracer
+from cookiebot.traysim import simulate
+
+
+class TracingTest(unittest.TestCase):
+
+    def tearDown(self):
+        tracer.disable()
+        tracer.clear()
+
+    def testRingKeepsNewestEvents(self):
+        buf = TraceBuffer(capacity=4, enabled=True)
+        for i in range(6):
+            buf.complete('event {0}'.format(i), 'test', 'track', i, i + 0.5)
+
+        self.assertEqual(len(buf), 4)
+        self.assertEqual([e[0] for e in buf.events()],
+                         ['event 2', 'event 3', 'event 4', 'event 5'])
+
+        buf.clear()
+        self.assertEqual((len(buf), list(buf.events())), (0, []))
+
+    def testChromeExport(self):
+        buf = TraceBuffer(capacity=8)
+        buf.complete('step', 'actuator', 'X-axis Stepper', 10.0, 10.5, {'steps': 3})
+        buf.complete('dispatch', 'stage', 'IcingStage', 11.0, 11.25)
+        trace = buf.to_chrome()
+
+        tracks = dict((e['tid'], e['args']['name'])
+                      for e in trace['traceEvents'] if e['ph'] == 'M')
+        self.assertEqual(sorted(tracks.values()), ['IcingStage', 'X-axis Stepper'])
+
+        step, dispatch = [e for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(tracks[step['tid']], 'X-axis Stepper')
+        self.assertEqual((step['ts'], step['dur'], step['args']), (0.0, 5e5, {'steps': 3}))
+        self.assertEqual((dispatch['ts'], dispatch['dur']), (1e6, 2.5e5))
+        self.assertNotIn('args', dispatch)
+        self.assertEqual(trace['otherData']['origin'], 10.0)
+
+    def testConcurrentWritersLoseNothing(self):
+        buf = TraceBuffer(capacity=10000, enabled=True)
+
+        def write(track):
+            for i in xrange(1000):
+                buf.complete('step', 'test', track, i, i + 1)
+
+        threads = [threading.Thread(target=write, args=('track {0}'.format(t),))
+                   for t in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(len(buf), 4000)
+        self.assertEqual(len(list(buf.events())), 4000)
+
+    def testHooksFollowEnabled(self):
+        hardware.select('none')
+        recipe = Recipe()
+        recipe.add_cookie({'icing': Recipe.IcingType.square}, (0, 0))
+
+        tracer.clear()
+        simulate(recipe)
+        self.assertEqual(len(tracer), 0)
+
+        tracer.enable()
+        result = simulate(recipe)
+        names = [e[0] for e in tracer.events()]
+        self.assertEqual(names.count('dispatch'), result['steps'])
+        self.assertIn('step', names)
+
+
+if __name__ == "__main__":
+    unittest.main()
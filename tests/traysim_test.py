@@ -0,0 +1,33 @@
+'''
+Created on Oct 18, 2026
+'''
+import array
+import unittest
+
+from cookiebot import traysim
+
+
+class TraySimTest(unittest.TestCase):
+
+    def testVirtualSteps(self):
+        clock = traysim.VirtualClock()
+        act = traysim.SimulatedStepperActuator(clock=clock, identity='Sim', peak_rpm=60)
+        done = act.set_task(array.array('b', [1] * 10), blocking=True)
+
+        # one step per 5ms, the first straight away, then a tick to finish
+        self.assertAlmostEqual(act.finish_time(), 0.05)
+        clock.now = act.finish_time()
+        act.advance(clock.now)
+
+        self.assertTrue(done.result(0))
+        self.assertEqual(act.step_pos, 10)
+        act.kill()
+
+    def testTraysMatchBaselines(self):
+        results = traysim.run_suite()
+
+        self.assertEqual(traysim.compare(results, traysim.load_baselines()), [])
+
+
+if __name__ == "__main__":
+    unittest.main()